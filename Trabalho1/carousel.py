@@ -0,0 +1,97 @@
+import os
+import socket
+import threading
+import time
+from loguru import logger
+from utils import TYPE_CAROUSEL_DATA, pack_header, content_size_for
+from flow_control import Pacer
+
+
+class Carousel:
+    # Sends every part of a file to a multicast group over and over, paced at rate bytes
+    # per second, for as long as some client is a member. Clients join with MCAST (and
+    # send it again now and then to stay), leave with LEAVE or are forgotten after
+    # member_timeout seconds. Whoever joins in the middle of a cycle gets the parts it
+    # missed in the next one, so the server sends the file once per cycle whatever the
+    # number of clients
+    def __init__(self, server, file_name: str, entry, datagram_size: int, group: str, port: int,
+                 rate: float, member_timeout: float, interface: str | None = None, ttl=1) -> None:
+        self.server = server
+        self.file_name = file_name
+        self.entry = entry
+        self.datagram_size = datagram_size
+        self.content_size = content_size_for(datagram_size)
+        self.group = group
+        self.port = port
+        self.rate = rate
+        self.member_timeout = member_timeout
+        self.number_of_parts = entry.parts_no(self.content_size)
+        # Sent in every datagram, the clients drop the ones of other carousels on the same port
+        self.carousel_id = int.from_bytes(os.urandom(2), 'big')
+        # address -> time of its last MCAST
+        self.members: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.cycles = 0
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        # Clients on the same host (and loopback tests) get the datagrams too
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        logger.info(f'Multicasting {self.file_name} to {self.group}:{self.port}')
+        self.thread.start()
+
+    # False once the carousel stopped, then the caller starts a new one
+    def join(self, address) -> bool:
+        with self.lock:
+            if self.stopped:
+                return False
+            self.members[address] = time.monotonic()
+            return True
+
+    def leave(self, address) -> None:
+        with self.lock:
+            self.members.pop(address, None)
+
+    # Forgets the members that went quiet and stops once none is left (right away for
+    # an empty file, there is nothing to send)
+    def keep_running(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            for address, last_seen in list(self.members.items()):
+                if now - last_seen > self.member_timeout:
+                    del self.members[address]
+            if not self.members or not self.number_of_parts:
+                self.stopped = True
+            return not self.stopped
+
+    def run(self) -> None:
+        pacer = Pacer(self.rate, max(self.content_size, 64 * 1024))
+        part_no = 1
+        try:
+            while self.keep_running():
+                payload = self.entry.part(part_no, self.content_size)
+                datagram = [pack_header(TYPE_CAROUSEL_DATA, part_no, payload, flags=self.carousel_id), payload]
+                delay = pacer.delay_for(sum(len(buffer) for buffer in datagram))
+                if delay:
+                    time.sleep(delay)
+                self.send(datagram)
+                part_no = part_no % self.number_of_parts + 1
+                if part_no == 1:
+                    self.cycles += 1
+        finally:
+            self.socket.close()
+            self.server.carousel_stopped(self)
+            logger.info(f'Stopped multicasting {self.file_name} after {self.cycles} cycles')
+
+    # Faults are injected as in the unicast answers, the clients repair them by unicast
+    def send(self, datagram: list) -> None:
+        if self.server.should_drop():
+            return
+        self.server.stats.add('multicast_datagrams_sent')
+        self.server.stats.add('multicast_bytes_sent', self.socket.sendmsg(
+            self.server.corrupt_datagram(datagram), [], 0, (self.group, self.port)))
@@ -0,0 +1,72 @@
+import os
+
+
+class Chunk_Writer:
+    # Writes the parts of a download at their offsets in a preallocated file,
+    # so they can arrive in any order. Received parts are tracked in a bitmap
+    def __init__(self, path: str, number_of_parts: int, content_size: int, file_size: int | None = None) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.number_of_parts = number_of_parts
+        self.content_size = content_size
+        self.received_count = 0
+        self.bitmap = bytearray((number_of_parts + 7) // 8)
+        self.file_size = number_of_parts * content_size if file_size is None else file_size
+        self.first_missing_hint = 1
+        self.file = open(path, 'wb+')
+        self.file.truncate(self.file_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def has_part(self, part_no: int) -> bool:
+        index = part_no - 1
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    # Returns False for duplicated or out of range parts
+    def write_part(self, part_no: int, data: bytes) -> bool:
+        if part_no < 1 or part_no > self.number_of_parts or self.has_part(part_no):
+            return False
+        index = part_no - 1
+        os.pwrite(self.file.fileno(), data, index * self.content_size)
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.received_count += 1
+        if part_no == self.number_of_parts:
+            self.file_size = index * self.content_size + len(data)
+        return True
+
+    def part_length(self, part_no: int) -> int:
+        return min(self.content_size, self.file_size - (part_no - 1) * self.content_size)
+
+    def read_part(self, part_no: int) -> bytes:
+        return os.pread(self.file.fileno(), self.part_length(part_no), (part_no - 1) * self.content_size)
+
+    def is_complete(self) -> bool:
+        return self.received_count == self.number_of_parts
+
+    def first_missing(self) -> int | None:
+        while self.first_missing_hint <= self.number_of_parts:
+            if not self.has_part(self.first_missing_hint):
+                return self.first_missing_hint
+            self.first_missing_hint += 1
+        return None
+
+    def missing_parts(self, start=1, end=None):
+        end = self.number_of_parts if end is None else min(end, self.number_of_parts)
+        for part_no in range(max(start, self.first_missing() or start), end + 1):
+            if not self.has_part(part_no):
+                yield part_no
+
+    # An incomplete download is removed, preallocated it would look like the whole file
+    def close(self):
+        if self.file.closed:
+            return
+        if not self.is_complete():
+            self.file.close()
+            os.remove(self.path)
+            return
+        self.file.truncate(self.file_size)
+        self.file.close()
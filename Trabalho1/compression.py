@@ -0,0 +1,64 @@
+import lzma
+import zlib
+
+# Codec of a compressed DATA datagram, sent in its flags (0 is a part sent as it is)
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+CODEC_NAMES = {codec: name for name, codec in CODECS.items()}
+# (lowest, highest, default) level of each codec
+LEVELS = {CODEC_ZLIB: (1, 9, 6), CODEC_LZMA: (0, 9, 6)}
+# A part is sent as it is unless compressing it saves at least 1/16 of it, so
+# already compressed files (images, archives) cost nothing to decompress
+MIN_SAVING_FRACTION = 1 / 16
+
+
+# compress=zlib/6 (or just compress=lzma for the default level): (codec, level), or
+# None for an unknown codec, which the server answers with uncompressed parts
+def parse_compression(value: str) -> tuple[int, int] | None:
+    name, _, level = value.partition('/')
+    codec = CODECS.get(name.lower())
+    if codec is None:
+        return None
+    lowest, highest, default = LEVELS[codec]
+    return codec, max(lowest, min(int(level) if level else default, highest))
+
+
+def format_compression(codec: int, level: int) -> str:
+    return f'{CODEC_NAMES[codec]}/{level}'
+
+
+# Raw LZMA2 streams, the xz container would add about 60 bytes to every part
+def lzma_filters(level: int) -> list[dict]:
+    return [{'id': lzma.FILTER_LZMA2, 'preset': level}]
+
+
+# The compressed part, or None when it's not worth it. Higher levels are only tried
+# when the fastest one saves at least half as much, lzma takes ~30 ms to give up on
+# 64 KiB of a PNG
+def compress_part(data: bytes | memoryview, codec: int, level: int) -> bytes | None:
+    if (codec, level) != (CODEC_ZLIB, 1):
+        if len(zlib.compress(data, 1)) > len(data) * (1 - MIN_SAVING_FRACTION / 2):
+            return None
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(data, level)
+    else:
+        compressed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=lzma_filters(level))
+    if len(compressed) > len(data) * (1 - MIN_SAVING_FRACTION):
+        return None
+    return compressed
+
+
+def decompress_part(data: bytes | memoryview, codec: int, max_length: int) -> bytes:
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=lzma_filters(0))
+    else:
+        raise ValueError(f'unknown codec {codec}')
+    # A part never grows past the content size, more than that is an error
+    part = decompressor.decompress(data, max_length + 1)
+    if len(part) > max_length:
+        raise ValueError('decompressed part larger than the content size')
+    return part
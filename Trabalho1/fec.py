@@ -0,0 +1,64 @@
+from chunk_writer import Chunk_Writer
+
+# Forward error correction with interleaved XOR parities: the parts are grouped in
+# blocks of block_size parts and parity i of a block is the XOR of the parts whose
+# index in the block is i modulo the number of parities. Each parity rebuilds one
+# lost part among the ones it covers, so r parities repair up to r parts of a block
+# as long as they are not covered by the same parity
+
+
+def xor_parities(parts, parities: int, length: int) -> list[bytes]:
+    values = [0] * parities
+    for index, part in enumerate(parts):
+        values[index % parities] ^= int.from_bytes(part, 'little')
+    # Shorter parts (the last one of the file) count as padded with zeros
+    return [value.to_bytes(length, 'little') for value in values]
+
+
+def block_first_part(part_no: int, block_size: int) -> int:
+    return part_no - (part_no - 1) % block_size
+
+
+class FEC_Decoder:
+    def __init__(self, writer: Chunk_Writer, block_size: int, parities: int) -> None:
+        self.writer = writer
+        self.block_size = block_size
+        self.parities = parities
+        # (first part of the block, parity index) -> parity, only for incomplete blocks
+        self.received: dict[tuple[int, int], bytes] = {}
+
+    def block_last_part(self, block_first: int) -> int:
+        return min(block_first + self.block_size - 1, self.writer.number_of_parts)
+
+    def add_parity(self, block_first: int, index: int, parity: bytes | memoryview) -> list[int]:
+        if index >= self.parities or self.block_complete(block_first):
+            return []
+        self.received[(block_first, index)] = bytes(parity)
+        return self.repair(block_first)
+
+    def block_complete(self, block_first: int) -> bool:
+        return all(self.writer.has_part(part_no) for part_no in range(block_first, self.block_last_part(block_first) + 1))
+
+    # Returns the parts rebuilt from the parities of the block
+    def repair(self, block_first: int) -> list[int]:
+        repaired = []
+        block_last = self.block_last_part(block_first)
+        for index in range(self.parities):
+            parity = self.received.get((block_first, index))
+            if parity is None:
+                continue
+            covered = range(block_first + index, block_last + 1, self.parities)
+            missing = [part_no for part_no in covered if not self.writer.has_part(part_no)]
+            if len(missing) != 1:
+                continue
+            value = int.from_bytes(parity, 'little')
+            for part_no in covered:
+                if part_no != missing[0]:
+                    value ^= int.from_bytes(self.writer.read_part(part_no), 'little')
+            data = value.to_bytes(len(parity), 'little')[:self.writer.part_length(missing[0])]
+            if self.writer.write_part(missing[0], data):
+                repaired.append(missing[0])
+        if self.block_complete(block_first):
+            for index in range(self.parities):
+                self.received.pop((block_first, index), None)
+        return repaired
@@ -0,0 +1,137 @@
+import math
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from compression import compress_part
+
+# Marks a part not compressed yet in the compressed variants of an entry
+NOT_COMPRESSED = object()
+# Compressed variants kept per entry, the clients choose the content size, codec and level
+MAX_COMPRESSED_VARIANTS = 4
+
+
+class Catalog_Entry:
+    def __init__(self, path: str, stat: os.stat_result, content_size: int, catalog=None) -> None:
+        self.path = path
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.content_size = content_size
+        self.max_parts_no = math.ceil(self.size / content_size)
+        if self.size == 0:
+            self.data = memoryview(b'')
+        else:
+            with open(path, 'rb') as file:
+                self.data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        # (content size, codec, level) -> every part compressed, None for the parts
+        # that don't compress, filled in as they are asked for. The least recently
+        # used variants beyond MAX_COMPRESSED_VARIANTS are dropped
+        self.compressed: OrderedDict[tuple[int, int, int], list] = OrderedDict()
+        self.lock = threading.Lock()
+        # Bytes of the compressed parts kept, counted in the loaded bytes of the catalog
+        self.compressed_bytes = 0
+        self.catalog = catalog
+        self.loaded = False
+
+    def is_stale(self, stat: os.stat_result) -> bool:
+        return self.size != stat.st_size or self.mtime_ns != stat.st_mtime_ns
+
+    def parts_no(self, content_size: int) -> int:
+        if content_size == self.content_size:
+            return self.max_parts_no
+        return math.ceil(self.size / content_size)
+
+    # Zero-copy slice of the mapped file, part numbers start at 1
+    def part(self, part_no: int, content_size: int | None = None) -> memoryview:
+        content_size = content_size or self.content_size
+        start_index = content_size * (part_no - 1)
+        return self.data[start_index:start_index + content_size]
+
+    # Compressed once and kept while the entry is loaded, so a hot file is not compressed
+    # again for every client. Two threads may compress the same part, both get the same bytes
+    def compressed_part(self, part_no: int, content_size: int, codec: int, level: int) -> bytes | None:
+        key = (content_size, codec, level)
+        with self.lock:
+            variant = self.compressed.get(key)
+            if variant is None:
+                variant = self.compressed[key] = [NOT_COMPRESSED] * self.parts_no(content_size)
+                while len(self.compressed) > MAX_COMPRESSED_VARIANTS:
+                    self.account(-variant_bytes(self.compressed.popitem(last=False)[1]))
+            else:
+                self.compressed.move_to_end(key)
+        compressed = variant[part_no - 1]
+        if compressed is NOT_COMPRESSED:
+            compressed = compress_part(self.part(part_no, content_size), codec, level)
+            with self.lock:
+                # Not counted when the variant was dropped meanwhile or another thread got there first
+                if self.compressed.get(key) is variant and variant[part_no - 1] is NOT_COMPRESSED:
+                    variant[part_no - 1] = compressed
+                    self.account(len(compressed) if compressed is not None else 0)
+        return compressed
+
+    def account(self, nbytes: int) -> None:
+        if self.catalog is not None:
+            self.catalog.charge(self, nbytes)
+        else:
+            self.compressed_bytes += nbytes
+
+
+def variant_bytes(variant: list) -> int:
+    return sum(len(part) for part in variant if part is not None and part is not NOT_COMPRESSED)
+
+
+class File_Catalog:
+    # Keeps the served files mmapped between requests. Entries are reloaded when
+    # the file size or mtime changes and the least recently used ones are dropped
+    # once more than max_bytes are mapped or kept compressed. Their compressed parts
+    # go with them
+    def __init__(self, root: str, content_size: int, max_bytes=256 * 1024 * 1024) -> None:
+        self.root = root
+        self.content_size = content_size
+        self.max_bytes = max_bytes
+        self.loaded_bytes = 0
+        self.entries: OrderedDict[str, Catalog_Entry] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_name: str) -> Catalog_Entry:
+        path = os.path.join(self.root, file_name)
+        stat = os.stat(path)
+        with self.lock:
+            return self._get(file_name, path, stat)
+
+    def _get(self, file_name: str, path: str, stat: os.stat_result) -> Catalog_Entry:
+        entry = self.entries.get(file_name)
+        if entry is not None and not entry.is_stale(stat):
+            self.entries.move_to_end(file_name)
+            return entry
+        if entry is not None:
+            self.remove(file_name)
+        entry = Catalog_Entry(path, stat, self.content_size, self)
+        entry.loaded = True
+        self.entries[file_name] = entry
+        self.loaded_bytes += entry.size
+        self.evict(entry)
+        return entry
+
+    # Called by the entries as they keep (or drop) compressed parts
+    def charge(self, entry: Catalog_Entry, nbytes: int) -> None:
+        with self.lock:
+            entry.compressed_bytes += nbytes
+            if entry.loaded:
+                self.loaded_bytes += nbytes
+                self.evict(entry)
+
+    # Drops the least recently used entries but keep while over max_bytes
+    def evict(self, keep: Catalog_Entry) -> None:
+        for file_name in [name for name, entry in self.entries.items() if entry is not keep]:
+            if self.loaded_bytes <= self.max_bytes:
+                break
+            self.remove(file_name)
+
+    # The mapping itself is released once no slice of it is referenced anymore
+    def remove(self, file_name: str) -> None:
+        entry = self.entries.pop(file_name, None)
+        if entry is not None:
+            entry.loaded = False
+            self.loaded_bytes -= entry.size + entry.compressed_bytes
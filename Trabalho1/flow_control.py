@@ -0,0 +1,101 @@
+import time
+from collections import OrderedDict
+
+
+class RTT_Estimator:
+    # Retransmission timeout in the style of Jacobson/Karels (RFC 6298):
+    # RTO = SRTT + 4 * RTTVAR, doubled on every timeout until a new sample arrives
+    def __init__(self, initial_rto=1.0, min_rto=0.005, max_rto=10.0, alpha=1/8, beta=1/4) -> None:
+        self.srtt: float | None = None
+        self.rttvar: float | None = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.backoff = 1
+
+    # Only for requests that were not retransmitted (Karn's algorithm)
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        self.backoff = 1
+
+    def on_timeout(self) -> None:
+        self.backoff = min(self.backoff * 2, 64)
+
+    def timeout(self) -> float:
+        return min(self.rto * self.backoff, self.max_rto)
+
+
+class Congestion_Window:
+    # AIMD window of requests in flight: slow start up to ssthresh, then +1 part
+    # per window of acknowledged parts, halved at most once per RTT on losses
+    def __init__(self, initial=4, minimum=1, maximum=1024) -> None:
+        self.size = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.ssthresh = float(maximum)
+        self.recovery_until = 0.0
+
+    def window(self) -> int:
+        return int(self.size)
+
+    def on_ack(self) -> None:
+        if self.size < self.ssthresh:
+            self.size += 1
+        else:
+            self.size += 1 / self.size
+        self.size = min(self.size, self.maximum)
+
+    def on_loss(self, now: float, rtt: float) -> bool:
+        if now < self.recovery_until:
+            return False
+        self.ssthresh = max(self.size / 2, self.minimum)
+        self.size = self.ssthresh
+        self.recovery_until = now + rtt
+        return True
+
+
+class Pacer:
+    # Token bucket, delay_for reserves the tokens for nbytes and returns how
+    # long the caller must wait before sending them
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+
+    def delay_for(self, nbytes: int) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class Client_Pacers:
+    # One pacer per client address, the least recently used ones are forgotten
+    def __init__(self, rate: float, burst: int, max_clients=4096) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.pacers: OrderedDict[tuple, Pacer] = OrderedDict()
+
+    def delay_for(self, address, nbytes: int) -> float:
+        pacer = self.pacers.get(address)
+        if pacer is None:
+            pacer = Pacer(self.rate, self.burst)
+            self.pacers[address] = pacer
+            if len(self.pacers) > self.max_clients:
+                self.pacers.popitem(last=False)
+        else:
+            self.pacers.move_to_end(address)
+        return pacer.delay_for(nbytes)
@@ -0,0 +1,240 @@
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from loguru import logger
+from udp_server import UDP_Server
+from udp_client import UDP_Client, ChecksumFailedException
+from utils import PROTOCOL_VERSION, parse_fec_option
+from compression import parse_compression
+from metrics import latency_ms
+from collections import Counter
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+DEFAULT_SIZES = '1K,64K,1M,16M'
+CONTENTS = ('random', 'text', 'mixed')
+WORDS = ('the', 'of', 'and', 'to', 'in', 'my', 'thou', 'lord', 'god', 'soul', 'which', 'that', 'was', 'not',
+         'for', 'me', 'thee', 'what', 'love', 'truth', 'heart', 'when', 'how', 'yet', 'whom', 'being', 'mind')
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix('B')
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for unit, scale in reversed(SIZE_UNITS.items()):
+        if size >= scale and size % scale == 0:
+            return f'{size // scale}{unit}'
+    return str(size)
+
+
+# The content only depends on the seed, the size and the kind of content, so runs with
+# the same arguments transfer the same bytes. Random bytes don't compress, text does and
+# mixed alternates 64 KiB of each
+def generate_file(path: str, size: int, seed: int, content='random'):
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        return
+    generator = random.Random(f'{seed}:{size}')
+    with open(path, 'wb') as file:
+        remaining = size
+        block_no = 0
+        while remaining:
+            chunk_size = min(remaining, 64 * 1024 if content == 'mixed' else 1024 * 1024)
+            if content == 'text' or (content == 'mixed' and block_no % 2 == 0):
+                file.write(generate_text(generator, chunk_size))
+            else:
+                file.write(generator.randbytes(chunk_size))
+            remaining -= chunk_size
+            block_no += 1
+
+
+def generate_text(generator: random.Random, size: int) -> bytes:
+    text = bytearray()
+    while len(text) < size:
+        text += ' '.join(generator.choices(WORDS, k=12)).encode('utf-8') + b'.\n'
+    return bytes(text[:size])
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def children_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Stopped with SIGTERM, then the server stats are sent back through stats
+def serve(server_kwargs: dict, log_level: str, ready, stats):
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = UDP_Server(**server_kwargs, auto_start=False)
+    ready.set()
+    server.start()
+    stats.put(server.stats.snapshot())
+
+
+def fetch(client: UDP_Client, file_name: str, max_attempts: int) -> int:
+    # The FOUND answer may be dropped or corrupted too, then FETCH is sent again
+    for attempt in range(max_attempts):
+        try:
+            client.fetch(file_name)
+            return attempt
+        except (socket.timeout, ChecksumFailedException):
+            continue
+    raise TimeoutError(f'{file_name} was not found after {max_attempts} attempts')
+
+
+def fetch_in_thread(clients: list[UDP_Client], client_no: int, file_name: str, max_attempts: int, fetch_retries: list[int]):
+    fetch_retries[client_no] = fetch(clients[client_no], file_name, max_attempts)
+
+
+# Each client downloads to its own folder, all at the same time
+def client_folder(client_no: int, args) -> str:
+    return 'client_data' if args.clients == 1 else os.path.join('client_data', str(client_no))
+
+
+# One server process per size, so its CPU time can be read once it's gone
+def run_transfer(size: int, args) -> dict:
+    file_name = f'bench_{format_size(size)}.bin' if args.content == 'random' else f'bench_{format_size(size)}_{args.content}.bin'
+    generate_file(os.path.join('server_data', file_name), size, args.seed, args.content)
+    client_paths = [os.path.join(client_folder(client_no, args), file_name) for client_no in range(args.clients)]
+    for client_path in client_paths:
+        os.makedirs(os.path.dirname(client_path), exist_ok=True)
+        if os.path.exists(client_path):
+            os.remove(client_path)
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server_stats = context.Queue()
+    server_kwargs = {
+        'ip': args.ip, 'port': args.port, 'should_corrupt': args.corruption_rate > 0,
+        'corruption_rate': args.corruption_rate, 'loss_rate': args.loss_rate, 'seed': args.seed,
+        'pacing_rate': args.pacing_rate, 'multicast_rate': args.multicast_rate,
+    }
+    server_cpu_before = children_cpu_time()
+    server = context.Process(target=serve, args=(server_kwargs, args.log_level, ready, server_stats))
+    server.start()
+    try:
+        ready.wait()
+        clients = [UDP_Client(ip=args.ip, port=args.port, window_size=args.window_size,
+                              protocol_version=args.protocol_version, datagram_size=args.datagram_size,
+                              burst_size=args.burst_size, fec=args.fec, compression=args.compress,
+                              multicast=args.multicast, download_folder=client_folder(client_no, args),
+                              auto_start=False, progress=False)
+                   for client_no in range(args.clients)]
+        fetch_retries = [0] * args.clients
+        threads = [threading.Thread(target=fetch_in_thread, args=(clients, client_no, file_name, args.max_attempts, fetch_retries))
+                   for client_no in range(args.clients)]
+        client_cpu_before = time.process_time()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+        client_cpu = time.process_time() - client_cpu_before
+        for client in clients:
+            client.UDP_Client_Socket.close()
+    finally:
+        server.terminate()
+        try:
+            snapshot = server_stats.get(timeout=5)
+        except queue.Empty:
+            snapshot = {'counters': {}, 'histograms': {}}
+        server.join()
+    server_cpu = children_cpu_time() - server_cpu_before
+    latencies = [latency * 1000 for client in clients for latency in client.part_latencies]
+    client_stats = sum((client.stats for client in clients), Counter())
+    stats = snapshot['counters']
+    return {
+        'file': file_name,
+        'size': size,
+        'ok': all(os.path.isfile(client_path) and filecmp.cmp(os.path.join('server_data', file_name), client_path, shallow=False)
+                  for client_path in client_paths),
+        'seconds': seconds,
+        'throughput_mib_s': size * args.clients / seconds / 1024 ** 2,
+        'chunks': len(latencies),
+        'chunk_latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+        },
+        'retransmits': client_stats['parts_retransmitted'],
+        'checksum_failures': client_stats['checksum_failures'],
+        'repaired': client_stats['parts_repaired'],
+        'compressed_parts': client_stats['parts_decompressed'],
+        'multicast_parts': client_stats['parts_multicast'],
+        'unicast_repaired_parts': client_stats['parts_unicast_repaired'],
+        'server_bytes_sent': stats.get('bytes_sent', 0) + stats.get('multicast_bytes_sent', 0),
+        'server_multicast_bytes_sent': stats.get('multicast_bytes_sent', 0),
+        'server_latency_ms': latency_ms(snapshot['histograms']),
+        'fetch_retries': sum(fetch_retries),
+        'client_cpu_s': client_cpu,
+        'server_cpu_s': server_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Downloads generated files from a local UDP server and reports the results as JSON')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'comma separated file sizes, from 1K to 1G (default {DEFAULT_SIZES})')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated files and the injected faults')
+    parser.add_argument('--loss-rate', type=float, default=0.0, help='fraction of the datagrams dropped by the server')
+    parser.add_argument('--corruption-rate', type=float, default=0.0, help='fraction of the datagrams corrupted by the server')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4567)
+    parser.add_argument('--protocol-version', type=int, default=PROTOCOL_VERSION)
+    parser.add_argument('--datagram-size', type=int, default=None)
+    parser.add_argument('--window-size', type=int, default=32)
+    parser.add_argument('--burst-size', type=int, default=256, help='parts per RFETCH, 0 uses CFETCH')
+    parser.add_argument('--fec', type=parse_fec_option, default=None, help='K/R parities per block of K parts')
+    parser.add_argument('--compress', type=parse_compression, default=None, help='codec/level of the parts, zlib/1-9 or lzma/0-9')
+    parser.add_argument('--content', choices=CONTENTS, default='random', help='what the generated files contain')
+    parser.add_argument('--pacing-rate', type=float, default=None)
+    parser.add_argument('--clients', type=int, default=1, help='clients downloading the same file at the same time')
+    parser.add_argument('--multicast', action='store_true', help='the clients join the multicast carousel of the file')
+    parser.add_argument('--multicast-rate', type=float, default=16 * 1024 * 1024, help='bytes per second sent by the carousel')
+    parser.add_argument('--max-attempts', type=int, default=10, help='FETCH attempts before a transfer is given up')
+    parser.add_argument('--workdir', default=None, help='keeps the generated files here instead of a temporary folder')
+    parser.add_argument('--log-level', default='CRITICAL')
+    parser.add_argument('--output', default=None, help='writes the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        os.chdir(args.workdir or temporary_folder)
+        os.makedirs('server_data', exist_ok=True)
+        os.makedirs('client_data', exist_ok=True)
+        results = [run_transfer(size, args) for size in sizes]
+    report = {
+        'protocol': 'udp',
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir', 'log_level')},
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
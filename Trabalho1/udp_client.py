@@ -1,31 +1,93 @@
-import math
+import ipaddress
 import socket
 import sys
 import time
 from loguru import logger  
 from utils import calculate_checksum, format_part_no, deformat_part_no
+from utils import (PROTOCOL_VERSION, MAX_DATAGRAM_SIZE, ETHERNET_DATAGRAM_SIZE, TYPE_FOUND, TYPE_DATA, TYPE_ERROR,
+                   FOUND_PAYLOAD, ERROR_PAYLOAD, MalformedDatagramException, unpack_datagram, content_size_for,
+                   format_part_ranges, MAX_RANGE_PARTS, TYPE_PARITY, TYPE_CAROUSEL, TYPE_CAROUSEL_DATA, CAROUSEL_PAYLOAD, TYPE_STATS, clamp_fec)
 from tqdm import tqdm
+from chunk_writer import Chunk_Writer
+from flow_control import RTT_Estimator, Congestion_Window
+from fec import FEC_Decoder, block_first_part
+from compression import format_compression, decompress_part
+from collections import Counter
+import json
 
 class ChecksumFailedException(Exception):
     pass
 
 class UDP_Client:
-    def __init__(self, ip='127.0.0.1', port=4567, buffer_size=1024) -> None:
+    def __init__(self, ip='127.0.0.1', port=4567, buffer_size=1024, window_size=32,
+                 protocol_version=PROTOCOL_VERSION, datagram_size=None, burst_size=256, fec=None,
+                 compression=None, multicast=False, download_folder='client_data', auto_start=True,
+                 progress=True) -> None:
         self.ip = ip
         logger.info(f'Using {self.ip}')
         self.port = port
         self.buffer_size = buffer_size
         self.content_size = buffer_size - (64 + 8 + 2) # checksum_size = 64 bytes + packet_num = 8 bytes + 2x 1 byte ':'
+        # Max number of CFETCH requests in flight, 1 falls back to stop-and-wait
+        self.window_size = window_size
+        # Timeout for FETCH, the parts use the timeout estimated from the measured RTT
+        self.retransmit_timeout = 2.0
+        self.rtt = RTT_Estimator(initial_rto=self.retransmit_timeout)
+        # 1 is the text protocol, 2 the binary one where the datagram size is negotiated on FETCH
+        self.protocol_version = protocol_version
+        self.datagram_size = datagram_size or self.default_datagram_size()
+        # Parts asked for in each RFETCH range request (binary protocol), 0 uses one CFETCH per part
+        self.burst_size = burst_size
+        # Parts requested after a missing one that may arrive before it is given up as lost
+        self.reorder_threshold = 3
+        # (block size, parities) of the XOR parities the server adds to each RFETCH burst
+        self.fec = clamp_fec(*fec) if fec else None
+        # (codec, level) asked for on FETCH (binary protocol), the parts only come
+        # compressed when the server answers FOUND with the same codec
+        self.compression = compression
+        self.transfer_compression = None
+        # Join the multicast carousel of the file (binary protocol) instead of asking for its
+        # parts, MCAST is sent again every multicast_keepalive seconds to stay a member
+        self.multicast = multicast
+        self.multicast_keepalive = 3.0
+        self.download_folder = download_folder
+        self.stats = Counter()
+        # Seconds between the (last) request of each part and its arrival, for the last transfer
+        self.part_latencies: list[float] = []
+        self.progress = progress
+        self.transfer_datagram_size = self.datagram_size
+        self.transfer_window_size = window_size
+        self.receive_size = max(self.buffer_size, self.datagram_size)
         self.UDP_Client_Socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        self.UDP_Client_Socket.settimeout(2.0)
+        self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
         logger.success(f"UDP client started on {self.ip}:{self.port}")
-        self.start()
+        if auto_start:
+            self.start()
+
+    def server_is_loopback(self) -> bool:
+        try:
+            return ipaddress.ip_address(self.ip).is_loopback
+        except ValueError:
+            return self.ip == 'localhost'
+
+    # Whole 64 KiB datagrams only make sense when they don't need to be fragmented
+    def default_datagram_size(self) -> int:
+        if self.server_is_loopback():
+            return MAX_DATAGRAM_SIZE
+        return ETHERNET_DATAGRAM_SIZE
         
     def start(self):
         while True:
-            file_name = input("Enter a filename (or 'q' to exit): ")
+            file_name = input("Enter a filename (or 'q' to exit, ':stats' for the server stats): ")
             if file_name.lower() == 'q':
                 break
+            # A file name can't have ':' in it
+            if file_name == ':stats':
+                try:
+                    print(json.dumps(self.fetch_stats(), indent=2))
+                except (socket.timeout, ChecksumFailedException):
+                    logger.error('No answer to STATS')
+                continue
             while True:
                 try:
                     self.fetch(file_name)
@@ -42,6 +104,10 @@ class UDP_Client:
                     continue
         
     def fetch(self, file_name: str):
+        if self.protocol_version == PROTOCOL_VERSION and self.multicast:
+            return self.fetch_multicast(file_name)
+        if self.protocol_version == PROTOCOL_VERSION:
+            return self.fetch_binary(file_name)
         logger.info(f'Sending FETCH:{file_name}')
         encodedRequestMessage = f'FETCH:{file_name}'.encode('utf-8')
         self.UDP_Client_Socket.sendto(encodedRequestMessage, (self.ip, self.port))
@@ -62,61 +128,469 @@ class UDP_Client:
                 raise FileNotFoundError()
             return
         elif res_args[0] == 'FOUND':
-            with open(f'client_data/{file_name}', 'wb') as file:
-                file.write(''.encode('utf-8'))
             number_of_parts = int(res_args[3])
-            i = 0
-            with tqdm(total=number_of_parts, desc="Downloading") as pbar:
-                while i < number_of_parts:
-                    try:
-                        self.cfetch(file_name, i+1)
-                        i += 1
-                        pbar.update(1) 
-                    except ChecksumFailedException:
-                        logger.error(f'Corrupted Information, trying again for part {i+1}')
-                    except TimeoutError:
-                        logger.error(f'Timeout: Server took too long to answer, trying again for part {i+1}')
-                    except Exception as error:
-                        logger.error(f'Error in cfetch: {error}')
-                        error_args = error.args[0].split(':')
-                        if error_args[0] == 'code':
-                            if error_args[1] == '701' or error_args[1] == '702':
-                                return
-                            elif error_args[1] == '700':
-                                logger.error('Requesting more parts than existing')
-                                return
-                        elif error_args[0] == 'need':
-                            part_needed = int(error_args[1])
-                            i = part_needed - 1
-            logger.success(f'Finished bringing file {file_name}')
+            self.part_latencies = []
+            with Chunk_Writer(f'{self.download_folder}/{file_name}', number_of_parts, self.content_size) as writer:
+                if self.window_size > 1:
+                    self.fetch_parts_windowed(file_name, writer)
+                else:
+                    self.fetch_parts_sequential(file_name, writer)
+            if writer.is_complete():
+                logger.success(f'Finished bringing file {file_name}')
         else:
             logger.error('Not implemented')
             logger.error(f'res_args: {res_args}')
             return
-                
-    def cfetch(self, file_name: str, part_no: int):
-        # logger.info(f'Sending CFETCH:{file_name}:{part_no}')
-        encodedRequestMessage = f'CFETCH:{file_name}:{part_no}'.encode('utf-8')
+
+    def fetch_binary(self, file_name: str):
+        options = f':compress={format_compression(*self.compression)}' if self.compression else ''
+        logger.info(f'Sending FETCH:{file_name}:{PROTOCOL_VERSION}:{self.datagram_size}{options}')
+        encodedRequestMessage = f'FETCH:{file_name}:{PROTOCOL_VERSION}:{self.datagram_size}{options}'.encode('utf-8')
         self.UDP_Client_Socket.sendto(encodedRequestMessage, (self.ip, self.port))
-        res_args, file_content = self.receive_response(has_file=True)
-        if res_args[0] == 'ERROR':
-            logger.error(f'Error code: {res_args[1]}')
-            logger.error(f'Error message: {res_args[2]}')
-            raise Exception(f'code:{res_args[1]}')
+        response = self.receive_answer(TYPE_FOUND)
+        if response is None:
+            return
+        flags, payload = response
+        number_of_parts, self.transfer_datagram_size, file_size = FOUND_PAYLOAD.unpack_from(payload)
+        logger.info(f'Negotiated datagram size: {self.transfer_datagram_size} ({file_size} bytes in {number_of_parts} parts)')
+        self.transfer_compression = self.compression if self.compression and flags == self.compression[0] else None
+        if self.compression and self.transfer_compression is None:
+            logger.info('The server does not compress with the codec asked for, the parts come as they are')
+        content_size = content_size_for(self.transfer_datagram_size)
+        self.size_receive_buffer()
+        self.part_latencies = []
+        with Chunk_Writer(f'{self.download_folder}/{file_name}', number_of_parts, content_size, file_size) as writer:
+            if self.burst_size > 0:
+                self.fetch_parts_burst(file_name, writer)
+            elif self.window_size > 1:
+                self.fetch_parts_windowed(file_name, writer)
+            else:
+                self.fetch_parts_sequential(file_name, writer)
+        if writer.is_complete():
+            logger.success(f'Finished bringing file {file_name}')
+
+    # The counters and histograms of the server (of one of its processes with --workers)
+    def fetch_stats(self) -> dict:
+        self.UDP_Client_Socket.sendto(b'STATS', (self.ip, self.port))
+        _, payload = self.receive_answer(TYPE_STATS)
+        return json.loads(bytes(payload).decode('utf-8'))
+
+    # The answer of type kind to FETCH, MCAST or STATS as (flags, payload), or None for an error
+    # other than a missing file
+    def receive_answer(self, kind: int):
+        while True:
+            response, _ = self.UDP_Client_Socket.recvfrom(self.receive_size)
+            try:
+                received_kind, flags, _, payload = unpack_datagram(response)
+            except MalformedDatagramException as error:
+                self.stats['checksum_failures'] += 1
+                logger.error(f'Checksum failed! Retry... ({error})')
+                raise ChecksumFailedException
+            if received_kind == TYPE_ERROR:
+                code = ERROR_PAYLOAD.unpack_from(payload)[0]
+                logger.error(f'Error code: {code}')
+                logger.error(f'Error message: {bytes(payload[ERROR_PAYLOAD.size:]).decode("utf-8")}')
+                if code == 701:
+                    raise FileNotFoundError()
+                return None
+            if received_kind == kind:
+                return flags, payload
+            # Late DATA from a previous transfer
+
+    def send_mcast(self, file_name: str):
+        request = f'MCAST:{file_name}:{PROTOCOL_VERSION}:{self.datagram_size}'
+        logger.info(f'Sending {request}')
+        self.UDP_Client_Socket.sendto(request.encode('utf-8'), (self.ip, self.port))
+
+    # Joins the carousel of the file: the server answers MCAST with the group where it
+    # sends every part over and over. The parts are taken in whatever order they come
+    # until the file is complete, a whole cycle went by (the rest were lost) or the
+    # carousel goes quiet, then the client leaves and asks for what it misses by unicast
+    def fetch_multicast(self, file_name: str):
+        self.send_mcast(file_name)
+        response = self.receive_answer(TYPE_CAROUSEL)
+        if response is None:
+            return
+        (number_of_parts, self.transfer_datagram_size, file_size, group, group_port,
+         carousel_id) = CAROUSEL_PAYLOAD.unpack_from(response[1])
+        group = socket.inet_ntoa(group)
+        logger.info(f'Joining {group}:{group_port} ({file_size} bytes in {number_of_parts} parts of {self.transfer_datagram_size})')
+        # The carousel sends the parts as they are
+        self.transfer_compression = None
+        self.size_receive_buffer()
+        self.part_latencies = []
+        with Chunk_Writer(f'{self.download_folder}/{file_name}', number_of_parts, content_size_for(self.transfer_datagram_size), file_size) as writer:
+            group_socket = self.join_group(group, group_port)
+            try:
+                self.receive_carousel(file_name, group_socket, carousel_id, writer)
+            finally:
+                group_socket.close()
+                self.UDP_Client_Socket.sendto(f'LEAVE:{file_name}'.encode('utf-8'), (self.ip, self.port))
+            if not writer.is_complete():
+                self.repair_parts(file_name, writer)
+        if writer.is_complete():
+            logger.success(f'Finished bringing file {file_name}')
+
+    def join_group(self, group: str, port: int) -> socket.socket:
+        group_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        # Every client of the host listens on the same port
+        group_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        group_socket.bind(('', port))
+        # A loopback server multicasts on the loopback interface, otherwise the kernel picks one
+        interface = '127.0.0.1' if self.server_is_loopback() else '0.0.0.0'
+        group_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(interface))
+        # Nothing is asked again while in the group, the buffer is all that absorbs a slow reader
+        try:
+            group_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.window_size * self.transfer_datagram_size)
+        except OSError:
+            pass
+        return group_socket
+
+    def receive_carousel(self, file_name: str, group_socket: socket.socket, carousel_id: int, writer: Chunk_Writer):
+        group_socket.settimeout(self.retransmit_timeout)
+        last_keepalive = time.monotonic()
+        previous_part_no = None
+        # Parts the carousel went through since the first one received
+        advanced = 0
+        with tqdm(total=writer.number_of_parts, desc="Multicast", disable=not self.progress) as pbar:
+            while not writer.is_complete() and advanced < writer.number_of_parts:
+                if time.monotonic() - last_keepalive >= self.multicast_keepalive:
+                    self.send_mcast(file_name)
+                    last_keepalive = time.monotonic()
+                try:
+                    response, _ = group_socket.recvfrom(self.receive_size)
+                    kind, flags, part_no, payload = unpack_datagram(response)
+                except socket.timeout:
+                    logger.error('The carousel went quiet, the missing parts are asked for by unicast')
+                    return
+                except MalformedDatagramException:
+                    self.stats['checksum_failures'] += 1
+                    logger.error('Corrupted part discarded, it will come again')
+                    continue
+                # Other carousels may share the group and port
+                if kind != TYPE_CAROUSEL_DATA or flags != carousel_id or not 1 <= part_no <= writer.number_of_parts:
+                    continue
+                if previous_part_no is not None:
+                    advanced += (part_no - previous_part_no) % writer.number_of_parts
+                previous_part_no = part_no
+                if writer.write_part(part_no, payload):
+                    self.stats['parts_multicast'] += 1
+                    pbar.update(1)
+
+    # NACKs for the parts the carousel did not deliver, a window at a time
+    def repair_parts(self, file_name: str, writer: Chunk_Writer):
+        logger.info(f'Asking for {writer.number_of_parts - writer.received_count} missing parts by unicast')
+        self.UDP_Client_Socket.settimeout(self.rtt.timeout())
+        while not writer.is_complete():
+            missing = []
+            for part_no in writer.missing_parts():
+                missing.append(part_no)
+                if len(missing) == self.transfer_window_size:
+                    break
+            self.send_range_request('NACK', file_name, missing)
+            self.stats['parts_retransmitted'] += len(missing)
+            # One answer per part asked for, whatever is still missing after them (or a
+            # timeout) is asked for again
+            for _ in missing:
+                try:
+                    kind, _, part_no, payload = self.receive_datagram()
+                    if kind == TYPE_DATA and writer.write_part(part_no, payload):
+                        self.stats['parts_unicast_repaired'] += 1
+                except ChecksumFailedException:
+                    logger.error('Corrupted part discarded, it will be requested again')
+                except socket.timeout:
+                    self.rtt.on_timeout()
+                    self.UDP_Client_Socket.settimeout(self.rtt.timeout())
+                    break
+                except Exception as error:
+                    logger.error(f'Error in multicast repair: {error}')
+                    self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
+                    return
+        self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
+
+    # Large datagrams fill the socket buffer with only a few parts, the window is
+    # capped by what the kernel accepts so a full window is not dropped on arrival
+    def size_receive_buffer(self):
+        wanted = self.window_size * self.transfer_datagram_size
+        try:
+            self.UDP_Client_Socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+        except OSError:
+            pass
+        # Linux reports twice the usable size
+        usable = self.UDP_Client_Socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+        self.transfer_window_size = max(1, min(self.window_size, usable // self.transfer_datagram_size))
+
+    def fetch_parts_sequential(self, file_name: str, writer: Chunk_Writer):
+        # part_no -> (time of the last request, whether it was retransmitted), a late answer
+        # to an earlier request is matched to that request and not to the last one
+        requested: dict[int, tuple[float, bool]] = {}
+        with tqdm(total=writer.number_of_parts, desc="Downloading", disable=not self.progress) as pbar:
+            while not writer.is_complete():
+                part_no = writer.first_missing()
+                retransmitted = part_no in requested
+                if retransmitted:
+                    self.stats['parts_retransmitted'] += 1
+                self.UDP_Client_Socket.settimeout(self.rtt.timeout())
+                try:
+                    self.send_cfetch(file_name, part_no)
+                    requested[part_no] = (time.monotonic(), retransmitted)
+                    received_part_no, file_content = self.receive_part()
+                    request = requested.pop(received_part_no, None)
+                    if writer.write_part(received_part_no, file_content):
+                        pbar.update(1)
+                        if request is not None:
+                            sent_at, request_retransmitted = request
+                            self.part_latencies.append(time.monotonic() - sent_at)
+                            if not request_retransmitted:
+                                self.rtt.sample(time.monotonic() - sent_at)
+                except ChecksumFailedException:
+                    logger.error(f'Corrupted Information, trying again for part {part_no}')
+                except TimeoutError:
+                    logger.error(f'Timeout: Server took too long to answer, trying again for part {part_no}')
+                    self.rtt.on_timeout()
+                except Exception as error:
+                    logger.error(f'Error in cfetch: {error}')
+                    error_args = error.args[0].split(':')
+                    if error_args[0] == 'code':
+                        if error_args[1] == '700':
+                            logger.error('Requesting more parts than existing')
+                        break
+        self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
+
+    # Selective repeat: keeps up to window_size CFETCH requests in flight, accepts
+    # parts in any order and retransmits only the ones that timed out. The number
+    # of requests in flight follows an AIMD congestion window and the timeout the
+    # RTT measured on requests that were not retransmitted
+    def fetch_parts_windowed(self, file_name: str, writer: Chunk_Writer):
+        # part_no -> (time of the last request, whether it was retransmitted)
+        in_flight: dict[int, tuple[float, bool]] = {}
+        next_to_request = 1
+        congestion_window = Congestion_Window(initial=min(4, self.transfer_window_size), maximum=self.transfer_window_size)
+        with tqdm(total=writer.number_of_parts, desc="Downloading", disable=not self.progress) as pbar:
+            while not writer.is_complete():
+                while len(in_flight) < congestion_window.window() and next_to_request <= writer.number_of_parts:
+                    self.send_cfetch(file_name, next_to_request)
+                    in_flight[next_to_request] = (time.monotonic(), False)
+                    next_to_request += 1
+                timeout = self.rtt.timeout()
+                oldest_request = min(sent_at for sent_at, _ in in_flight.values())
+                self.UDP_Client_Socket.settimeout(max(oldest_request + timeout - time.monotonic(), 0.001))
+                try:
+                    part_no, file_content = self.receive_part()
+                    request = in_flight.pop(part_no, None)
+                    if request is not None:
+                        sent_at, retransmitted = request
+                        self.part_latencies.append(time.monotonic() - sent_at)
+                        if not retransmitted:
+                            self.rtt.sample(time.monotonic() - sent_at)
+                        congestion_window.on_ack()
+                    if writer.write_part(part_no, file_content):
+                        pbar.update(1)
+                except ChecksumFailedException:
+                    logger.error('Corrupted part discarded, it will be requested again')
+                except socket.timeout:
+                    pass
+                except Exception as error:
+                    logger.error(f'Error in windowed fetch: {error}')
+                    break
+                now = time.monotonic()
+                expired = [part_no for part_no, (sent_at, _) in in_flight.items() if now - sent_at >= timeout]
+                if expired and congestion_window.on_loss(now, self.rtt.srtt or timeout):
+                    self.rtt.on_timeout()
+                self.stats['parts_retransmitted'] += len(expired)
+                for part_no in expired:
+                    self.send_cfetch(file_name, part_no)
+                    in_flight[part_no] = (now, True)
+        self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
+
+    # Range bursts: each RFETCH asks for up to burst_size contiguous parts which the server
+    # streams back to back, the window counts parts instead of requests. A part is given up
+    # as lost when parts requested after it keep arriving (the server answers in order) or
+    # when nothing arrives for a whole timeout, then it's asked again in a NACK listing only
+    # the missing part numbers. With FEC the parts of a block are only given up after the
+    # parities of the block had the chance to arrive and rebuild them
+    def fetch_parts_burst(self, file_name: str, writer: Chunk_Writer):
+        # part_no -> (request sequence number, sequence after which it is lost, time of the request),
+        # in request order
+        outstanding: dict[int, tuple[int, int, float]] = {}
+        # First part of each range, its arrival gives an RTT sample
+        range_heads: dict[int, float] = {}
+        next_to_request = 1
+        sequence = 0
+        highest_sequence_received = -1
+        last_arrival = time.monotonic()
+        congestion_window = Congestion_Window(initial=min(16, self.transfer_window_size), maximum=self.transfer_window_size)
+        decoder = FEC_Decoder(writer, *self.fec) if self.fec else None
+        options = f':fec={self.fec[0]}/{self.fec[1]}' if self.fec else ''
+        options += self.compression_option()
+        # First part of a block -> sequence number of its first parity
+        parity_sequences: dict[int, int] = {}
+        # First part of a block -> its parts requested so far, kept until its parity arrives
+        # (or the block is complete) since a block may start in one burst and end in the next
+        open_blocks: dict[int, list[int]] = {}
+        stats_before = self.stats.copy()
+        with tqdm(total=writer.number_of_parts, desc="Downloading", disable=not self.progress) as pbar:
+            while not writer.is_complete():
+                window = congestion_window.window()
+                # Waits for room for a whole burst (or half the window) instead of asking one part at a time
+                min_request = min(self.burst_size, max(1, window // 2))
+                while window - len(outstanding) >= min_request and next_to_request <= writer.number_of_parts:
+                    count = min(self.burst_size, window - len(outstanding))
+                    part_nos = range(next_to_request, min(next_to_request + count, writer.number_of_parts + 1))
+                    self.send_range_request('RFETCH', file_name, part_nos, options)
+                    now = time.monotonic()
+                    for part_no in part_nos:
+                        if decoder is None:
+                            outstanding[part_no] = (sequence, sequence, now)
+                            sequence += 1
+                            continue
+                        # Not given up as lost before the parity of its block is expected
+                        outstanding[part_no] = (sequence, sys.maxsize, now)
+                        sequence += 1
+                        block_first = block_first_part(part_no, decoder.block_size)
+                        open_blocks.setdefault(block_first, []).append(part_no)
+                        if part_no % decoder.block_size == 0 or part_no == writer.number_of_parts:
+                            parity_sequences[block_first] = sequence
+                            sequence += decoder.parities
+                            for block_part_no in open_blocks[block_first]:
+                                if block_part_no in outstanding:
+                                    request_sequence, _, sent_at = outstanding[block_part_no]
+                                    outstanding[block_part_no] = (request_sequence, sequence - 1, sent_at)
+                    range_heads[next_to_request] = now
+                    next_to_request = part_nos[-1] + 1
+                timeout = self.rtt.timeout()
+                oldest_request = next(iter(outstanding.values()))[2]
+                deadline = max(oldest_request, last_arrival) + timeout
+                self.UDP_Client_Socket.settimeout(max(deadline - time.monotonic(), 0.001))
+                lost = []
+                try:
+                    kind, flags, part_no, payload = self.receive_datagram()
+                    last_arrival = time.monotonic()
+                    if kind == TYPE_DATA:
+                        request = outstanding.pop(part_no, None)
+                        if request is not None:
+                            highest_sequence_received = max(highest_sequence_received, request[0])
+                            self.part_latencies.append(last_arrival - request[2])
+                            head_sent_at = range_heads.pop(part_no, None)
+                            if head_sent_at is not None:
+                                self.rtt.sample(last_arrival - head_sent_at)
+                            congestion_window.on_ack()
+                        if writer.write_part(part_no, payload):
+                            pbar.update(1)
+                        if decoder is not None:
+                            block_first = block_first_part(part_no, decoder.block_size)
+                            if block_first in open_blocks and decoder.block_complete(block_first):
+                                del open_blocks[block_first]
+                    elif kind == TYPE_PARITY and decoder is not None:
+                        open_blocks.pop(part_no, None)
+                        if part_no in parity_sequences:
+                            highest_sequence_received = max(highest_sequence_received, parity_sequences[part_no] + flags)
+                        for repaired_part_no in decoder.add_parity(part_no, flags, payload):
+                            outstanding.pop(repaired_part_no, None)
+                            range_heads.pop(repaired_part_no, None)
+                            self.stats['parts_repaired'] += 1
+                            pbar.update(1)
+                    for part_no, (_, loss_sequence, _) in outstanding.items():
+                        if loss_sequence >= highest_sequence_received - self.reorder_threshold:
+                            break
+                        lost.append(part_no)
+                except ChecksumFailedException:
+                    logger.error('Corrupted part discarded, it will be requested again')
+                except socket.timeout:
+                    now = time.monotonic()
+                    lost = [part_no for part_no, (_, _, sent_at) in outstanding.items() if now - sent_at >= timeout]
+                    if lost:
+                        self.rtt.on_timeout()
+                except Exception as error:
+                    logger.error(f'Error in burst fetch: {error}')
+                    break
+                if not lost:
+                    continue
+                now = time.monotonic()
+                congestion_window.on_loss(now, self.rtt.srtt or timeout)
+                lost.sort()
+                self.send_range_request('NACK', file_name, lost, self.compression_option())
+                self.stats['parts_retransmitted'] += len(lost)
+                for part_no in lost:
+                    del outstanding[part_no]
+                    outstanding[part_no] = (sequence, sequence, now)
+                    sequence += 1
+                    range_heads.pop(part_no, None)
+        self.UDP_Client_Socket.settimeout(self.retransmit_timeout)
+        if decoder is not None:
+            transfer_stats = self.stats - stats_before
+            logger.info(f'FEC repaired {transfer_stats["parts_repaired"]} parts, {transfer_stats["parts_retransmitted"]} were asked again')
+
+    # Splits the ranges in as many requests as needed to fit the server request buffer,
+    # each one with at most MAX_RANGE_PARTS parts (the server ignores the rest)
+    def send_range_request(self, kind: str, file_name: str, part_nos, options=''):
+        prefix = f'{kind}:{file_name}:'
+        suffix = f':{PROTOCOL_VERSION}:{self.transfer_datagram_size}{options}'
+        max_spec_size = self.buffer_size - len(f'{prefix}{suffix}'.encode('utf-8'))
+        part_nos = list(part_nos)
+        for start in range(0, len(part_nos), MAX_RANGE_PARTS):
+            spec = format_part_ranges(part_nos[start:start + MAX_RANGE_PARTS])
+            while spec:
+                if len(spec) <= max_spec_size:
+                    chunk, spec = spec, ''
+                else:
+                    cut = spec.rindex(',', 0, max_spec_size + 1)
+                    chunk, spec = spec[:cut], spec[cut + 1:]
+                self.UDP_Client_Socket.sendto(f'{prefix}{chunk}{suffix}'.encode('utf-8'), (self.ip, self.port))
+
+    # The server keeps no state between requests, each one says how the parts are compressed
+    def compression_option(self) -> str:
+        if self.transfer_compression is None:
+            return ''
+        return f':compress={format_compression(*self.transfer_compression)}'
+
+    def send_cfetch(self, file_name: str, part_no: int):
+        if self.protocol_version == PROTOCOL_VERSION:
+            request = f'CFETCH:{file_name}:{part_no}:{PROTOCOL_VERSION}:{self.transfer_datagram_size}{self.compression_option()}'
         else:
-            existing_parts = 0
-            with open(f'client_data/{file_name}', 'rb') as file:
-                file_bytes = file.read()
-                existing_parts = math.ceil(len(file_bytes)/self.content_size)
-                part_no_received = deformat_part_no(res_args[0])
-                if part_no_received != existing_parts + 1:
-                    logger.error('part_no_received != existing_parts + 1')
-                    logger.error(f'{part_no_received}')
-                    logger.error(f'{existing_parts} + 1')
-                    raise Exception(f'need:{existing_parts + 1}')
-            with open(f'client_data/{file_name}', 'ab') as file:
-                file.write(file_content)
-        
+            request = f'CFETCH:{file_name}:{part_no}'
+        self.UDP_Client_Socket.sendto(request.encode('utf-8'), (self.ip, self.port))
+
+    def receive_part(self) -> tuple[int, bytes | memoryview]:
+        if self.protocol_version == PROTOCOL_VERSION:
+            return self.receive_binary_part()
+        return self.receive_text_part()
+
+    def receive_datagram(self) -> tuple[int, int, int, memoryview]:
+        response, _ = self.UDP_Client_Socket.recvfrom(self.receive_size)
+        try:
+            kind, flags, part_no, payload = unpack_datagram(response)
+        except MalformedDatagramException as error:
+            self.stats['checksum_failures'] += 1
+            raise ChecksumFailedException(str(error))
+        if kind == TYPE_ERROR:
+            raise Exception(f'code:{ERROR_PAYLOAD.unpack_from(payload)[0]}')
+        # The flags of a DATA datagram are the codec of a compressed part
+        if kind == TYPE_DATA and flags:
+            try:
+                payload = decompress_part(payload, flags, content_size_for(self.transfer_datagram_size))
+            except Exception as error:
+                raise ChecksumFailedException(f'could not decompress part {part_no}: {error}')
+            self.stats['parts_decompressed'] += 1
+        return kind, flags, part_no, payload
+
+    def receive_binary_part(self) -> tuple[int, memoryview]:
+        kind, _, part_no, payload = self.receive_datagram()
+        if kind != TYPE_DATA:
+            raise ChecksumFailedException('unexpected datagram type')
+        return part_no, payload
+
+    # Part response: file_content + : + 8 bytes part_no + : + checksum
+    def receive_text_part(self) -> tuple[int, bytes]:
+        response, _ = self.UDP_Client_Socket.recvfrom(self.buffer_size)
+        if not self.verify_checksum(response[-64:], response[:-65]):
+            raise ChecksumFailedException('checksum_failed')
+        part_no = response[-73:-65]
+        if response[-74:-73] != b':' or not part_no.isdigit():
+            res_args = response[:-65].decode('utf-8').split(':')
+            raise Exception(f'code:{res_args[1]}')
+        return deformat_part_no(part_no.decode('utf-8')), response[:-74]
+
     def receive_response(self, has_file=False):
         response, server_address = self.UDP_Client_Socket.recvfrom(self.buffer_size)
         # logger.info(f'Received response from {server_address}')
@@ -136,7 +610,7 @@ class UDP_Client:
         
     def verify_checksum(self, received_checksum: str | bytes, message: bytes) -> bool:
         if type(received_checksum) == bytes:
-            received_checksum = received_checksum.decode('utf-8')
+            received_checksum = received_checksum.decode('utf-8', errors='replace')
         calculated_checksum = calculate_checksum(message)
         return calculated_checksum == received_checksum
     
@@ -1,12 +1,38 @@
-import math
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import signal
 import sys
 import socket
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger  
 from utils import calculate_checksum, format_part_no, deformat_part_no
+from utils import (PROTOCOL_VERSION, MAX_DATAGRAM_SIZE, MIN_DATAGRAM_SIZE, TYPE_FOUND, TYPE_DATA, TYPE_ERROR,
+                   FOUND_PAYLOAD, ERROR_PAYLOAD, TYPE_PARITY, TYPE_CAROUSEL, CAROUSEL_PAYLOAD, TYPE_STATS, pack_header,
+                   content_size_for, parse_part_ranges, MAX_RANGE_PARTS, parse_request_options, parse_fec_option)
+from fec import xor_parities, block_first_part
+from compression import parse_compression
+from carousel import Carousel
+from metrics import Metrics, Log_Sampler
+from file_catalog import File_Catalog
+from flow_control import Client_Pacers
 import random
 
 class UDP_Server:
-    def __init__(self, ip='127.0.0.1', port=4567, buffer_size=1024) -> None:
+    def __init__(self, ip='127.0.0.1', port=4567, buffer_size=1024, max_datagram_size=MAX_DATAGRAM_SIZE,
+                 should_corrupt=None, reuse_port=False, catalog=None, auto_start=True,
+                 pacing_rate=None, pacing_burst=256 * 1024, max_burst_parts=MAX_RANGE_PARTS,
+                 corruption_rate=0.02, loss_rate=0.0, seed=None, multicast_group='239.255.0.1',
+                 multicast_port=4600, multicast_rate=16 * 1024 * 1024, multicast_member_timeout=10.0,
+                 log_every=100, stats_file=None, stats_interval=10.0) -> None:
         self.ip = ip
         logger.info(f'Using {self.ip}')
         self.port = port
@@ -16,101 +42,594 @@ class UDP_Server:
         self.separators_size = 2
         # Calculated supposing the worst case scenario: tranfering files
         self.content_size = buffer_size - (self.checksum_size + self.packet_no_size + self.separators_size)
+        # Upper bound for the datagram size negotiated by binary protocol clients
+        self.max_datagram_size = min(max_datagram_size, MAX_DATAGRAM_SIZE)
+        # Upper bound for the number of parts answered to a single RFETCH or NACK
+        self.max_burst_parts = max_burst_parts
+        self.catalog = catalog or File_Catalog('server_data', self.content_size)
+        # Counters and latency histograms, answered to STATS and dumped every
+        # stats_interval seconds to stats_file (JSON lines) when there is one
+        self.stats = Metrics()
+        if stats_file:
+            self.stats.start_dumping(stats_file, stats_interval)
+        # The logs of each request are DEBUG and only one request in log_every is logged
+        self.log_sampler = Log_Sampler(log_every)
+        # Optional rate limit (bytes per second) for what is sent to each client
+        self.pacers = Client_Pacers(pacing_rate, pacing_burst) if pacing_rate else None
+        # Paced datagrams wait here as (due time, sequence, address, datagram) and are sent
+        # by the receive loop between requests, so a paced client doesn't hold up the others
+        self.paced_sends: list[tuple[float, int, tuple, list]] = []
+        self.paced_sequence = itertools.count()
         self.UDP_Server_Socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        if reuse_port:
+            # Several processes bind the same port and the kernel spreads the clients between them
+            self.UDP_Server_Socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.UDP_Server_Socket.bind((self.ip, self.port))
         self.UDP_Server_Socket.settimeout(2.0)
-        self.should_corrupt = False
-        should_corrupt_input = input("Should some packets be corrupted? (y/n) ")
-        if should_corrupt_input == 'y':
-            self.should_corrupt = True
+        if should_corrupt is None:
+            should_corrupt = input("Should some packets be corrupted? (y/n) ") == 'y'
+        self.should_corrupt = should_corrupt
+        # Fraction of the datagrams corrupted (when should_corrupt) or silently dropped,
+        # a seed makes the injected faults repeatable
+        self.corruption_rate = corruption_rate
+        self.loss_rate = loss_rate
+        self.random = random.Random(seed)
+        # Files asked for with MCAST are multicast to multicast_group, each one on its own
+        # port from multicast_port on, at multicast_rate bytes per second
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.multicast_rate = multicast_rate
+        self.multicast_member_timeout = multicast_member_timeout
+        self.carousels: dict[str, Carousel] = {}
+        self.carousels_lock = threading.Lock()
         logger.success(f"UDP server started on {self.ip}:{self.port}")
-        self.start()
+        if auto_start:
+            self.start()
 
     def start(self):
         while True:
             try:
+                self.send_due()
                 message, address = self.UDP_Server_Socket.recvfrom(self.buffer_size)
-                logger.info(f'Received the following from {address}:{message}')
-                decoded_message = message.decode('utf-8')
-                req_args = decoded_message.split(':')
-                if req_args[0] == 'FETCH':
-                    self.handle_fetch_request(address, req_args)
-                elif req_args[0] == 'CFETCH':
-                    self.handle_continue_fetch_request(address, req_args)
+                self.stats.add('requests')
+                started = time.perf_counter()
+                datagrams = self.handle_request(message, address)
+                self.stats.observe('handle_s', time.perf_counter() - started)
+                send_seconds = 0.0
+                for datagram in datagrams:
+                    delay = self.pacing_delay(address, datagram)
+                    if delay:
+                        heapq.heappush(self.paced_sends, (time.monotonic() + delay, next(self.paced_sequence), address, datagram))
+                        continue
+                    started = time.perf_counter()
+                    self.respond(address, datagram)
+                    send_seconds += time.perf_counter() - started
+                if datagrams:
+                    self.stats.observe('send_s', send_seconds)
             except socket.timeout:
                 continue  
             except KeyboardInterrupt:
                 break 
+
+    # Sends the paced datagrams that are due, the next receive waits at most until the following one
+    def send_due(self) -> None:
+        now = time.monotonic()
+        while self.paced_sends and self.paced_sends[0][0] <= now:
+            _, _, address, datagram = heapq.heappop(self.paced_sends)
+            started = time.perf_counter()
+            self.respond(address, datagram)
+            self.stats.observe('paced_send_s', time.perf_counter() - started)
+        timeout = max(self.paced_sends[0][0] - now, 0.0005) if self.paced_sends else 2.0
+        self.UDP_Server_Socket.settimeout(min(timeout, 2.0))
+
+    # Returns the datagrams (each one a list of buffers) to be sent back to address.
+    # handle_s (in the stats) is the time taken here, reading the parts and packing
+    # them; the parts of mapped files are only read from the page cache when sent, in send_s
+    def handle_request(self, message: bytes, address) -> list[list]:
+        try:
+            decoded_message = message.decode('utf-8')
+            req_args = decoded_message.split(':')
+            if req_args[0] == 'FETCH':
+                return [self.handle_fetch_request(address, req_args)]
+            elif req_args[0] == 'CFETCH':
+                return [self.handle_continue_fetch_request(address, req_args)]
+            elif req_args[0] in ('RFETCH', 'NACK'):
+                return self.handle_range_request(address, req_args)
+            elif req_args[0] == 'MCAST':
+                return [self.handle_multicast_request(address, req_args)]
+            elif req_args[0] == 'LEAVE':
+                self.leave_carousel(address, req_args[1])
+            elif req_args[0] == 'STATS':
+                return [self.handle_stats_request()]
+        except (ValueError, IndexError) as error:
+            self.stats.add('requests_malformed')
+            logger.error(f'Malformed request from {address}: {error}')
+        return []
+
+    # Formatted only for the requests that are logged
+    def log_request(self, message: str, *args) -> None:
+        if self.log_sampler():
+            logger.debug(message, *args)
+
+    # STATS: the counters and histograms of this process as JSON
+    def handle_stats_request(self) -> list:
+        return self.binary_datagram(TYPE_STATS, 0, json.dumps(self.stats.snapshot()).encode('utf-8'))
     
-    # Fetch file: FETCH:filename
-    def handle_fetch_request(self, address, req_args: list[str]):
+    # Fetch file: FETCH:filename or FETCH:filename:2:datagram_size for the binary protocol
+    def handle_fetch_request(self, address, req_args: list[str]) -> list:
         file_name = req_args[1]
-        logger.info(f'Identified a FETCH request to {file_name}')
+        if len(req_args) >= 4 and req_args[2] == str(PROTOCOL_VERSION):
+            return self.handle_binary_fetch_request(address, file_name, int(req_args[3]), parse_request_options(req_args[4:]))
+        self.log_request('Identified a FETCH request to {}', file_name)
         try:
-            with open(f'server_data/{file_name}', 'rb') as file:
-                file_bytes = file.read()
-                max_parts_no = math.ceil(len(file_bytes)/self.content_size)
-                response_message = f'FOUND:100:parts:{format_part_no(max_parts_no)}'
-                response = response_message
+            max_parts_no = self.catalog.get(file_name).max_parts_no
+            response = f'FOUND:100:parts:{format_part_no(max_parts_no)}'
         except FileNotFoundError:
             logger.error("Error:FileNotFoundError")
             response = f'ERROR:701:File {file_name} was not found.'
         except Exception as error:
             logger.error(f'Error in CFETCH (address:{address}) (req_args:{req_args}): {error}')
             response = f'ERROR:702:Unknown error.'
-        finally:
-            self.respond(address, response)    
+        return self.text_datagram(response)
 
-    # Continue fetching file: CFETCH:filename:part
-    def handle_continue_fetch_request(self, address, req_args: list[str]):
+    # Continue fetching file: CFETCH:filename:part or CFETCH:filename:part:2:datagram_size
+    def handle_continue_fetch_request(self, address, req_args: list[str]) -> list:
         file_name = req_args[1]
         file_part_no = int(req_args[2])
-        logger.info(f'Identified a CFETCH request to {file_name}, part:{file_part_no}')
+        if len(req_args) >= 5 and req_args[3] == str(PROTOCOL_VERSION):
+            return self.handle_binary_continue_fetch_request(address, file_name, file_part_no, int(req_args[4]),
+                                                             parse_request_options(req_args[5:]))
+        self.log_request('Identified a CFETCH request to {}, part:{}', file_name, file_part_no)
         try:
-            with open(f'server_data/{file_name}', 'rb') as file:
-                file_bytes = file.read()
-                max_parts_no = math.ceil(len(file_bytes)/self.content_size)
-                if file_part_no > max_parts_no:
-                    response = f'ERROR:700:File part number exceeded maximum.'
-                else:
-                    start_index = self.content_size * (file_part_no - 1)
-                    end_index = start_index + self.content_size
-                    response_content = file_bytes[start_index:end_index]
-                    response = response_content + f':{format_part_no(file_part_no)}'.encode('utf-8')
+            entry = self.catalog.get(file_name)
+            if file_part_no > entry.max_parts_no:
+                return self.text_datagram(f'ERROR:700:File part number exceeded maximum.')
+            return self.text_datagram(entry.part(file_part_no), f':{format_part_no(file_part_no)}')
         except FileNotFoundError:
             logger.error("Error:FileNotFoundError")
-            response = f'ERROR:701:File {file_name} was not found.'
+            return self.text_datagram(f'ERROR:701:File {file_name} was not found.')
         except Exception as error:
             logger.error(f'Error in CFETCH (address:{address}) (req_args:{req_args}): {error}')
-            response = f'ERROR:702:Unknown error.'
-        finally:
-            self.respond(address, response)
+            return self.text_datagram(f'ERROR:702:Unknown error.')
     
-    def respond(self, address, message: str | bytes) -> None:
-        logger.info(f'Responding to {address}')
-        checksum = calculate_checksum(message)
-        if type(message) == str:
-            message = message.encode('utf-8')
-        response = message + f':{checksum}'.encode('utf-8')
-        if self.should_corrupt:
-            num_of_random_changes = random.randint(0 ,100)
-            if num_of_random_changes < 3:
-                response = self.modify_bytes(response, num_of_random_changes)
-        self.UDP_Server_Socket.sendto(response, address)
+    def negotiate_datagram_size(self, requested_size: int) -> int:
+        return max(MIN_DATAGRAM_SIZE, min(requested_size, self.max_datagram_size))
+
+    # With the compress=codec/level option the flags of FOUND carry the codec the parts
+    # will be compressed with, 0 when the server doesn't know it
+    def handle_binary_fetch_request(self, address, file_name: str, datagram_size: int, options=None) -> list:
+        datagram_size = self.negotiate_datagram_size(datagram_size)
+        compression = self.requested_compression(options or {})
+        self.log_request('Identified a binary FETCH request to {}, datagram size:{}', file_name, datagram_size)
+        try:
+            entry = self.catalog.get(file_name)
+            max_parts_no = entry.parts_no(content_size_for(datagram_size))
+            payload = FOUND_PAYLOAD.pack(max_parts_no, datagram_size, entry.size)
+            return self.binary_datagram(TYPE_FOUND, 0, payload, flags=compression[0] if compression else 0)
+        except FileNotFoundError:
+            logger.error("Error:FileNotFoundError")
+            return self.binary_error(701, f'File {file_name} was not found.')
+        except Exception as error:
+            logger.error(f'Error in FETCH (address:{address}) (file:{file_name}): {error}')
+            return self.binary_error(702, 'Unknown error.')
+
+    def handle_binary_continue_fetch_request(self, address, file_name: str, file_part_no: int, datagram_size: int,
+                                             options=None) -> list:
+        content_size = content_size_for(self.negotiate_datagram_size(datagram_size))
+        compression = self.requested_compression(options or {})
+        try:
+            entry = self.catalog.get(file_name)
+            if file_part_no < 1 or file_part_no > entry.parts_no(content_size):
+                return self.binary_error(700, 'File part number exceeded maximum.')
+            return self.data_datagram(entry, file_part_no, content_size, compression)
+        except FileNotFoundError:
+            logger.error("Error:FileNotFoundError")
+            return self.binary_error(701, f'File {file_name} was not found.')
+        except Exception as error:
+            logger.error(f'Error in CFETCH (address:{address}) (file:{file_name}): {error}')
+            return self.binary_error(702, 'Unknown error.')
+
+    # Range burst: RFETCH:filename:first-last:2:datagram_size streams all the parts of the range
+    # back to back and NACK:filename:3,5-7:2:datagram_size sends again the listed missing parts.
+    # With the fec=K/R option RFETCH also sends R parities after the last part of each block of K parts
+    def handle_range_request(self, address, req_args: list[str]) -> list[list]:
+        file_name = req_args[1]
+        if req_args[3] != str(PROTOCOL_VERSION):
+            raise ValueError(f'{req_args[0]} needs protocol version {PROTOCOL_VERSION}')
+        content_size = content_size_for(self.negotiate_datagram_size(int(req_args[4])))
+        part_nos = parse_part_ranges(req_args[2], self.max_burst_parts)
+        options = parse_request_options(req_args[5:])
+        fec = parse_fec_option(options['fec']) if 'fec' in options and req_args[0] == 'RFETCH' else None
+        compression = self.requested_compression(options)
+        if not part_nos:
+            logger.error(f'Empty part range in {req_args[0]} from {address}: {req_args[2]}')
+            return [self.binary_error(703, 'Empty part range.')]
+        self.log_request('Identified a {} request to {}, {} parts from {}', req_args[0], file_name, len(part_nos), part_nos[0])
+        if req_args[0] == 'NACK':
+            self.stats.add('parts_retransmitted', len(part_nos))
+        try:
+            entry = self.catalog.get(file_name)
+            max_parts_no = entry.parts_no(content_size)
+            datagrams = []
+            exceeded = False
+            for part_no in part_nos:
+                if not 1 <= part_no <= max_parts_no:
+                    exceeded = True
+                    continue
+                datagrams.append(self.data_datagram(entry, part_no, content_size, compression))
+                if fec is not None and (part_no % fec[0] == 0 or part_no == max_parts_no):
+                    datagrams.extend(self.parity_datagrams(entry, part_no, content_size, *fec))
+            if exceeded:
+                datagrams.append(self.binary_error(700, 'File part number exceeded maximum.'))
+            return datagrams
+        except FileNotFoundError:
+            logger.error("Error:FileNotFoundError")
+            return [self.binary_error(701, f'File {file_name} was not found.')]
+        except Exception as error:
+            logger.error(f'Error in {req_args[0]} (address:{address}) (file:{file_name}): {error}')
+            return [self.binary_error(702, 'Unknown error.')]
+
+    def requested_compression(self, options: dict[str, str]) -> tuple[int, int] | None:
+        return parse_compression(options['compress']) if 'compress' in options else None
+
+    # A part compresses once per file, codec and level (see Catalog_Entry.compressed_part),
+    # the ones that don't compress go as they are with flags 0. The parities are always
+    # computed over the uncompressed parts
+    def data_datagram(self, entry, part_no: int, content_size: int, compression: tuple[int, int] | None) -> list:
+        if compression is not None:
+            compressed = entry.compressed_part(part_no, content_size, *compression)
+            if compressed is not None:
+                self.stats.add('parts_compressed')
+                return self.binary_datagram(TYPE_DATA, part_no, compressed, flags=compression[0])
+        return self.binary_datagram(TYPE_DATA, part_no, entry.part(part_no, content_size))
+
+    # Multicast carousel: MCAST:filename:2:datagram_size joins the carousel of the file,
+    # started by the first client with the datagram size it negotiates, and is answered
+    # with CAROUSEL: where the parts are being sent. Clients send it again to stay and
+    # LEAVE:filename once they have the file
+    def handle_multicast_request(self, address, req_args: list[str]) -> list:
+        file_name = req_args[1]
+        if req_args[2] != str(PROTOCOL_VERSION):
+            raise ValueError(f'MCAST needs protocol version {PROTOCOL_VERSION}')
+        logger.info(f'Identified a MCAST request to {file_name}')
+        try:
+            carousel = self.join_carousel(address, file_name, self.negotiate_datagram_size(int(req_args[3])))
+            payload = CAROUSEL_PAYLOAD.pack(carousel.number_of_parts, carousel.datagram_size, carousel.entry.size,
+                                            socket.inet_aton(carousel.group), carousel.port,
+                                            carousel.carousel_id)
+            return self.binary_datagram(TYPE_CAROUSEL, 0, payload)
+        except FileNotFoundError:
+            logger.error("Error:FileNotFoundError")
+            return self.binary_error(701, f'File {file_name} was not found.')
+        except Exception as error:
+            logger.error(f'Error in MCAST (address:{address}) (file:{file_name}): {error}')
+            return self.binary_error(702, 'Unknown error.')
+
+    def join_carousel(self, address, file_name: str, datagram_size: int) -> Carousel:
+        entry = self.catalog.get(file_name)
+        with self.carousels_lock:
+            carousel = self.carousels.get(file_name)
+            if carousel is not None and carousel.join(address):
+                return carousel
+            # A carousel that just stopped keeps its port until it's gone
+            used_ports = {carousel.port for carousel in self.carousels.values()}
+            port = next(port for port in itertools.count(self.multicast_port) if port not in used_ports)
+            interface = self.ip if self.ip not in ('', '0.0.0.0') else None
+            carousel = Carousel(self, file_name, entry, datagram_size, self.multicast_group, port,
+                                self.multicast_rate, self.multicast_member_timeout, interface)
+            carousel.join(address)
+            self.carousels[file_name] = carousel
+        carousel.start()
+        return carousel
+
+    def leave_carousel(self, address, file_name: str) -> None:
+        with self.carousels_lock:
+            carousel = self.carousels.get(file_name)
+        if carousel is not None:
+            carousel.leave(address)
+
+    def carousel_stopped(self, carousel: Carousel) -> None:
+        with self.carousels_lock:
+            if self.carousels.get(carousel.file_name) is carousel:
+                del self.carousels[carousel.file_name]
+
+    def parity_datagrams(self, entry, block_last: int, content_size: int, block_size: int, parities: int) -> list[list]:
+        block_first = block_first_part(block_last, block_size)
+        parts = [entry.part(part_no, content_size) for part_no in range(block_first, block_last + 1)]
+        return [
+            self.binary_datagram(TYPE_PARITY, block_first, parity, flags=index)
+            for index, parity in enumerate(xor_parities(parts, parities, content_size))
+        ]
+
+    def binary_error(self, code: int, message: str) -> list:
+        return self.binary_datagram(TYPE_ERROR, 0, ERROR_PAYLOAD.pack(code) + message.encode('utf-8'))
+
+    def binary_datagram(self, kind: int, part_no: int, payload: bytes | memoryview, flags=0) -> list:
+        return [pack_header(kind, part_no, payload, flags), payload]
+
+    # The message may be split in several buffers (e.g. a memoryview of the file
+    # and its part number), they are only joined if the datagram gets corrupted
+    def text_datagram(self, *message: str | bytes | memoryview) -> list:
+        buffers = [part.encode('utf-8') if type(part) == str else part for part in message]
+        checksum = calculate_checksum(*buffers)
+        buffers.append(f':{checksum}'.encode('utf-8'))
+        return buffers
+
+    def corrupt_datagram(self, datagram: list) -> list:
+        if self.should_corrupt and self.random.random() < self.corruption_rate:
+            self.stats.add('datagrams_corrupted')
+            return [self.modify_bytes(b''.join(datagram), self.random.randint(1, 2))]
+        return datagram
+
+    def should_drop(self) -> bool:
+        if self.loss_rate and self.random.random() < self.loss_rate:
+            self.stats.add('datagrams_dropped')
+            return True
+        return False
+
+    def pacing_delay(self, address, datagram: list) -> float:
+        if self.pacers is None:
+            return 0.0
+        return self.pacers.delay_for(address, sum(len(buffer) for buffer in datagram))
+
+    def respond(self, address, datagram: list) -> None:
+        if self.should_drop():
+            return
+        self.stats.add('datagrams_sent')
+        self.stats.add('bytes_sent', self.UDP_Server_Socket.sendmsg(self.corrupt_datagram(datagram), [], 0, address))
         
     def modify_bytes(self, data: bytes, num_changes: int) -> bytes:
-        print(f'Modifying {num_changes} bytes')
+        logger.debug(f'Modifying {num_changes} bytes')
         modified_data = bytearray(data)
-        indices_to_change = random.sample(range(len(modified_data)), num_changes)
+        indices_to_change = self.random.sample(range(len(modified_data)), num_changes)
         for index in indices_to_change:
-            modified_data[index] = random.randint(0, 255)
-        print(f'are they the same? {bytes(modified_data) == data}')
+            modified_data[index] = self.random.randint(0, 255)
+        logger.debug(f'are they the same? {bytes(modified_data) == data}')
         return bytes(modified_data)
-        
+
+
+class Transfer_Session:
+    # Requests from one address for one file, waiting for their turn
+    def __init__(self, address, file_name: str, max_pending: int) -> None:
+        self.address = address
+        self.file_name = file_name
+        self.pending: deque[bytes] = deque(maxlen=max_pending)
+        self.scheduled = False
+        self.requests_served = 0
+        self.datagrams_sent = 0
+        self.last_activity = time.monotonic()
+
+
+class UDP_Server_Protocol(asyncio.DatagramProtocol):
+    def __init__(self, server: 'Async_UDP_Server') -> None:
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.server.enqueue_request(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.error(f'Socket error: {exc}')
+
+
+class Async_UDP_Server(UDP_Server):
+    # Requests are queued per (address, file) session and served round-robin by a
+    # few workers, the file reads happen in a thread pool so one slow read or a
+    # burst of requests from one client doesn't stall the others
+    def __init__(self, *args, concurrency=8, max_pending=1024, session_timeout=60.0, **kwargs) -> None:
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.session_timeout = session_timeout
+        self.sessions: dict[tuple, Transfer_Session] = {}
+        self.ready_sessions: deque[Transfer_Session] = deque()
+        super().__init__(*args, **kwargs)
+        self.stats.gauge('sessions', lambda: len(self.sessions))
+        self.stats.gauge('session_queue_depth', self.session_queue_depth)
+
+    # Requests waiting in the sessions, read from the thread answering STATS
+    def session_queue_depth(self) -> dict:
+        depths = [len(session.pending) for session in list(self.sessions.values())]
+        return {'max': max(depths, default=0), 'total': sum(depths)}
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.has_ready_sessions = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.UDP_Server_Socket.setblocking(False)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: UDP_Server_Protocol(self), sock=self.UDP_Server_Socket
+        )
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        try:
+            while True:
+                await asyncio.sleep(self.session_timeout)
+                self.expire_sessions()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.transport.close()
+            self.executor.shutdown(wait=False)
+
+    def enqueue_request(self, message: bytes, address) -> None:
+        req_args = message.split(b':', 2)
+        file_name = req_args[1].decode('utf-8', errors='replace') if len(req_args) > 1 else ''
+        session = self.sessions.get((address, file_name))
+        if session is None:
+            session = Transfer_Session(address, file_name, self.max_pending)
+            self.sessions[(address, file_name)] = session
+        if len(session.pending) == self.max_pending:
+            # The oldest request of the session is dropped to make room
+            self.stats.add('requests_dropped')
+        session.pending.append(message)
+        session.last_activity = time.monotonic()
+        if not session.scheduled:
+            session.scheduled = True
+            self.ready_sessions.append(session)
+            self.has_ready_sessions.set()
+
+    async def worker(self):
+        while True:
+            while not self.ready_sessions:
+                self.has_ready_sessions.clear()
+                await self.has_ready_sessions.wait()
+            session = self.ready_sessions.popleft()
+            message = session.pending.popleft()
+            self.stats.add('requests')
+            # One request per turn, the session goes back to the end of the line
+            if session.pending:
+                self.ready_sessions.append(session)
+            else:
+                session.scheduled = False
+            started = time.perf_counter()
+            datagrams = await self.loop.run_in_executor(self.executor, self.handle_request, message, session.address)
+            self.stats.observe('handle_s', time.perf_counter() - started)
+            send_seconds = 0.0
+            for datagram in datagrams:
+                # Paced datagrams are sent by the loop when due, the worker moves on to the next session
+                delay = self.pacing_delay(session.address, datagram)
+                if delay:
+                    self.loop.call_later(delay, self.send_paced, session.address, datagram)
+                    continue
+                started = time.perf_counter()
+                self.respond(session.address, datagram)
+                send_seconds += time.perf_counter() - started
+            if datagrams:
+                self.stats.observe('send_s', send_seconds)
+            session.requests_served += 1
+            session.datagrams_sent += len(datagrams)
+
+    def send_paced(self, address, datagram: list) -> None:
+        started = time.perf_counter()
+        self.respond(address, datagram)
+        self.stats.observe('paced_send_s', time.perf_counter() - started)
+
+    def expire_sessions(self):
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            if not session.scheduled and now - session.last_activity > self.session_timeout:
+                del self.sessions[key]
+
+    def respond(self, address, datagram: list) -> None:
+        if self.should_drop():
+            return
+        response = b''.join(self.corrupt_datagram(datagram))
+        self.stats.add('datagrams_sent')
+        self.stats.add('bytes_sent', len(response))
+        self.transport.sendto(response, address)
+
+
+def run_worker(worker_id: int, server_class, server_kwargs: dict, stats_queue, stats_interval: float):
+    # The worker stops on the first SIGINT or SIGTERM (from the parent or the terminal),
+    # even if the parent was started with SIGINT ignored
+    signal.signal(signal.SIGINT, interrupt_once)
+    signal.signal(signal.SIGTERM, interrupt_once)
+    server = server_class(**server_kwargs, reuse_port=True, auto_start=False)
+
+    def report_stats():
+        while True:
+            time.sleep(stats_interval)
+            stats_queue.put((worker_id, os.getpid(), server.stats.counters()))
+
+    threading.Thread(target=report_stats, daemon=True).start()
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    stats_queue.put((worker_id, os.getpid(), server.stats.counters()))
+
+
+# Forks the workers after loading the catalog so the mappings are shared with
+# them, every worker binds the same port with SO_REUSEPORT and reports its
+# stats to the parent, which logs the totals
+def run_workers(workers: int, server_class=UDP_Server, stats_interval=5.0, **server_kwargs):
+    context = multiprocessing.get_context('fork')
+    buffer_size = server_kwargs.get('buffer_size', 1024)
+    catalog = File_Catalog('server_data', buffer_size - (64 + 8 + 2))
+    for file_name in sorted(os.listdir('server_data')):
+        if os.path.isfile(os.path.join('server_data', file_name)):
+            catalog.get(file_name)
+    if server_kwargs.get('should_corrupt') is None:
+        server_kwargs['should_corrupt'] = input("Should some packets be corrupted? (y/n) ") == 'y'
+    server_kwargs['catalog'] = catalog
+    stats_queue = context.Queue()
+    processes = [
+        context.Process(target=run_worker, args=(worker_id, server_class, server_kwargs, stats_queue, stats_interval))
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, interrupt)
+    worker_stats: dict[int, dict] = {}
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                worker_id, pid, stats = stats_queue.get(timeout=stats_interval)
+            except queue.Empty:
+                continue
+            worker_stats[worker_id] = stats
+            log_worker_stats(worker_stats)
+    except KeyboardInterrupt:
+        # The workers stop on SIGINT like the single process server and report their final stats
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+    for process in processes:
+        process.join()
+    while not stats_queue.empty():
+        worker_id, pid, stats = stats_queue.get()
+        worker_stats[worker_id] = stats
+    log_worker_stats(worker_stats)
+    return worker_stats
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def interrupt_once(signum, frame):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def log_worker_stats(worker_stats: dict[int, dict]):
+    total = Counter()
+    for stats in worker_stats.values():
+        total.update(stats)
+    per_worker = ', '.join(f'{worker_id}:{stats.get("requests", 0)}' for worker_id, stats in sorted(worker_stats.items()))
+    logger.info(f"Workers stats: {dict(total)} (requests per worker {per_worker})")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1: 
-        server = UDP_Server(ip=sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ip', nargs='?', default='127.0.0.1')
+    parser.add_argument('--asyncio', action='store_true', help='serve many clients concurrently with asyncio')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('--pacing-rate', type=float, default=None, help='max bytes per second sent to each client')
+    parser.add_argument('--loss-rate', type=float, default=0.0, help='fraction of the datagrams dropped on purpose')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the injected corruption and loss')
+    parser.add_argument('--multicast-group', default='239.255.0.1', help='group the MCAST carousels send to')
+    parser.add_argument('--multicast-port', type=int, default=4600, help='port of the first carousel, the next ones count up')
+    parser.add_argument('--multicast-rate', type=float, default=16 * 1024 * 1024, help='bytes per second sent by each carousel')
+    parser.add_argument('--log-level', default='INFO', help='DEBUG also logs every request')
+    parser.add_argument('--log-every', type=int, default=100, help='only one request in this many is logged (DEBUG)')
+    parser.add_argument('--stats-file', default=None, help='appends the stats to this file as JSON lines')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='seconds between the stats written to --stats-file')
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    server_kwargs = {'ip': args.ip, 'pacing_rate': args.pacing_rate, 'loss_rate': args.loss_rate, 'seed': args.seed,
+                     'multicast_group': args.multicast_group, 'multicast_port': args.multicast_port,
+                     'multicast_rate': args.multicast_rate, 'log_every': args.log_every,
+                     'stats_file': args.stats_file, 'stats_interval': args.stats_interval}
+    if args.workers > 1:
+        run_workers(args.workers, Async_UDP_Server if args.asyncio else UDP_Server, **server_kwargs)
+    elif args.asyncio:
+        server = Async_UDP_Server(**server_kwargs)
     else:
-        server = UDP_Server()
\ No newline at end of file
+        server = UDP_Server(**server_kwargs)
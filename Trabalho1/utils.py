@@ -1,10 +1,13 @@
 import hashlib
+import struct
+import zlib
 
-def calculate_checksum(data: str | bytes) -> str: # len 64
-    if type(data) == str:
-        data = data.encode('utf-8')
+def calculate_checksum(*data: str | bytes | memoryview) -> str: # len 64
     hash_object = hashlib.sha256()
-    hash_object.update(data)
+    for buffer in data:
+        if type(buffer) == str:
+            buffer = buffer.encode('utf-8')
+        hash_object.update(buffer)
     checksum = hash_object.hexdigest()
     # print(f'data: {data}')
     # print(f'checksum calculated: {checksum}')
@@ -15,4 +18,105 @@ def format_part_no(num: int) -> str:
     
 
 def deformat_part_no(num: str) -> int:
-    return int(num)
\ No newline at end of file
+    return int(num)
+
+
+# Binary protocol (version 2): every datagram starts with
+# version | type | flags | part_no | payload length | crc32 of the header and payload
+PROTOCOL_VERSION = 2
+DATAGRAM_HEADER = struct.Struct('!BBHIHI')
+DATAGRAM_HEADER_SIZE = DATAGRAM_HEADER.size
+# Largest UDP payload over IPv4, what fits in a single loopback datagram
+MAX_DATAGRAM_SIZE = 65507
+# Ethernet MTU minus the IP and UDP headers, avoids IP fragmentation
+ETHERNET_DATAGRAM_SIZE = 1472
+MIN_DATAGRAM_SIZE = 64
+
+TYPE_FOUND = 1
+TYPE_DATA = 2
+TYPE_ERROR = 3
+# part_no is the first part of the block and flags the parity index
+TYPE_PARITY = 4
+# Answer to MCAST: where the parts of the file are multicast
+TYPE_CAROUSEL = 5
+# Answer to STATS: the server counters and histograms as utf-8 JSON
+TYPE_STATS = 6
+# A part sent by a carousel, flags is the id of the carousel: the processes of a server
+# (or different servers) may multicast other files to the same group and port
+TYPE_CAROUSEL_DATA = 7
+
+# FOUND payload: number of parts | negotiated datagram size | file size
+FOUND_PAYLOAD = struct.Struct('!IHQ')
+# ERROR payload: error code followed by the utf-8 message
+ERROR_PAYLOAD = struct.Struct('!H')
+# CAROUSEL payload: number of parts | datagram size | file size | group address | group port | carousel id
+CAROUSEL_PAYLOAD = struct.Struct('!IHQ4sHH')
+
+
+class MalformedDatagramException(Exception):
+    pass
+
+
+def pack_header(kind: int, part_no: int, payload: bytes | memoryview, flags=0) -> bytes:
+    header = DATAGRAM_HEADER.pack(PROTOCOL_VERSION, kind, flags, part_no, len(payload), 0)
+    crc = zlib.crc32(payload, zlib.crc32(header[:-4]))
+    return header[:-4] + crc.to_bytes(4, 'big')
+
+
+def unpack_datagram(datagram: bytes) -> tuple[int, int, int, memoryview]:
+    if len(datagram) < DATAGRAM_HEADER_SIZE:
+        raise MalformedDatagramException('datagram shorter than its header')
+    version, kind, flags, part_no, length, crc = DATAGRAM_HEADER.unpack_from(datagram)
+    payload = memoryview(datagram)[DATAGRAM_HEADER_SIZE:]
+    if version != PROTOCOL_VERSION or length != len(payload):
+        raise MalformedDatagramException('unexpected version or length')
+    if zlib.crc32(payload, zlib.crc32(memoryview(datagram)[:DATAGRAM_HEADER_SIZE - 4])) != crc:
+        raise MalformedDatagramException('crc32 mismatch')
+    return kind, flags, part_no, payload
+
+
+def content_size_for(datagram_size: int) -> int:
+    return datagram_size - DATAGRAM_HEADER_SIZE
+
+
+# Part ranges as sent in RFETCH and NACK requests: "1-256" or "3,5-7,10"
+def format_part_ranges(part_nos) -> str:
+    ranges = []
+    for part_no in part_nos:
+        if ranges and ranges[-1][1] == part_no - 1:
+            ranges[-1][1] = part_no
+        else:
+            ranges.append([part_no, part_no])
+    return ','.join(f'{first}-{last}' if first != last else str(first) for first, last in ranges)
+
+
+# Parts answered to a single RFETCH or NACK at most, the client splits longer requests
+MAX_RANGE_PARTS = 1024
+
+
+def parse_part_ranges(spec: str, max_parts: int) -> list[int]:
+    part_nos = []
+    for item in spec.split(','):
+        first, _, last = item.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        part_nos.extend(range(first, min(last, first + max_parts - len(part_nos) - 1) + 1))
+        if len(part_nos) >= max_parts:
+            break
+    return part_nos
+
+
+# Extra key=value arguments after the datagram size, e.g. RFETCH:file:1-256:2:1472:fec=16/2
+def parse_request_options(args: list[str]) -> dict[str, str]:
+    return dict(arg.split('=', 1) for arg in args if '=' in arg)
+
+
+# FEC blocks of 2 to 64 parts with 1 to 8 parities (never more than the block size)
+def clamp_fec(block_size: int, parities: int) -> tuple[int, int]:
+    block_size = max(2, min(block_size, 64))
+    return block_size, max(1, min(parities, 8, block_size))
+
+
+def parse_fec_option(value: str) -> tuple[int, int]:
+    block_size, _, parities = value.partition('/')
+    return clamp_fec(int(block_size), int(parities or 1))
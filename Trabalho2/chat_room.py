@@ -0,0 +1,318 @@
+import asyncio
+import itertools
+import socket
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+from framing import LENGTH_PREFIX
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+
+# Messages waiting to be written to one client. When a client doesn't keep up with
+# the chat and the queue is full the oldest message is dropped or the client is
+# disconnected, the sender never waits for it. File streams share the connection:
+# each one has a window of DATA bytes it may still send, granted by the client
+class Outbox(ABC):
+    def __init__(self, max_messages=256, policy=DROP_OLDEST, quantum=64 * 1024) -> None:
+        self.messages = deque()
+        self.max_messages = max_messages
+        self.policy = policy
+        self.closed = False
+        # Whether the pending messages are still written after close
+        self.flush = False
+        self.dropped = 0
+        # stream id -> [iterator of (buffers, DATA bytes), window], in round robin order
+        self.streams = OrderedDict()
+        # Bytes of stream messages written at most before the chat gets its turn again
+        self.quantum = quantum
+        # Transfers that write to the connection themselves (plain files and deltas), each
+        # one run by the writer once what was queued before it and every stream are sent
+        self.tasks = deque()
+
+    # Control messages (bounded=False) are never dropped
+    def put(self, frame: bytes, bounded=True) -> bool:
+        if self.closed:
+            return False
+        if bounded and len(self.messages) >= self.max_messages:
+            if self.policy == DISCONNECT:
+                self.disconnect()
+                return False
+            self.messages.popleft()
+            self.dropped += 1
+        self.messages.append(frame)
+        self.wake()
+        return True
+
+    def add_stream(self, stream_id: int, messages, window: int) -> None:
+        self.streams[stream_id] = [messages, window]
+        self.wake()
+
+    def update_window(self, stream_id: int, increment: int) -> None:
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            stream[1] += increment
+            self.wake()
+
+    def ready_stream(self):
+        return next((stream_id for stream_id, (_, window) in self.streams.items() if window > 0), None)
+
+    def put_task(self, task) -> bool:
+        if self.closed:
+            return False
+        self.tasks.append(task)
+        self.wake()
+        return True
+
+    def ready_task(self) -> bool:
+        return bool(self.tasks) and not self.messages and not self.streams
+
+    def has_work(self) -> bool:
+        return bool(self.messages) or self.ready_stream() is not None or self.ready_task()
+
+    def take_messages(self) -> list:
+        buffers = list(self.messages)
+        self.messages.clear()
+        return buffers
+
+    # Appends the message of the stream to buffers and sends the stream to the end of
+    # the round, or drops it when it has no message left. Returns the bytes appended
+    def add_message(self, stream_id: int, message, buffers: list) -> int:
+        stream = self.streams.pop(stream_id)
+        if message is None:
+            return 0
+        message_buffers, data_bytes = message
+        stream[1] -= data_bytes
+        self.streams[stream_id] = stream
+        buffers.extend(message_buffers)
+        return sum(len(buffer) for buffer in message_buffers)
+
+    def close(self, flush=False) -> None:
+        self.closed = True
+        self.flush = flush
+        self.wake()
+
+    # Lets the writer know there is something to send
+    @abstractmethod
+    def wake(self) -> None: ...
+
+    # Closes the connection of a client that doesn't keep up with the chat
+    @abstractmethod
+    def disconnect(self) -> None: ...
+
+
+# Written by its own thread, so one client with a full receive window only stalls itself
+class Chat_Outbox(Outbox):
+    def __init__(self, sock: socket.socket, max_messages=256, policy=DROP_OLDEST) -> None:
+        super().__init__(max_messages, policy)
+        self.sock = sock
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame: bytes, bounded=True) -> bool:
+        with self.condition:
+            return super().put(frame, bounded)
+
+    def add_stream(self, stream_id: int, messages, window: int) -> None:
+        with self.condition:
+            super().add_stream(stream_id, messages, window)
+
+    def update_window(self, stream_id: int, increment: int) -> None:
+        with self.condition:
+            super().update_window(stream_id, increment)
+
+    def put_task(self, task) -> bool:
+        with self.condition:
+            return super().put_task(task)
+
+    def close(self, flush=False) -> None:
+        with self.condition:
+            super().close(flush)
+
+    def wake(self) -> None:
+        self.condition.notify()
+
+    def disconnect(self) -> None:
+        with self.condition:
+            super().close()
+        try:
+            # Wakes up the thread reading from the client, which then leaves the room
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # All the pending chat lines at once, then the streams with window left take
+    # turns one message at a time, everything joined in a single write. The streams
+    # read, compress and hash the file without the lock, so put and update_window
+    # never wait for them
+    def next_batch(self) -> bytes:
+        with self.condition:
+            buffers = self.take_messages()
+        size = sum(len(buffer) for buffer in buffers)
+        while size < self.quantum:
+            with self.condition:
+                stream_id = self.ready_stream()
+                if stream_id is None:
+                    break
+                messages = self.streams[stream_id][0]
+            # Only this thread takes streams out, it's still there afterwards
+            message = next(messages, None)
+            with self.condition:
+                size += self.add_message(stream_id, message, buffers)
+        return b"".join(buffers)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.has_work() and not self.closed:
+                    self.condition.wait()
+                sending = not self.closed or self.flush
+            batch = self.next_batch() if sending else b""
+            with self.condition:
+                task = self.tasks.popleft() if sending and self.ready_task() else None
+                done = self.closed and not (self.flush and self.has_work())
+            try:
+                if batch:
+                    self.sock.sendall(batch)
+                if task is not None:
+                    task()
+            except OSError:
+                self.disconnect()
+                return
+            if done:
+                return
+
+    # Waits for the pending messages (and the streams that still have window) to be
+    # written before the socket is used for anything else
+    def finish(self) -> None:
+        self.close(flush=True)
+        self.thread.join()
+
+
+# Messages of a stream produced in a thread a batch ahead of the writer, so the event
+# loop never waits for the disk or the compression
+class Produced_Ahead:
+    def __init__(self, loop: asyncio.AbstractEventLoop, messages, batch: int) -> None:
+        self.loop = loop
+        self.messages = messages
+        self.batch = batch
+        self.produced = deque()
+        self.pending = None
+        self.exhausted = False
+
+    def produce(self) -> None:
+        if self.pending is None and not self.exhausted:
+            self.pending = self.loop.run_in_executor(None, lambda: list(itertools.islice(self.messages, self.batch)))
+
+    # The next message, None once there is none left
+    async def take(self):
+        if not self.produced:
+            self.produce()
+            if self.pending is None:
+                return None
+            batch = await self.pending
+            self.pending = None
+            self.exhausted = len(batch) < self.batch
+            self.produced.extend(batch)
+        message = self.produced.popleft() if self.produced else None
+        # The next batch is on its way while this one is written
+        if len(self.produced) < self.batch // 2:
+            self.produce()
+        return message
+
+
+# Written by its own task, waiting for the transport to drain before the next batch
+class Async_Chat_Outbox(Outbox):
+    # Stream messages produced by each trip to the thread
+    PREFETCH = 64
+
+    def __init__(self, writer: asyncio.StreamWriter, max_messages=256, policy=DROP_OLDEST) -> None:
+        super().__init__(max_messages, policy)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def add_stream(self, stream_id: int, messages, window: int) -> None:
+        super().add_stream(stream_id, Produced_Ahead(self.loop, messages, self.PREFETCH), window)
+
+    async def next_batch_async(self) -> bytes:
+        buffers = self.take_messages()
+        size = sum(len(buffer) for buffer in buffers)
+        while size < self.quantum:
+            stream_id = self.ready_stream()
+            if stream_id is None:
+                break
+            message = await self.streams[stream_id][0].take()
+            size += self.add_message(stream_id, message, buffers)
+        return b"".join(buffers)
+
+    def wake(self) -> None:
+        self.event.set()
+
+    def disconnect(self) -> None:
+        super().close()
+        self.writer.transport.abort()
+
+    async def run(self) -> None:
+        while True:
+            if not self.has_work() and not self.closed:
+                self.event.clear()
+                await self.event.wait()
+            closed = self.closed
+            if not closed or self.flush:
+                batch = await self.next_batch_async()
+                task = self.tasks.popleft() if self.ready_task() else None
+                if batch or task is not None:
+                    self.writer.write(batch)
+                    try:
+                        await self.writer.drain()
+                        if task is not None:
+                            await task()
+                    except OSError:
+                        self.disconnect()
+                        return
+                    # Lets the connection read window updates and chat between batches
+                    await asyncio.sleep(0)
+            if closed and not (self.flush and self.has_work()):
+                return
+
+    async def finish(self) -> None:
+        self.close(flush=True)
+        await self.task
+
+
+# Members are kept in an immutable snapshot replaced on join and leave, so a broadcast
+# only frames the message once and appends the same bytes to every outbox
+class Chat_Room:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.members = {}
+        self.snapshot = ()
+
+    def join(self, key, outbox: Outbox) -> None:
+        with self.lock:
+            self.members[key] = outbox
+            self.snapshot = tuple(self.members.items())
+
+    def leave(self, key):
+        with self.lock:
+            outbox = self.members.pop(key, None)
+            self.snapshot = tuple(self.members.items())
+        return outbox
+
+    def __contains__(self, key) -> bool:
+        return key in self.members
+
+    def __len__(self) -> int:
+        return len(self.snapshot)
+
+    def broadcast(self, message: bytes, exclude=None) -> None:
+        frame = LENGTH_PREFIX.pack(len(message)) + message
+        for key, outbox in self.snapshot:
+            if key is not exclude and not outbox.put(frame):
+                self.leave(key)
@@ -0,0 +1,106 @@
+import lzma
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+# Codec of a COMPRESSED frame, the first byte of its payload
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+CODEC_NAMES = {codec: name for name, codec in CODECS.items()}
+# (lowest, highest, default) level of each codec
+LEVELS = {CODEC_ZLIB: (1, 9, 6), CODEC_LZMA: (0, 9, 6)}
+# Bytes of the file compressed on their own, chunks start at multiples of it so the
+# same chunks are cached whatever range a client asks for
+COMPRESSED_CHUNK_SIZE = 64 * 1024
+# A chunk is sent as it is unless compressing it saves at least 1/16 of it, so
+# already compressed files (images, archives) cost nothing to decompress
+MIN_SAVING_FRACTION = 1 / 16
+# Rough size of the key and the bookkeeping of a cached chunk, so the chunks that don't
+# compress count too
+CACHE_ENTRY_OVERHEAD = 128
+
+
+# COMPRESS=zlib/6 (or COMPRESS=lzma for the default level): (codec, level), or None for
+# an unknown codec, which the server answers with uncompressed DATA frames
+def parse_compression(value: str):
+    name, _, level = value.partition("/")
+    codec = CODECS.get(name.lower())
+    if codec is None:
+        return None
+    lowest, highest, default = LEVELS[codec]
+    return codec, max(lowest, min(int(level) if level else default, highest))
+
+
+def format_compression(codec: int, level: int) -> str:
+    return f"{CODEC_NAMES[codec]}/{level}"
+
+
+# Raw LZMA2 streams, the xz container would add about 60 bytes to every chunk
+def lzma_filters(level: int):
+    return [{"id": lzma.FILTER_LZMA2, "preset": level}]
+
+
+# The payload of the COMPRESSED frame (codec byte and compressed bytes), or None when
+# it's not worth it. Higher levels are only tried when the fastest one saves at least
+# half as much
+def compress_chunk(data, codec: int, level: int):
+    if (codec, level) != (CODEC_ZLIB, 1):
+        if len(zlib.compress(data, 1)) > len(data) * (1 - MIN_SAVING_FRACTION / 2):
+            return None
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(data, level)
+    else:
+        compressed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=lzma_filters(level))
+    if len(compressed) > len(data) * (1 - MIN_SAVING_FRACTION):
+        return None
+    return bytes([codec]) + compressed
+
+
+def decompress_chunk(payload, max_length=COMPRESSED_CHUNK_SIZE) -> bytes:
+    codec = payload[0]
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=lzma_filters(0))
+    else:
+        raise ValueError(f"unknown codec {codec}")
+    chunk = decompressor.decompress(payload[1:], max_length + 1)
+    if len(chunk) > max_length:
+        raise ValueError("decompressed chunk larger than a compressed chunk")
+    return chunk
+
+
+# Compressed chunks of the served files, kept while their size and modification time
+# don't change so a hot file is not compressed again for every request. The least
+# recently used ones are dropped once they take more than max_bytes. Chunks that don't
+# compress are kept too, as None
+class Compression_Cache:
+    def __init__(self, max_bytes=64 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        # (path, size, mtime_ns, codec, level, offset) -> frame payload or None
+        self.chunks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # data is the whole chunk at offset, two threads may compress the same chunk
+    def chunk(self, file_path: str, stat: os.stat_result, codec: int, level: int, offset: int, data):
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, codec, level, offset)
+        with self.lock:
+            if key in self.chunks:
+                self.chunks.move_to_end(key)
+                self.hits += 1
+                return self.chunks[key]
+            self.misses += 1
+        payload = compress_chunk(data, codec, level)
+        with self.lock:
+            if key not in self.chunks:
+                self.chunks[key] = payload
+                self.cached_bytes += CACHE_ENTRY_OVERHEAD + len(payload or b"")
+            while self.cached_bytes > self.max_bytes:
+                _, evicted = self.chunks.popitem(last=False)
+                self.cached_bytes -= CACHE_ENTRY_OVERHEAD + len(evicted or b"")
+        return payload
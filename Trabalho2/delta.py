@@ -0,0 +1,113 @@
+import hashlib
+import struct
+import zlib
+from math import isqrt
+
+# Each full block of the client's copy: its weak (Adler-32) and strong checksum
+SIGNATURE_ENTRY = struct.Struct(">I16s")
+# Payload of a FRAME_COPY: offset and length in the client's copy
+COPY_RANGE = struct.Struct(">QQ")
+ADLER_MODULUS = 65521
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 128 * 1024
+# Blocks searched byte by byte without a match before the rest of the file is sent
+# as it is, the search runs in Python and a file with nothing in common would take long
+MAX_UNMATCHED_BLOCKS = 64
+# Bytes of literal data in each DATA frame of a delta
+LITERAL_FRAME_SIZE = 64 * 1024
+
+
+# About the square root of the file size, like rsync
+def block_size_for(file_size: int) -> int:
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, isqrt(file_size) // 1024 * 1024))
+
+
+def strong_checksum(block) -> bytes:
+    return hashlib.sha256(block).digest()[:16]
+
+
+# (digest of the whole file, block size, signature payload) of the client's copy. The
+# payload is the digest followed by an entry for every full block
+def file_signature(file_path: str):
+    file_hasher = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        file.seek(0, 2)
+        block_size = block_size_for(file.tell())
+        file.seek(0)
+        entries = []
+        for block in iter(lambda: file.read(block_size), b""):
+            file_hasher.update(block)
+            if len(block) == block_size:
+                entries.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_checksum(block)))
+    digest = file_hasher.hexdigest()
+    return digest, block_size, bytes.fromhex(digest) + b"".join(entries)
+
+
+# A block size the client could have picked and a payload made of the digest and
+# whole entries, anything else from the client is refused before it's searched
+def valid_signature(block_size: int, payload) -> bool:
+    return (
+        MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE
+        and len(payload) >= 32
+        and (len(payload) - 32) % SIGNATURE_ENTRY.size == 0
+    )
+
+
+# (client digest, weak checksum -> {strong checksum: block index})
+def parse_signature(payload):
+    blocks = {}
+    entries = memoryview(payload)[32:]
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(entries)):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    return bytes(payload[:32]).hex(), blocks
+
+
+# Rebuilds data from the client's blocks: ("copy", offset in the client's copy, length)
+# and ("literal", start, end) in data, in order. Blocks are tried where the previous
+# match ended and, when they don't match, at every following byte with the checksum
+# rolled forward, so an insertion only costs the bytes inserted
+def delta_instructions(data, block_size: int, blocks: dict):
+    size = len(data)
+    position = literal_start = 0
+    # The copy being extended while the following blocks of the client's copy match
+    copy_offset = copy_length = 0
+    weak = None
+    while blocks and position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[position : position + block_size])
+        candidates = blocks.get(weak)
+        index = None
+        if candidates is not None:
+            index = candidates.get(strong_checksum(data[position : position + block_size]))
+        if index is not None:
+            if literal_start < position:
+                if copy_length:
+                    yield "copy", copy_offset, copy_length
+                    copy_length = 0
+                yield "literal", literal_start, position
+            if copy_length and copy_offset + copy_length == index * block_size:
+                copy_length += block_size
+            else:
+                if copy_length:
+                    yield "copy", copy_offset, copy_length
+                copy_offset, copy_length = index * block_size, block_size
+            position += block_size
+            literal_start = position
+            weak = None
+            continue
+        if position - literal_start >= MAX_UNMATCHED_BLOCKS * block_size:
+            break
+        if position + block_size < size:
+            weak = roll(weak, data[position], data[position + block_size], block_size)
+        position += 1
+    if copy_length:
+        yield "copy", copy_offset, copy_length
+    if literal_start < size:
+        yield "literal", literal_start, size
+
+
+# Adler-32 of the window moved one byte forward
+def roll(weak: int, removed: int, added: int, block_size: int) -> int:
+    a = ((weak & 0xFFFF) - removed + added) % ADLER_MODULUS
+    b = ((weak >> 16) - block_size * removed + a - 1) % ADLER_MODULUS
+    return b << 16 | a
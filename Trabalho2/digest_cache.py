@@ -0,0 +1,126 @@
+import atexit
+import json
+import os
+import threading
+
+from manifest import Manifest, build_manifest
+from utils import calculate_sha256
+
+
+# SHA-256 of the served files, kept while their size and modification time
+# don't change and saved to disk so it survives restarts. Their chunk manifests are
+# kept in a folder next to it, one file per digest. The digests are saved at most
+# every save_interval seconds and when the process exits, not on every change. It's
+# kept next to server_files, not in it, so no client can ask for it
+class Digest_Cache:
+    def __init__(self, path="./.digest_cache.json", save_interval=5.0) -> None:
+        self.path = path
+        self.manifest_folder = f"{os.path.splitext(path)[0]}_manifests"
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        # Only one save writes the file at a time
+        self.save_lock = threading.Lock()
+        # Pending save, started by the first change after the previous one
+        self.save_timer = None
+        # file path -> [size, mtime_ns, hex digest]
+        self.digests = {}
+        # file path -> lock held while its digest is computed
+        self.file_locks = {}
+        try:
+            with open(self.path, "r") as file:
+                self.digests = json.load(file)
+        except (OSError, ValueError):
+            pass
+        atexit.register(self.flush)
+
+    def get(self, file_path: str, stat: os.stat_result):
+        with self.lock:
+            entry = self.digests.get(os.path.abspath(file_path))
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return entry[2]
+
+    # stat must be taken before reading the file, if it changed meanwhile the digest is not
+    # kept. The manifest of the digest it replaces is deleted, unless another file has it too
+    def put(self, file_path: str, stat: os.stat_result, digest: str) -> None:
+        current = os.stat(file_path)
+        if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return
+        entry = [stat.st_size, stat.st_mtime_ns, digest]
+        with self.lock:
+            previous = self.digests.get(os.path.abspath(file_path))
+            if previous == entry:
+                return
+            self.digests[os.path.abspath(file_path)] = entry
+            superseded = previous is not None and all(other[2] != previous[2] for other in self.digests.values())
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_interval, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+        if superseded:
+            try:
+                os.remove(self.manifest_path(previous[2]))
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                print(f"Could not delete the manifest of {file_path}: {error}")
+
+    # Parallel range requests for a file not cached yet wait for a single computation
+    def digest(self, file_path: str, stat: os.stat_result) -> str:
+        digest = self.get(file_path, stat)
+        if digest is not None:
+            return digest
+        with self.file_lock(file_path):
+            digest = self.get(file_path, stat)
+            if digest is None:
+                digest = calculate_sha256(file_path)
+                self.put(file_path, stat, digest)
+        return digest
+
+    # Built along with the digest when either is missing
+    def manifest(self, file_path: str, stat: os.stat_result) -> Manifest:
+        with self.file_lock(file_path):
+            digest = self.get(file_path, stat)
+            if digest is not None:
+                try:
+                    return Manifest.load(self.manifest_path(digest))
+                except (OSError, ValueError):
+                    pass
+            manifest = build_manifest(file_path)
+            self.put(file_path, stat, manifest.digest)
+            try:
+                os.makedirs(self.manifest_folder, exist_ok=True)
+                manifest.save(self.manifest_path(manifest.digest))
+            except OSError as error:
+                print(f"Could not save the manifest of {file_path}: {error}")
+        return manifest
+
+    def manifest_path(self, digest: str) -> str:
+        return os.path.join(self.manifest_folder, f"{digest}.json")
+
+    def file_lock(self, file_path: str) -> threading.Lock:
+        with self.lock:
+            return self.file_locks.setdefault(os.path.abspath(file_path), threading.Lock())
+
+    # Saves the pending changes right away
+    def flush(self) -> None:
+        with self.lock:
+            timer = self.save_timer
+        if timer is not None:
+            timer.cancel()
+            self.save()
+
+    # Written to a temporary file first so a crash never leaves a truncated cache
+    def save(self) -> None:
+        temporary_path = f"{self.path}.tmp"
+        with self.save_lock:
+            with self.lock:
+                self.save_timer = None
+                contents = json.dumps(self.digests)
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(temporary_path, "w") as file:
+                    file.write(contents)
+                os.replace(temporary_path, self.path)
+            except OSError as error:
+                print(f"Could not save the digest cache: {error}")
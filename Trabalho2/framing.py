@@ -0,0 +1,129 @@
+import asyncio
+import socket
+import struct
+
+# Every message is a 4 byte big endian length followed by its body. Text bodies
+# are split on <DELIMITER>; binary bodies start with a type byte below 0x20 (text
+# always starts with a printable character) and carry the rest of the fixed header:
+# type, stream id (0 outside of streams), length of the name, offset in the file. The
+# name and the payload follow it
+LENGTH_PREFIX = struct.Struct(">I")
+BINARY_HEADER = struct.Struct(">IBIHQ")
+BINARY_FIELDS = struct.Struct(">BIHQ")
+
+FRAME_DATA = 1
+# Sent by the client: the stream may send offset more bytes of DATA payload
+FRAME_WINDOW = 2
+# Sent by the client: the signature of its copy of the file, offset is the block size
+FRAME_SIGNATURE = 3
+# Part of a delta: bytes of the client's copy to be written at offset
+FRAME_COPY = 4
+# DATA compressed with the codec in the first byte of the payload, offset is where its
+# uncompressed bytes go
+FRAME_COMPRESSED = 5
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+
+def is_binary_frame(frame) -> bool:
+    return len(frame) > 0 and frame[0] < 0x20
+
+
+def pack_frame_header(kind: int, name: bytes, offset: int, payload_length: int, stream_id=0) -> bytes:
+    length = BINARY_FIELDS.size + len(name) + payload_length
+    return BINARY_HEADER.pack(length, kind, stream_id, len(name), offset) + name
+
+
+# Returns (type, stream id, name, offset, payload), the payload is a view on the received
+# frame. ValueError when the frame is too short for its header and name
+def unpack_frame(frame: memoryview):
+    if len(frame) < BINARY_FIELDS.size:
+        raise ValueError("binary frame shorter than its header")
+    kind, stream_id, name_length, offset = BINARY_FIELDS.unpack_from(frame)
+    name_end = BINARY_FIELDS.size + name_length
+    if name_end > len(frame):
+        raise ValueError("binary frame shorter than its name")
+    return kind, stream_id, bytes(frame[BINARY_FIELDS.size : name_end]), offset, frame[name_end:]
+
+
+# sendmsg may send only part of the buffers, the rest is sent until nothing is left
+def sendmsg_all(sock: socket.socket, buffers) -> None:
+    views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_frame(sock: socket.socket, kind: int, name: bytes, offset: int, payload, stream_id=0) -> None:
+    sendmsg_all(sock, [pack_frame_header(kind, name, offset, len(payload), stream_id), payload])
+
+
+# Reads many frames with each recv_into on a buffer reused for the whole connection.
+# The views returned by read_frame are only valid until the next read
+class Frame_Reader:
+    def __init__(self, sock: socket.socket, buffer_size=DEFAULT_BUFFER_SIZE) -> None:
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Buffered bytes not consumed yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        while True:
+            available = self.end - self.start
+            if available >= LENGTH_PREFIX.size:
+                frame_end = self.start + LENGTH_PREFIX.size + LENGTH_PREFIX.unpack_from(self.buffer, self.start)[0]
+                if frame_end <= self.end:
+                    frame = self.view[self.start + LENGTH_PREFIX.size : frame_end]
+                    self.start = frame_end
+                    return frame
+                self.make_room(frame_end - self.start)
+            else:
+                self.make_room(LENGTH_PREFIX.size)
+            if not self.fill():
+                return None
+
+    # Copies buffered bytes first, then reads straight from the socket into buffer
+    def read_into(self, buffer: memoryview) -> int:
+        available = self.end - self.start
+        if available:
+            count = min(available, len(buffer))
+            buffer[:count] = self.view[self.start : self.start + count]
+            self.start += count
+            return count
+        return self.sock.recv_into(buffer)
+
+    def fill(self) -> int:
+        received = self.sock.recv_into(self.view[self.end :])
+        self.end += received
+        return received
+
+    # Moves the pending bytes to the start of the buffer, or to a larger one when
+    # a frame doesn't fit
+    def make_room(self, needed: int) -> None:
+        available = self.end - self.start
+        if self.start + needed <= len(self.buffer) and self.end < len(self.buffer):
+            return
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:available] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:available] = self.buffer[self.start : self.end]
+        self.start = 0
+        self.end = available
+
+
+# asyncio streams buffer what they read (many frames per syscall) on their own
+async def read_frame_async(reader):
+    try:
+        length = LENGTH_PREFIX.unpack(await reader.readexactly(LENGTH_PREFIX.size))[0]
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
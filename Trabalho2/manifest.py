@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+from typing import List
+
+# Bytes covered by each hash of a manifest, the smallest range asked for again
+MANIFEST_CHUNK_SIZE = 256 * 1024
+
+
+# SHA-256 of every chunk_size bytes of a file besides the digest of the whole file, so
+# the client checks each chunk as it arrives and asks again only for the bad ones
+class Manifest:
+    def __init__(self, chunk_size: int, file_size: int, digest: str, chunk_hashes: List[bytes]) -> None:
+        self.chunk_size = chunk_size
+        self.file_size = file_size
+        self.digest = digest
+        self.chunk_hashes = chunk_hashes
+
+    def chunk_count(self) -> int:
+        return len(self.chunk_hashes)
+
+    # (offset, length) of the chunk, the last one may be shorter
+    def chunk_range(self, index: int):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.file_size - offset)
+
+    # Fields of the MANIFEST message: chunk size, file size, digest and the chunk hashes
+    # joined in a single hex string
+    def fields(self) -> list:
+        return [self.chunk_size, self.file_size, self.digest, b"".join(self.chunk_hashes).hex()]
+
+    @staticmethod
+    def from_fields(fields: list) -> "Manifest":
+        chunk_size, file_size, digest, hashes = (
+            field.decode("utf-8") if isinstance(field, bytes) else field for field in fields[:4]
+        )
+        hashes = bytes.fromhex(hashes)
+        chunk_hashes = [hashes[start : start + 32] for start in range(0, len(hashes), 32)]
+        return Manifest(int(chunk_size), int(file_size), digest, chunk_hashes)
+
+    # Written to a temporary file first so a crash never leaves a truncated manifest
+    def save(self, path: str) -> None:
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.fields(), file)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str) -> "Manifest":
+        with open(path, "r") as file:
+            return Manifest.from_fields(json.load(file))
+
+
+# The digest of the whole file and of its chunks, in a single pass
+def build_manifest(file_path: str, chunk_size=MANIFEST_CHUNK_SIZE) -> Manifest:
+    file_hasher = hashlib.sha256()
+    chunk_hashes = []
+    file_size = 0
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            file_hasher.update(chunk)
+            chunk_hashes.append(hashlib.sha256(chunk).digest())
+            file_size += len(chunk)
+    return Manifest(chunk_size, file_size, file_hasher.hexdigest(), chunk_hashes)
+
+
+# Checks the chunks of a download against the manifest while their bytes are written.
+# The bytes of a chunk must come in order, from its first one
+class Chunk_Tracker:
+    def __init__(self, manifest: Manifest) -> None:
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        # 1 for the chunks already written and matching their hash
+        self.verified = bytearray(manifest.chunk_count())
+        # chunk index -> [hasher, bytes received] of the chunks being received
+        self.hashers = {}
+        # Chunks received that didn't match their hash
+        self.failed = 0
+
+    # Keeps what a previous download left on disk that matches the manifest
+    def check_file(self, fd: int) -> None:
+        for index in range(self.manifest.chunk_count()):
+            offset, length = self.manifest.chunk_range(index)
+            data = os.pread(fd, length, offset)
+            if len(data) == length and hashlib.sha256(data).digest() == self.manifest.chunk_hashes[index]:
+                self.verified[index] = 1
+
+    def update(self, offset: int, data) -> None:
+        view = memoryview(data).cast("B")
+        while view:
+            index = offset // self.manifest.chunk_size
+            chunk_offset, chunk_length = self.manifest.chunk_range(index)
+            count = min(len(view), chunk_offset + chunk_length - offset)
+            if offset == chunk_offset:
+                self.hashers[index] = [hashlib.sha256(), 0]
+            state = self.hashers.get(index)
+            # Bytes that don't continue the start of a chunk can't be checked, it's asked again
+            if state is not None:
+                state[0].update(view[:count])
+                state[1] += count
+                if state[1] == chunk_length:
+                    del self.hashers[index]
+                    matches = state[0].digest() == self.manifest.chunk_hashes[index]
+                    with self.lock:
+                        self.verified[index] = matches
+                        self.failed += not matches
+            view = view[count:]
+            offset += count
+
+    def complete(self) -> bool:
+        return all(self.verified)
+
+    # (offset, length) runs of the chunks between start and end still to be fetched
+    def missing_ranges(self, start=0, end=None):
+        chunk_size = self.manifest.chunk_size
+        first = start // chunk_size
+        last = self.manifest.chunk_count() if end is None else -(-end // chunk_size)
+        ranges = []
+        for index in range(first, last):
+            if self.verified[index]:
+                continue
+            offset, length = self.manifest.chunk_range(index)
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        return ranges
@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+# The start of Linux's struct tcp_info: 8 one byte fields, then 32 bit ones up to
+# tcpi_total_retrans. tcpi_rtt is in microseconds
+TCP_INFO = struct.Struct("=8B24I")
+TCP_INFO_RTT = 8 + 15
+TCP_INFO_TOTAL_RETRANS = 8 + 23
+
+# Bucket i of a histogram holds the values from 2^(i-1) to 2^i microseconds, the last
+# one everything above about 35 minutes
+HISTOGRAM_BUCKETS = 32
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[min(int(seconds * 1_000_000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram") -> None:
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # Upper bound of the bucket where the fraction of the values is reached
+    def percentile(self, fraction: float) -> float | None:
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min((1 << index) / 1_000_000, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_s": self.total / self.count if self.count else None,
+            "p50_s": self.percentile(0.50),
+            "p90_s": self.percentile(0.90),
+            "p99_s": self.percentile(0.99),
+            "max_s": self.max,
+        }
+
+
+class Metrics:
+    # Counters and latency histograms recorded from any thread without taking a lock:
+    # each thread only writes to its own shard and a snapshot adds them up. The lock
+    # is only taken to register the shard of a new thread and by the snapshots, which
+    # fold the shards of the threads that are gone into one
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (thread, counters, histograms) of every thread that recorded something
+        self.shards: list[tuple[threading.Thread, dict, dict]] = []
+        # (counters, histograms) of the threads that are gone
+        self.retired: tuple[dict, dict] = ({}, {})
+        # name -> function giving its current value, only called by the snapshots
+        self.gauges = {}
+
+    def shard(self) -> tuple[dict, dict]:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = ({}, {})
+            with self.lock:
+                self.shards.append((threading.current_thread(), *shard))
+            self.local.shard = shard
+            return shard
+
+    def add(self, name: str, value: int | float = 1) -> None:
+        counters = self.shard()[0]
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        histograms = self.shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name: str, function) -> None:
+        self.gauges[name] = function
+
+    def __getitem__(self, name: str) -> int | float:
+        return self.counters().get(name, 0)
+
+    def collect(self) -> tuple[dict, dict]:
+        with self.lock:
+            alive = []
+            for shard in self.shards:
+                if shard[0].is_alive():
+                    alive.append(shard)
+                else:
+                    add_shard(self.retired, shard[1:])
+            self.shards = alive
+            total = ({}, {})
+            add_shard(total, self.retired)
+            for _, counters, histograms in alive:
+                # The copies are taken at once, the thread may go on adding meanwhile
+                add_shard(total, (dict(counters), dict(histograms)))
+        return total
+
+    def counters(self) -> dict:
+        return self.collect()[0]
+
+    def snapshot(self) -> dict:
+        counters, histograms = self.collect()
+        uptime = time.monotonic() - self.started
+        return {
+            "pid": os.getpid(),
+            "uptime_s": uptime,
+            "counters": counters,
+            # Per second since the start, the dumps also have them since the previous dump
+            "rates": {name: value / uptime for name, value in counters.items()} if uptime else {},
+            "gauges": {name: function() for name, function in self.gauges.items()},
+            "histograms": {name: histogram.summary() for name, histogram in sorted(histograms.items())},
+        }
+
+    # Appends a snapshot to path as a line of JSON every interval seconds
+    def start_dumping(self, path: str, interval: float) -> threading.Thread:
+        thread = threading.Thread(target=self.dump_periodically, args=(path, interval), daemon=True)
+        thread.start()
+        return thread
+
+    def dump_periodically(self, path: str, interval: float) -> None:
+        previous = self.snapshot()
+        while True:
+            time.sleep(interval)
+            snapshot = self.snapshot()
+            elapsed = snapshot["uptime_s"] - previous["uptime_s"]
+            snapshot["interval_rates"] = {
+                name: (value - previous["counters"].get(name, 0)) / elapsed
+                for name, value in snapshot["counters"].items()
+            }
+            try:
+                with open(path, "a") as file:
+                    file.write(json.dumps(snapshot) + "\n")
+            except OSError as error:
+                print(f"ERROR: Could not write the stats to {path}: {error}")
+            previous = snapshot
+
+
+# Adds the (counters, histograms) of a shard to total
+def add_shard(total: tuple[dict, dict], shard: tuple[dict, dict]) -> None:
+    for name, value in shard[0].items():
+        total[0][name] = total[0].get(name, 0) + value
+    for name, histogram in shard[1].items():
+        total[1].setdefault(name, Histogram()).merge(histogram)
+
+
+# Percentiles of the histograms of a snapshot in milliseconds, named like send_p50
+def latency_ms(histograms: dict, percentiles=("p50", "p99")) -> dict:
+    latencies = {}
+    for name, summary in histograms.items():
+        for percentile in percentiles:
+            seconds = summary[f"{percentile}_s"]
+            latencies[f"{name.removesuffix('_s')}_{percentile}"] = seconds * 1000 if seconds is not None else None
+    return latencies
+
+
+# Adds up the time spent producing the items of iterator, reading a file for instance
+class Timed_Iterator:
+    def __init__(self, iterator) -> None:
+        self.iterator = iterator
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+# (segments retransmitted, smoothed RTT in seconds) of a connection from the kernel's
+# tcp_info, or None where there's no TCP_INFO
+def tcp_info(sock):
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = TCP_INFO.unpack(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size))
+    except (OSError, struct.error):
+        return None
+    return info[TCP_INFO_TOTAL_RETRANS], info[TCP_INFO_RTT] / 1_000_000
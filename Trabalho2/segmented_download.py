@@ -0,0 +1,257 @@
+import os
+import socket
+import threading
+import time
+from collections import deque
+from typing import List
+
+from framing import Frame_Reader
+from manifest import Chunk_Tracker, Manifest
+from utils import send_message
+
+DEFAULT_PIECE_SIZE = 4 * 1024 * 1024
+# Ranges asked for ahead on each connection, so it doesn't wait a round trip between them
+PIPELINE_DEPTH = 2
+
+
+# What one connection still has to ask for: the bytes from position to end
+class Segment:
+    def __init__(self, position: int, end: int) -> None:
+        self.position = position
+        self.end = end
+        self.received = 0
+        self.started = time.monotonic()
+        # Set while its connection has nothing to do, or once it has ended
+        self.idle = False
+
+    def remaining(self) -> int:
+        return self.end - self.position
+
+    def rate(self) -> float:
+        return self.received / max(time.monotonic() - self.started, 1e-6)
+
+    def time_left(self) -> float:
+        rate = self.rate()
+        return self.remaining() / rate if rate else float("inf")
+
+
+# Downloads a file over many connections at once. The chunks missing on disk (all of
+# them for a new download) are split in one segment per connection, each one asked for
+# in ranges of piece_size bytes and written at their offset. Every chunk is checked
+# against the manifest as it arrives and the bad ones are queued to be asked again. A
+# connection that runs out of work takes the end of the segment expected to finish
+# last, in proportion to how fast both are going, so a slow connection doesn't hold
+# the download. With nothing left to take it waits until every connection is done, for
+# the ranges of one that fails
+class Segmented_Download:
+    def __init__(
+        self,
+        host,
+        port,
+        file_name: str,
+        file_path: str,
+        connections=4,
+        piece_size=DEFAULT_PIECE_SIZE,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.file_name = file_name
+        self.file_path = file_path
+        self.connections = connections
+        self.piece_size = piece_size
+        self.lock = threading.Lock()
+        # Idle connections wait on it for the ranges a failed connection leaves behind
+        self.work = threading.Condition(self.lock)
+        self.segments: List[Segment] = []
+        # (start, end) ranges no connection is working on: the segments not started
+        # yet, chunks that didn't match and the ranges of connections that failed
+        self.pending = deque()
+        self.tracker = None
+        # Set when a range ends with a HASH other than the digest of the manifest: the file
+        # changed in the server and the download stops, the next attempt gets a new manifest
+        self.stale = False
+        # Seconds between asking for each range and having all of it
+        self.piece_latencies: List[float] = []
+
+    def run(self) -> bool:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, self.port))
+            reader = Frame_Reader(sock)
+            send_message(sock, f"Arquivo<DELIMITER>{self.file_name}<DELIMITER>MANIFEST".encode("utf-8"))
+            manifest = self.read_manifest(reader)
+        except (OSError, ValueError) as error:
+            print(f"ERROR: Could not download {self.file_name}: {error}")
+            sock.close()
+            return False
+        # Ranges start at a chunk, so each chunk is received in order by a single connection
+        self.piece_size = max(1, self.piece_size // manifest.chunk_size) * manifest.chunk_size
+        resumed = os.path.isfile(self.file_path)
+        self.fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(self.fd, manifest.file_size)
+            self.tracker = Chunk_Tracker(manifest)
+            # What a previous download left on disk is kept
+            if resumed:
+                self.tracker.check_file(self.fd)
+            self.pending.extend(self.split(self.tracker.missing_ranges()))
+            self.segments = [Segment(0, 0) for _ in range(min(self.connections, len(self.pending)))]
+            threads = [
+                threading.Thread(target=self.run_connection, args=(segment,))
+                for segment in self.segments[1:]
+            ]
+            for thread in threads:
+                thread.start()
+            if self.segments:
+                self.run_connection(self.segments[0], sock, reader)
+            else:
+                sock.close()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(self.fd)
+        if self.stale:
+            print(f"ERROR: File {self.file_name} changed in the server during the download.")
+            return False
+        if not self.tracker.complete():
+            missing = self.tracker.verified.count(0)
+            print(f"ERROR: Download of {self.file_name} stopped with {missing} chunks missing.")
+            return False
+        return True
+
+    # (start, end) ranges of at most a connection's share of the bytes, at chunk boundaries
+    def split(self, ranges) -> list:
+        chunk_size = self.tracker.manifest.chunk_size
+        total = sum(length for _, length in ranges)
+        share = max(1, -(-total // self.connections // chunk_size)) * chunk_size
+        segments = []
+        for offset, length in ranges:
+            end = offset + length
+            segments.extend((start, min(start + share, end)) for start in range(offset, end, share))
+        return segments
+
+    def read_manifest(self, reader: Frame_Reader) -> Manifest:
+        message = reader.read_frame()
+        if message is None:
+            raise ConnectionAbortedError("connection closed by the server")
+        split_message = bytes(message).split(b"<DELIMITER>")
+        if split_message[:2] == [b"Arquivo", b"NON_EXISTENT_FILE"]:
+            raise FileNotFoundError("file does not exist in the server")
+        if split_message[3:4] != [b"MANIFEST"]:
+            raise ValueError(f"unexpected answer {bytes(message)[:64]!r}")
+        return Manifest.from_fields(split_message[4:])
+
+    def request(self, sock: socket.socket, offset: int, length: int):
+        message = f"Arquivo<DELIMITER>{self.file_name}<DELIMITER>SENDFILE<DELIMITER>OFFSET={offset}<DELIMITER>LENGTH={length}"
+        send_message(sock, message.encode("utf-8"))
+
+    # (length, offset, file size) of the range that follows
+    def read_header(self, reader: Frame_Reader):
+        message = reader.read_frame()
+        if message is None:
+            raise ConnectionAbortedError("connection closed by the server")
+        split_message = bytes(message).split(b"<DELIMITER>")
+        if split_message[3:4] != [b"SIZE"] or len(split_message) < 7:
+            raise ValueError(f"unexpected answer {bytes(message)[:64]!r}")
+        return tuple(int(field) for field in split_message[4:7])
+
+    def run_connection(self, segment: Segment, sock=None, reader=None):
+        # (offset, length, time asked for) of the ranges asked for and not received yet
+        in_flight = deque()
+        try:
+            if sock is None:
+                sock = socket.create_connection((self.host, self.port))
+                reader = Frame_Reader(sock)
+            with sock:
+                buffer = memoryview(bytearray(256 * 1024))
+                while True:
+                    requests = []
+                    with self.lock:
+                        while True:
+                            while len(in_flight) + len(requests) < PIPELINE_DEPTH:
+                                if not segment.remaining() and not self.take_work(segment):
+                                    break
+                                length = min(self.piece_size, segment.remaining())
+                                requests.append((segment.position, length, time.monotonic()))
+                                segment.position += length
+                            if requests or in_flight:
+                                break
+                            # Nothing left to ask for, but while other connections are busy
+                            # one of them may fail and leave its ranges behind
+                            segment.idle = True
+                            if self.stale or all(other.idle for other in self.segments):
+                                self.work.notify_all()
+                                return
+                            self.work.wait()
+                            segment.idle = False
+                    in_flight.extend(requests)
+                    for offset, length, _ in requests:
+                        self.request(sock, offset, length)
+                    offset, length, requested = in_flight[0]
+                    header = self.read_header(reader)
+                    if header != (length, offset, self.tracker.manifest.file_size):
+                        raise ValueError(f"asked for {length} bytes at {offset}, got {header}")
+                    self.receive_range(reader, buffer, segment, offset, length)
+                    in_flight.popleft()
+                    self.piece_latencies.append(time.monotonic() - requested)
+        except (OSError, ValueError) as error:
+            print(f"ERROR: Connection for {self.file_name} failed: {error}")
+            with self.lock:
+                self.pending.extend((offset, offset + length) for offset, length, _ in in_flight)
+                if segment.remaining():
+                    self.pending.append((segment.position, segment.end))
+                segment.position = segment.end
+                segment.idle = True
+                self.work.notify_all()
+
+    # The raw bytes of the range, then the HASH message of the whole file. The chunks
+    # of the range that didn't match are queued again
+    def receive_range(self, reader: Frame_Reader, buffer: memoryview, segment: Segment, offset: int, length: int):
+        remaining = length
+        while remaining:
+            received = reader.read_into(buffer[: min(remaining, len(buffer))])
+            if not received:
+                raise ConnectionAbortedError("connection closed in the middle of a range")
+            position = offset + length - remaining
+            os.pwrite(self.fd, buffer[:received], position)
+            self.tracker.update(position, buffer[:received])
+            remaining -= received
+            segment.received += received
+        message = reader.read_frame()
+        if message is None:
+            raise ConnectionAbortedError("connection closed before the file hash")
+        split_message = bytes(message).split(b"<DELIMITER>")
+        if split_message[3:4] != [b"HASH"]:
+            raise ValueError(f"unexpected answer {bytes(message)[:64]!r}")
+        with self.lock:
+            if split_message[4].decode("utf-8") != self.tracker.manifest.digest:
+                self.stale = True
+                self.work.notify_all()
+                return
+            for bad_offset, bad_length in self.tracker.missing_ranges(offset, offset + length):
+                self.pending.append((bad_offset, bad_offset + bad_length))
+            self.work.notify_all()
+
+    # Called with the lock held. Gives an idle connection a pending range, or the end
+    # of the segment with the most time left
+    def take_work(self, segment: Segment) -> bool:
+        if self.stale:
+            return False
+        if self.pending:
+            segment.position, segment.end = self.pending.popleft()
+            return True
+        candidates = [other for other in self.segments if other.remaining() > self.piece_size]
+        if not candidates:
+            return False
+        victim = max(candidates, key=Segment.time_left)
+        rate, victim_rate = segment.rate(), victim.rate()
+        share = rate / (rate + victim_rate) if rate + victim_rate else 0.5
+        share = min(max(share, 0.1), 0.9)
+        chunk_size = self.tracker.manifest.chunk_size
+        split = victim.end - int(victim.remaining() * share)
+        split = -(-split // chunk_size) * chunk_size
+        if split >= victim.end:
+            return False
+        segment.position, segment.end = split, victim.end
+        victim.end = split
+        return True
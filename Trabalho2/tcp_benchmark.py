@@ -0,0 +1,306 @@
+import argparse
+import contextlib
+import filecmp
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from compression import parse_compression
+from metrics import latency_ms
+from segmented_download import DEFAULT_PIECE_SIZE
+from tcp_client import TCP_Client
+from tcp_server import Async_TCP_Server, TCP_Server
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+DEFAULT_SIZES = "1K,64K,1M,16M"
+CONTENTS = ("random", "text", "mixed")
+WORDS = (
+    "the", "of", "and", "to", "in", "my", "thou", "lord", "god", "soul", "which", "that", "was", "not",
+    "for", "me", "thee", "what", "love", "truth", "heart", "when", "how", "yet", "whom", "being", "mind",
+)
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix("B")
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for unit, scale in reversed(SIZE_UNITS.items()):
+        if size >= scale and size % scale == 0:
+            return f"{size // scale}{unit}"
+    return str(size)
+
+
+# The content only depends on the seed, the size and the kind of content, so runs with
+# the same arguments transfer the same bytes. Random bytes don't compress, text does and
+# mixed alternates 64 KiB of each
+def generate_file(path: str, size: int, seed: int, content="random"):
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        return
+    generator = random.Random(f"{seed}:{size}")
+    with open(path, "wb") as file:
+        remaining = size
+        block_no = 0
+        while remaining:
+            chunk_size = min(remaining, 64 * 1024 if content == "mixed" else 1024 * 1024)
+            if content == "text" or (content == "mixed" and block_no % 2 == 0):
+                file.write(generate_text(generator, chunk_size))
+            else:
+                file.write(generator.randbytes(chunk_size))
+            remaining -= chunk_size
+            block_no += 1
+
+
+def generate_text(generator: random.Random, size: int) -> bytes:
+    text = bytearray()
+    while len(text) < size:
+        text += " ".join(generator.choices(WORDS, k=12)).encode("utf-8") + b".\n"
+    return bytes(text[:size])
+
+
+def copy_bytes(source, destination, count: int):
+    while count > 0:
+        data = source.read(min(count, 1024 * 1024))
+        if not data:
+            break
+        destination.write(data)
+        count -= len(data)
+
+
+# The same file with a byte changed, 100 bytes inserted and 100 bytes removed, for
+# the client to hold before a delta transfer
+def write_older_version(source_path: str, destination_path: str, seed: int):
+    size = os.path.getsize(source_path)
+    generator = random.Random(f"{seed}:{size}:older")
+    edits = sorted(generator.randrange(size) for _ in range(3)) if size else []
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        position = 0
+        for kind, offset in zip(("change", "insert", "remove"), edits):
+            offset = max(offset, position)
+            copy_bytes(source, destination, offset - position)
+            position = offset
+            if kind == "change":
+                data = source.read(1)
+                destination.write(bytes(byte ^ 0xFF for byte in data))
+                position += len(data)
+            elif kind == "insert":
+                destination.write(generator.randbytes(100))
+            else:
+                position = min(position + 100, size)
+                source.seek(position)
+        copy_bytes(source, destination, size - position)
+
+
+def percentile(values, fraction: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def children_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve(host: str, port: int, corruption_rate: float, seed: int, use_asyncio: bool):
+    server_class = Async_TCP_Server if use_asyncio else TCP_Server
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server_class(host, port, interactive=False, corruption_rate=corruption_rate, seed=seed)
+
+
+def connect(host: str, port: int, client_id: str, timeout: float, **client_kwargs) -> TCP_Client:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return TCP_Client(host, port, client_id, interactive=False, **client_kwargs)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+# One server process per size, so its CPU time can be read once it's gone
+def run_transfer(size: int, args) -> dict:
+    file_name = f"bench_{format_size(size)}.bin"
+    if args.content != "random":
+        file_name = f"bench_{format_size(size)}_{args.content}.bin"
+    generate_file(os.path.join("server_files", file_name), size, args.seed, args.content)
+    context = multiprocessing.get_context("fork")
+    server_cpu_before = children_cpu_time()
+    server = context.Process(
+        target=serve,
+        args=(args.host, args.port, args.corruption_rate, args.seed, args.asyncio),
+    )
+    server.start()
+    try:
+        client = connect(
+            args.host,
+            args.port,
+            "bench",
+            args.timeout,
+            sendfile=not args.no_sendfile,
+            frames=not args.no_frames,
+            streams=args.streams,
+            manifest=not args.no_manifest,
+            delta=args.delta,
+            compression=args.compress,
+        )
+        client_path = os.path.join(client.client_folder, file_name)
+        if args.delta:
+            write_older_version(os.path.join("server_files", file_name), client_path, args.seed)
+        elif os.path.exists(client_path):
+            os.remove(client_path)
+        client_cpu_before = time.process_time()
+        started = time.perf_counter()
+        if args.segments:
+            downloaded = client.download_segmented(file_name, args.segments, args.piece_size)
+        else:
+            client.request_file(file_name)
+            downloaded = client.wait_for_file(file_name, args.timeout)
+        seconds = time.perf_counter() - started
+        client_cpu = time.process_time() - client_cpu_before
+        server_stats = client.request_stats(args.timeout) or {"counters": {}, "histograms": {}}
+        client.stop()
+    finally:
+        server.terminate()
+        server.join()
+    server_cpu = children_cpu_time() - server_cpu_before
+    latencies = [latency * 1000 for latency in client.chunk_latencies]
+    return {
+        "file": file_name,
+        "size": size,
+        "ok": downloaded
+        and filecmp.cmp(
+            os.path.join("server_files", file_name), client_path, shallow=False
+        ),
+        "seconds": seconds,
+        "throughput_mib_s": size / seconds / 1024**2,
+        "chunks": len(latencies),
+        "chunk_latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+        },
+        "retransmits": client.stats["hash_mismatches"],
+        "chunks_refetched": client.stats["chunks_refetched"],
+        "delta_literal_bytes": client.stats["delta_literal_bytes"],
+        "delta_copied_bytes": client.stats["delta_copied_bytes"],
+        "compressed_bytes": client.stats["compressed_bytes"],
+        "decompressed_bytes": client.stats["decompressed_bytes"],
+        "server_bytes_sent": server_stats["counters"].get("file_bytes_sent", 0)
+        + server_stats["counters"].get("delta_bytes_sent", 0),
+        "server_latency_ms": latency_ms(server_stats["histograms"]),
+        "client_cpu_s": client_cpu,
+        "server_cpu_s": server_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Downloads generated files from a local TCP server and reports the results as JSON"
+    )
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help=f"comma separated file sizes, from 1K to 1G (default {DEFAULT_SIZES})",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed for the generated files and the injected faults"
+    )
+    parser.add_argument(
+        "--corruption-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the transfers with a corrupted chunk, they are downloaded again",
+    )
+    parser.add_argument(
+        "--no-sendfile", action="store_true", help="asks for the files in 1024 byte DATA messages"
+    )
+    parser.add_argument(
+        "--no-frames", action="store_true", help="DATA chunks in text messages instead of binary frames"
+    )
+    parser.add_argument(
+        "--streams", action="store_true", help="asks for the files on flow controlled streams"
+    )
+    parser.add_argument(
+        "--no-manifest",
+        action="store_true",
+        help="downloads whole files checked against a single hash instead of chunk by chunk",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="the client holds an older version of each file and only gets what changed",
+    )
+    parser.add_argument(
+        "--compress",
+        type=parse_compression,
+        default=None,
+        help="codec/level the DATA chunks are compressed with, zlib/1-9 or lzma/0-9",
+    )
+    parser.add_argument(
+        "--content", choices=CONTENTS, default="random", help="what the generated files contain"
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=0,
+        help="downloads each file in ranges over this many parallel connections",
+    )
+    parser.add_argument(
+        "--piece-size",
+        type=parse_size,
+        default=DEFAULT_PIECE_SIZE,
+        help="bytes asked for in each range request of a segmented download",
+    )
+    parser.add_argument(
+        "--asyncio", action="store_true", help="runs the event loop server instead of a thread per client"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3300)
+    parser.add_argument(
+        "--timeout", type=float, default=600.0, help="seconds before a transfer is given up"
+    )
+    parser.add_argument(
+        "--workdir", default=None, help="keeps the generated files here instead of a temporary folder"
+    )
+    parser.add_argument(
+        "--output", default=None, help="writes the JSON report to this file instead of stdout"
+    )
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    output = os.path.abspath(args.output) if args.output else None
+    # The client and server messages go to stderr, stdout only gets the report
+    with tempfile.TemporaryDirectory() as temporary_folder, contextlib.redirect_stdout(
+        sys.stderr
+    ):
+        os.chdir(args.workdir or temporary_folder)
+        os.makedirs("server_files", exist_ok=True)
+        results = [run_transfer(size, args) for size in sizes]
+    report = {
+        "protocol": "tcp",
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "workdir")
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,106 @@
+import hashlib
+import json
 import socket
 import sys
 import threading
+import time
 
-from typing import Dict
-from utils import calculate_sha256, recv_message, send_message
+from collections import Counter
+from typing import Dict, List
+from compression import decompress_chunk, format_compression
+from delta import COPY_RANGE, file_signature
+from framing import (
+    FRAME_COMPRESSED,
+    FRAME_COPY,
+    FRAME_DATA,
+    FRAME_SIGNATURE,
+    FRAME_WINDOW,
+    Frame_Reader,
+    is_binary_frame,
+    send_frame,
+    unpack_frame,
+)
+from manifest import Chunk_Tracker, Manifest
+from segmented_download import DEFAULT_PIECE_SIZE, Segmented_Download
+from utils import send_message
 import os
 
 
 class TCP_Client:
-    def __init__(self, host, port, id=0):
+    # Rounds of ranges asked for a file (the first one included) before its download fails
+    RANGE_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        host,
+        port,
+        id=0,
+        interactive=True,
+        sendfile=True,
+        frames=True,
+        streams=True,
+        stream_window=1024 * 1024,
+        manifest=True,
+        delta=False,
+        compression=None,
+    ):
         self.client_id = id
         self.host = host
         self.port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
         self.running = True
+        # Without a terminal the commands come from request_file instead of stdin
+        self.interactive = interactive
+        # Asks for files in SENDFILE mode: one SIZE message followed by the raw contents
+        self.sendfile = sendfile
+        # Asks for the DATA chunks in binary frames instead of text messages
+        self.frames = frames
+        # Asks for files on streams, which share the connection with the chat and
+        # with each other, instead of taking it over until they end
+        self.streams = streams
+        self.stream_window = stream_window
+        self.next_stream_id = 1
+        # file name -> its streams, stream -> DATA bytes received and not granted again yet
+        self.file_streams: Dict[str, List[int]] = {}
+        self.stream_pending: Dict[int, int] = {}
+        # Asks for the hashes of the chunks of a file first, then only for the ranges
+        # not on disk yet. Each chunk is checked as it arrives and only the bad ones
+        # are asked for again
+        self.manifest = manifest
+        self.trackers: Dict[str, Chunk_Tracker] = {}
+        # file name -> ranges asked for and not finished yet
+        self.pending_ranges: Dict[str, int] = {}
+        # file name -> rounds of ranges asked for
+        self.range_rounds: Dict[str, int] = {}
+        # Files whose HASH didn't match the digest of their manifest: the file changed in
+        # the server, a new manifest is asked for once their ranges end
+        self.stale_manifests = set()
+        # Sends the signature of the copy of a file already in the client folder, when
+        # there is one, and only gets what changed
+        self.delta = delta
+        # file name -> the copy whose signature was sent, opened once the delta starts
+        self.delta_bases: Dict[str, str] = {}
+        self.delta_base_files = {}
+        # (codec, level) the DATA chunks are asked for compressed with, instead of SENDFILE.
+        # The chunks that don't compress still come in DATA frames
+        self.compression = compression
+        self.reader = Frame_Reader(self.sock)
+        # The receiving thread grants windows and asks again for corrupted files
+        self.send_lock = threading.Lock()
         self.open_files: Dict[str, socket.socket] = {}
+        # SHA-256 of each file being downloaded, updated as its contents arrive
+        self.file_hashers = {}
+        # Set when the download of the file finishes, with its result in download_results
+        self.downloads: Dict[str, threading.Event] = {}
+        self.download_results: Dict[str, bool] = {}
+        # Seconds since the request (or the previous chunk) for every DATA chunk received
+        self.chunk_latencies: List[float] = []
+        self.last_chunk_times: Dict[str, float] = {}
+        self.stats = Counter()
+        # Answer to the last STATS, the stats of the server
+        self.server_stats = None
+        self.server_stats_received = threading.Event()
         self.client_folder = f"./client{self.client_id}_files"
         os.makedirs(self.client_folder, exist_ok=True)
         self._run()
@@ -23,50 +108,98 @@ class TCP_Client:
     def _receive_messages_handler(self):
         while self.running:
             try:
-                response = recv_message(self.sock)
+                response = self.reader.read_frame()
+                if response is None:
+                    break
+
+                if is_binary_frame(response):
+                    kind, stream_id, name, offset, payload = unpack_frame(response)
+                    if kind == FRAME_DATA and name.decode("utf-8") in self.delta_base_files:
+                        self.write_chunk(name.decode("utf-8"), payload, offset)
+                        self.stats["delta_literal_bytes"] += len(payload)
+                    elif kind == FRAME_COPY:
+                        self.copy_from_base(name.decode("utf-8"), offset, *COPY_RANGE.unpack(payload))
+                    elif kind == FRAME_DATA:
+                        self.write_chunk(name.decode("utf-8"), payload, offset)
+                        if stream_id:
+                            self.grant_window(stream_id, len(payload))
+                    elif kind == FRAME_COMPRESSED:
+                        self.write_compressed_chunk(name.decode("utf-8"), payload, offset)
+                        if stream_id:
+                            self.grant_window(stream_id, len(payload))
+                    continue
 
-                split_message = response.split(b"<DELIMITER>")
+                split_message = bytes(response).split(b"<DELIMITER>")
 
                 if split_message[0] == b"Arquivo":
                     if split_message[1] == b"NON_EXISTENT_FILE":
                         print("ERROR: File does not exist in the server.")
+                        # The answer doesn't name the file, every pending download fails
+                        for file_name in list(self.downloads):
+                            self.finish_download(file_name, False)
                     elif split_message[1] == b"SUCCESS":
                         file_name = split_message[2].decode("utf-8")
-                        if split_message[3] == b"START":
-                            if os.path.isfile(f"{self.client_folder}/{file_name}"):
-                                os.remove(f"{self.client_folder}/{file_name}")
+                        if split_message[3] == b"MANIFEST":
+                            self.start_ranges(file_name, Manifest.from_fields(split_message[4:]))
+                        elif split_message[3] == b"START" and file_name in self.trackers:
+                            # The DATA messages of a range go on from its offset
+                            self.open_files[file_name].seek(int(split_message[4]))
+                        elif split_message[3] == b"START":
+                            # Opened here so an empty file, without any DATA, is created too
+                            self.open_files[file_name] = open(f"{self.client_folder}/{file_name}", "wb")
+                            self.file_hashers[file_name] = hashlib.sha256()
+                        elif split_message[3] == b"SIZE":
+                            offset = int(split_message[5]) if len(split_message) > 5 else 0
+                            self.receive_file_body(file_name, int(split_message[4]), offset)
                         elif split_message[3] == b"DATA":
-                            file_data = split_message[4]
-                            if file_name not in self.open_files:
-                                self.open_files[file_name] = open(
-                                    f"{self.client_folder}/{file_name}", "ab+"
-                                )
-                            self.open_files[file_name].write(file_data)
+                            self.write_chunk(file_name, split_message[4])
+                        elif split_message[3] == b"HASH" and file_name in self.trackers:
+                            self.finish_range(file_name, split_message[4].decode("utf-8"))
+                        elif split_message[3] == b"UNCHANGED":
+                            self.delta_bases.pop(file_name, None)
+                            print(f"File {file_name} is up to date.")
+                            self.finish_download(file_name, True)
+                        elif split_message[3] == b"DELTA":
+                            self.start_delta(file_name)
+                        elif split_message[3] == b"INVALID_RANGE":
+                            print(f"ERROR: The server refused the range asked for of {file_name}.")
+                            self.finish_download(file_name, False)
+                        elif split_message[3] == b"INVALID_SIGNATURE":
+                            print(f"ERROR: The server refused the signature of {file_name}. Downloading the whole file...")
+                            self.delta_bases.pop(file_name, None)
+                            self.ask_for_file(file_name, delta=False)
+                        elif split_message[3] == b"HASH" and file_name in self.delta_base_files:
+                            self.finish_delta(file_name, split_message[4].decode("utf-8"))
                         elif split_message[3] == b"HASH":
                             self.open_files[file_name].flush()
                             remote_file_hash = split_message[4].decode("utf-8")
-                            local_file_hash = calculate_sha256(
-                                f"{self.client_folder}/{file_name}"
-                            )
+                            local_file_hash = self.file_hashers.pop(
+                                file_name
+                            ).hexdigest()
                             if remote_file_hash != local_file_hash:
                                 print(
                                     "ERROR: File hash does not match. Trying again..."
                                 )
+                                self.open_files.pop(file_name).close()
                                 os.remove(f"{self.client_folder}/{file_name}")
-                                del self.open_files[file_name]
-                                message_to_retry = (
-                                    f"Arquivo<DELIMITER>{file_name}".encode("utf-8")
-                                )
-                                send_message(self.sock, message_to_retry)
+                                self.stats["hash_mismatches"] += 1
+                                self.send_file_request(file_name)
                             else:
                                 self.open_files[file_name].close()
                                 del self.open_files[file_name]
                                 print(f"File {file_name} successfully downloaded!")
+                                self.finish_download(file_name, True)
 
                 elif split_message[0] == b"Chat":
                     print(f"{split_message[1].decode('utf-8')}")
 
-            except ConnectionAbortedError:
+                elif split_message[0] == b"STATS":
+                    self.server_stats = json.loads(split_message[1].decode("utf-8"))
+                    if self.interactive:
+                        print(json.dumps(self.server_stats, indent=2))
+                    self.server_stats_received.set()
+
+            except OSError:
                 print(f"Connection terminated.")
                 break
         self.stop()
@@ -77,21 +210,306 @@ class TCP_Client:
             if message == "Sair":
                 break
             message = message.replace("|", "<DELIMITER>")
-            send_message(self.sock, message.encode("utf-8"))
+            split_message = message.split("<DELIMITER>")
+            if split_message[0] == "Arquivo" and len(split_message) == 2:
+                self.ask_for_file(split_message[1])
+                continue
+            # Arquivo|name|DELTA only gets what changed in the copy already in the client folder
+            if split_message[0] == "Arquivo" and split_message[2:] == ["DELTA"]:
+                self.ask_for_file(split_message[1], delta=True)
+                continue
+            # Arquivo|name|SEGMENTS=n downloads the file over n connections of its own
+            if split_message[0] == "Arquivo" and split_message[2:3] and split_message[2].startswith("SEGMENTS="):
+                connections = int(split_message[2].split("=", 1)[1])
+                threading.Thread(
+                    target=self.download_segmented, args=(split_message[1], connections), daemon=True
+                ).start()
+                continue
+            self.send(message.encode("utf-8"))
         self.stop()
 
     def _run(self):
         receive_messages_thread = threading.Thread(
             target=self._receive_messages_handler
         )
-        send_messages_thread = threading.Thread(target=self._send_messages_handler)
-
         receive_messages_thread.start()
-        send_messages_thread.start()
+        if self.interactive:
+            send_messages_thread = threading.Thread(
+                target=self._send_messages_handler
+            )
+            send_messages_thread.start()
         self.running = True
 
+    def send(self, message: bytes):
+        with self.send_lock:
+            send_message(self.sock, message)
+
+    def ask_for_file(self, file_name: str, delta=None):
+        file_path = f"{self.client_folder}/{file_name}"
+        if (self.delta if delta is None else delta) and os.path.isfile(file_path):
+            self.send_signature(file_name, file_path)
+        elif self.manifest:
+            self.range_rounds[file_name] = 0
+            self.request_manifest(file_name)
+        else:
+            self.send_file_request(file_name)
+
+    def send_signature(self, file_name: str, file_path: str):
+        self.last_chunk_times[file_name] = time.monotonic()
+        _, block_size, signature = file_signature(file_path)
+        self.delta_bases[file_name] = file_path
+        with self.send_lock:
+            send_frame(self.sock, FRAME_SIGNATURE, file_name.encode("utf-8"), block_size, signature)
+
+    # The new file is written next to the old copy, which replaces it once the hash matches
+    def start_delta(self, file_name: str):
+        base_path = self.delta_bases.pop(file_name)
+        self.delta_base_files[file_name] = open(base_path, "rb")
+        self.open_files[file_name] = open(f"{base_path}.delta", "wb")
+        self.file_hashers[file_name] = hashlib.sha256()
+
+    # Copies length bytes at source in the old copy to offset in the new file
+    def copy_from_base(self, file_name: str, offset: int, source: int, length: int):
+        base_file = self.delta_base_files[file_name]
+        file = self.open_files[file_name]
+        if file.tell() != offset:
+            file.seek(offset)
+        hasher = self.file_hashers[file_name]
+        copied = 0
+        while copied < length:
+            data = os.pread(base_file.fileno(), min(length - copied, 1024 * 1024), source + copied)
+            if not data:
+                raise ValueError(f"{file_name} is shorter than its signature")
+            file.write(data)
+            hasher.update(data)
+            copied += len(data)
+        self.stats["delta_copied_bytes"] += length
+
+    # On a mismatch the whole file is asked for instead
+    def finish_delta(self, file_name: str, remote_file_hash: str):
+        file_path = f"{self.client_folder}/{file_name}"
+        self.delta_base_files.pop(file_name).close()
+        self.open_files.pop(file_name).close()
+        if self.file_hashers.pop(file_name).hexdigest() != remote_file_hash:
+            print("ERROR: File hash does not match. Downloading the whole file...")
+            os.remove(f"{file_path}.delta")
+            self.stats["hash_mismatches"] += 1
+            self.ask_for_file(file_name, delta=False)
+            return
+        os.replace(f"{file_path}.delta", file_path)
+        print(f"File {file_name} successfully updated!")
+        self.finish_download(file_name, True)
+
+    # byte_range is (offset, length) to ask for part of the file
+    def send_file_request(self, file_name: str, byte_range=None):
+        self.last_chunk_times[file_name] = time.monotonic()
+        message = f"Arquivo<DELIMITER>{file_name}"
+        if byte_range is not None:
+            message += f"<DELIMITER>OFFSET={byte_range[0]}<DELIMITER>LENGTH={byte_range[1]}"
+        if self.streams:
+            # Every request (a range, a corrupted file asked again) gets a new stream
+            stream_id = self.next_stream_id
+            self.next_stream_id += 1
+            self.file_streams.setdefault(file_name, []).append(stream_id)
+            self.stream_pending[stream_id] = 0
+            message += f"<DELIMITER>STREAM={stream_id}<DELIMITER>WINDOW={self.stream_window}"
+        elif self.sendfile and self.compression is None:
+            message += "<DELIMITER>SENDFILE"
+        if self.frames:
+            message += "<DELIMITER>FRAMES"
+        if self.compression is not None:
+            message += f"<DELIMITER>COMPRESS={format_compression(*self.compression)}"
+        self.send(message.encode("utf-8"))
+
+    # The server stops a stream once it sent a whole window, it's granted again as
+    # soon as half of it was written to disk
+    def grant_window(self, stream_id: int, received: int):
+        if stream_id not in self.stream_pending:
+            return
+        self.stream_pending[stream_id] += received
+        if self.stream_pending[stream_id] >= self.stream_window // 2:
+            with self.send_lock:
+                send_frame(self.sock, FRAME_WINDOW, b"", self.stream_pending[stream_id], b"", stream_id)
+            self.stream_pending[stream_id] = 0
+
+    def request_manifest(self, file_name: str):
+        self.last_chunk_times[file_name] = time.monotonic()
+        self.send(f"Arquivo<DELIMITER>{file_name}<DELIMITER>MANIFEST".encode("utf-8"))
+
+    # Keeps the chunks already on disk that match the manifest, so an interrupted
+    # download goes on from where it stopped, and asks for the rest
+    def start_ranges(self, file_name: str, manifest: Manifest):
+        file_path = f"{self.client_folder}/{file_name}"
+        resumed = os.path.isfile(file_path)
+        file = open(file_path, "r+b" if resumed else "w+b")
+        file.truncate(manifest.file_size)
+        tracker = Chunk_Tracker(manifest)
+        if resumed:
+            tracker.check_file(file.fileno())
+        self.open_files[file_name] = file
+        self.trackers[file_name] = tracker
+        self.request_ranges(file_name)
+
+    def request_ranges(self, file_name: str):
+        ranges = self.trackers[file_name].missing_ranges()
+        if not ranges:
+            self.open_files.pop(file_name).close()
+            del self.trackers[file_name]
+            print(f"File {file_name} successfully downloaded!")
+            self.finish_download(file_name, True)
+            return
+        self.pending_ranges[file_name] = len(ranges)
+        self.range_rounds[file_name] = self.range_rounds.get(file_name, 0) + 1
+        for byte_range in ranges:
+            self.send_file_request(file_name, byte_range)
+
+    # Once every range asked for has ended, the chunks that didn't match are asked again,
+    # or the whole manifest when the file changed in the server meanwhile
+    def finish_range(self, file_name: str, remote_file_hash: str):
+        tracker = self.trackers[file_name]
+        if remote_file_hash != tracker.manifest.digest:
+            self.stale_manifests.add(file_name)
+        self.pending_ranges[file_name] -= 1
+        if self.pending_ranges[file_name]:
+            return
+        stale = file_name in self.stale_manifests
+        if not stale and tracker.complete():
+            self.request_ranges(file_name)
+            return
+        if self.range_rounds.get(file_name, 0) >= self.RANGE_ATTEMPTS:
+            print(f"ERROR: Could not download {file_name} after {self.RANGE_ATTEMPTS} attempts.")
+            self.finish_download(file_name, False)
+            return
+        if stale:
+            print(f"ERROR: File {file_name} changed in the server. Asking for its manifest again...")
+            self.stats["manifests_refetched"] += 1
+            self.stale_manifests.discard(file_name)
+            self.open_files.pop(file_name).close()
+            del self.trackers[file_name]
+            self.request_manifest(file_name)
+            return
+        missing = tracker.verified.count(0)
+        print(f"ERROR: {missing} chunks of {file_name} do not match their hashes. Trying them again...")
+        self.stats["chunks_refetched"] += missing
+        self.request_ranges(file_name)
+
+    # Text DATA messages come in order, binary frames say where the chunk goes
+    def write_chunk(self, file_name: str, data, offset=None):
+        now = time.monotonic()
+        self.chunk_latencies.append(now - self.last_chunk_times.get(file_name, now))
+        self.last_chunk_times[file_name] = now
+        if file_name not in self.open_files:
+            self.open_files[file_name] = open(f"{self.client_folder}/{file_name}", "wb")
+        file = self.open_files[file_name]
+        if offset is not None and file.tell() != offset:
+            file.seek(offset)
+        tracker = self.trackers.get(file_name)
+        if tracker is not None:
+            tracker.update(file.tell(), data)
+        else:
+            self.file_hashers[file_name].update(data)
+        file.write(data)
+
+    # A chunk that doesn't decompress is left out, the hash (or the manifest) finds it missing
+    def write_compressed_chunk(self, file_name: str, payload, offset: int):
+        try:
+            data = decompress_chunk(payload)
+        except Exception as error:
+            print(f"ERROR: Could not decompress a chunk of {file_name}: {error}")
+            return
+        self.stats["compressed_bytes"] += len(payload)
+        self.stats["decompressed_bytes"] += len(data)
+        self.write_chunk(file_name, data, offset)
+
+    # Reads the raw contents that follow a SIZE message straight into a reusable buffer
+    def receive_file_body(self, file_name: str, file_size: int, offset=0):
+        tracker = self.trackers.get(file_name)
+        if tracker is None:
+            file = open(f"{self.client_folder}/{file_name}", "wb")
+            self.open_files[file_name] = file
+            hasher = self.file_hashers[file_name] = hashlib.sha256()
+        else:
+            file = self.open_files[file_name]
+            file.seek(offset)
+        buffer = memoryview(bytearray(min(file_size, 256 * 1024)))
+        remaining = file_size
+        while remaining:
+            received = self.reader.read_into(buffer[: min(remaining, len(buffer))])
+            if not received:
+                raise ConnectionAbortedError
+            if tracker is None:
+                hasher.update(buffer[:received])
+            else:
+                tracker.update(offset + file_size - remaining, buffer[:received])
+            file.write(buffer[:received])
+            remaining -= received
+            now = time.monotonic()
+            self.chunk_latencies.append(
+                now - self.last_chunk_times.get(file_name, now)
+            )
+            self.last_chunk_times[file_name] = now
+
+    # Every attempt keeps the chunks the previous ones left on disk
+    def download_segmented(self, file_name: str, connections=4, piece_size=DEFAULT_PIECE_SIZE, attempts=3) -> bool:
+        for _ in range(attempts):
+            download = Segmented_Download(
+                self.host, self.port, file_name, f"{self.client_folder}/{file_name}", connections, piece_size
+            )
+            success = download.run()
+            self.chunk_latencies.extend(download.piece_latencies)
+            if download.tracker is None:
+                return False
+            self.stats["chunks_refetched"] += download.tracker.failed
+            if success:
+                print(f"File {file_name} successfully downloaded!")
+                return True
+        return False
+
+    def request_file(self, file_name: str) -> threading.Event:
+        self.downloads[file_name] = threading.Event()
+        self.ask_for_file(file_name)
+        return self.downloads[file_name]
+
+    # The counters, gauges and histograms of the server, or None without an answer in time
+    def request_stats(self, timeout=None):
+        self.server_stats_received.clear()
+        self.send(b"STATS")
+        if not self.server_stats_received.wait(timeout):
+            return None
+        return self.server_stats
+
+    def wait_for_file(self, file_name: str, timeout=None) -> bool:
+        if not self.downloads[file_name].wait(timeout):
+            return False
+        del self.downloads[file_name]
+        return self.download_results.pop(file_name)
+
+    def finish_download(self, file_name: str, success: bool):
+        self.last_chunk_times.pop(file_name, None)
+        for stream_id in self.file_streams.pop(file_name, []):
+            self.stream_pending.pop(stream_id, None)
+        self.trackers.pop(file_name, None)
+        self.pending_ranges.pop(file_name, None)
+        self.range_rounds.pop(file_name, None)
+        self.stale_manifests.discard(file_name)
+        self.delta_bases.pop(file_name, None)
+        if file_name in self.delta_base_files:
+            self.delta_base_files.pop(file_name).close()
+        if file_name in self.open_files:
+            self.open_files.pop(file_name).close()
+        if file_name in self.downloads:
+            self.download_results[file_name] = success
+            self.downloads[file_name].set()
+
     def stop(self):
+        if not self.running:
+            return
         self.running = False
+        try:
+            # Wakes up the receiving thread blocked on recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
         print("Client stopped.")
 
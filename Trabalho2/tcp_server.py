@@ -1,30 +1,190 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import mmap
 import os
+import random
+import resource
 import socket
 import threading
+import time
 from typing import Literal
 
-from utils import calculate_sha256, recv_message, send_message
+from chat_room import (
+    DROP_OLDEST,
+    SLOW_CONSUMER_POLICIES,
+    Async_Chat_Outbox,
+    Chat_Outbox,
+    Chat_Room,
+    Produced_Ahead,
+)
+from compression import COMPRESSED_CHUNK_SIZE, Compression_Cache, compress_chunk, parse_compression
+from delta import COPY_RANGE, LITERAL_FRAME_SIZE, delta_instructions, parse_signature, valid_signature
+from digest_cache import Digest_Cache
+from metrics import Metrics, Timed_Iterator, tcp_info
+from framing import (
+    FRAME_COMPRESSED,
+    FRAME_COPY,
+    FRAME_DATA,
+    FRAME_SIGNATURE,
+    FRAME_WINDOW,
+    LENGTH_PREFIX,
+    Frame_Reader,
+    is_binary_frame,
+    pack_frame_header,
+    read_frame_async,
+    sendmsg_all,
+    unpack_frame,
+)
+from utils import send_message
 
 CLIENT_MODES = Literal["Command", "Chat"]
 
+NON_EXISTENT_FILE_MESSAGE = "Arquivo<DELIMITER>NON_EXISTENT_FILE".encode("utf-8")
+
+# DATA bytes a stream may send before the client grants more, when it doesn't say
+DEFAULT_STREAM_WINDOW = 1024 * 1024
+# Answered with INVALID_RANGE instead of the file
+INVALID_RANGE = (-1, -1)
+
+
+def file_message(filename: str, kind: str, *args) -> bytes:
+    fields = ["Arquivo", "SUCCESS", filename, kind, *(str(arg) for arg in args)]
+    return "<DELIMITER>".join(fields).encode("utf-8")
+
+
+def framed(message: bytes) -> bytes:
+    return LENGTH_PREFIX.pack(len(message)) + message
+
+
+# The KEY=value options of an Arquivo request
+def request_values(options: list) -> dict:
+    return dict(option.decode("utf-8").split("=", 1) for option in options if b"=" in option)
+
+
+# Arquivo<DELIMITER>name<DELIMITER>STREAM=id<DELIMITER>WINDOW=bytes asks for the file
+# on a stream: (stream id, window), or None for a plain request
+def stream_request(options: list):
+    values = request_values(options)
+    if "STREAM" not in values:
+        return None
+    return int(values["STREAM"]), int(values.get("WINDOW", DEFAULT_STREAM_WINDOW))
+
+
+# OFFSET=bytes<DELIMITER>LENGTH=bytes asks for part of the file: (offset, length), the
+# length None up to the end of the file, None for the whole file or INVALID_RANGE when
+# a value is negative or not a number
+def range_request(options: list):
+    values = request_values(options)
+    if "OFFSET" not in values and "LENGTH" not in values:
+        return None
+    length = values.get("LENGTH")
+    try:
+        byte_range = int(values.get("OFFSET", 0)), None if length is None else int(length)
+    except ValueError:
+        return INVALID_RANGE
+    if byte_range[0] < 0 or (byte_range[1] or 0) < 0:
+        return INVALID_RANGE
+    return byte_range
+
+
+# COMPRESS=codec/level asks for the DATA chunks compressed, in binary frames whatever
+# the other options say: (codec, level), or None for an unknown codec or no compression
+def compression_request(options: list):
+    values = request_values(options)
+    if "COMPRESS" not in values:
+        return None
+    return parse_compression(values["COMPRESS"])
+
+
+# (offset, length) of the bytes to send, clamped to the file
+def file_range(byte_range, file_size: int):
+    if byte_range is None:
+        return 0, file_size
+    offset = min(byte_range[0], file_size)
+    if byte_range[1] is None:
+        return offset, file_size - offset
+    return offset, min(byte_range[1], file_size - offset)
+
+
+# START and SIZE answers to a range request also carry its offset and the size of the
+# whole file. HASH is always the digest of the whole file
+def range_fields(byte_range, offset: int, file_size: int):
+    if byte_range is None:
+        return ()
+    return offset, file_size
+
+
+# The contents of the file without reading them all (mmap can't map an empty file)
+def map_file(file, file_size: int):
+    if not file_size:
+        return contextlib.nullcontext(b"")
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
 
 class TCP_Server:
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        interactive=True,
+        corruption_rate=0.0,
+        seed=None,
+        digest_cache=None,
+        compression_cache=None,
+        backlog=5,
+        chat_queue_size=256,
+        slow_consumer_policy=DROP_OLDEST,
+        quiet=False,
+        stats_file=None,
+        stats_interval=10.0,
+    ) -> None:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
+        self.backlog = backlog
+        self.server_socket.listen(backlog)
         self.clients = []
-        self.chat_clients = []
+        self.chat_room = Chat_Room()
+        # Chat messages queued for each client before slow_consumer_policy applies
+        self.chat_queue_size = chat_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
         self.running = True
+        # Without a terminal the server chat is not read from stdin
+        self.interactive = interactive
+        # Fraction of the file transfers with one DATA chunk corrupted on purpose,
+        # a seed makes them repeatable
+        self.corruption_rate = corruption_rate
+        self.random = random.Random(seed)
+        self.digest_cache = digest_cache or Digest_Cache()
+        self.compression_cache = compression_cache or Compression_Cache()
+        # Without the messages of every connection and transfer, the errors are still printed
+        self.quiet = quiet
+        # Counters and latency histograms, answered to STATS and appended every
+        # stats_interval seconds to stats_file (JSON lines) when there is one
+        self.stats = Metrics()
+        self.stats.gauge("connections_open", lambda: self.stats["connections"] - self.stats["connections_closed"])
+        self.stats.gauge("chat_queue_depth", self.chat_queue_depth)
+        if stats_file:
+            self.stats.start_dumping(stats_file, stats_interval)
 
         print(f"Server listening on {host}:{port}")
         self._run()
 
     def _run(self):
-        server_chat_send_thread = threading.Thread(target=self.server_chat_send_handler)
-        server_chat_send_thread.start()
+        if self.interactive:
+            server_chat_send_thread = threading.Thread(
+                target=self.server_chat_send_handler
+            )
+            server_chat_send_thread.start()
         while self.running:
             client_socket, addr = self.server_socket.accept()
+            # A range answer is three writes (SIZE, body, HASH): without this the body
+            # waits for the delayed ACK of SIZE
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.clients.append(client_socket)
             client_handler = threading.Thread(
                 target=self.handle_client, args=(client_socket,)
@@ -33,105 +193,779 @@ class TCP_Server:
 
     def handle_client(self, client_socket: socket.socket) -> None:
         client_mode: CLIENT_MODES = "Command"
+        # Writer of the connection while it's in the chat or has streams
+        outbox = None
 
         with client_socket as sock:
-            print(f"Accepted connection from {sock.getpeername()}")
+            self.stats.add("connections")
+            self.log(f"Accepted connection from {sock.getpeername()}")
+            reader = Frame_Reader(sock)
 
             while self.running:
                 if client_mode == "Command":
                     try:
-                        message = recv_message(sock=sock)
+                        message = reader.read_frame()
                     except ConnectionResetError:
-                        print(f"Connection reset by peer: {sock.getpeername()}")
+                        self.log(f"Connection reset by peer: {sock.getpeername()}")
                         break
-                    split_message = message.split(b"<DELIMITER>")
+                    if message is None:
+                        self.log("Connection closed by peer")
+                        break
+                    if is_binary_frame(message) and message[0] == FRAME_SIGNATURE:
+                        if outbox is not None:
+                            # Sent by the writer after what it still has, the window
+                            # updates of its streams keep being read meanwhile
+                            outbox.put_task(functools.partial(self.send_delta, sock, bytes(message)))
+                        else:
+                            self.send_delta(sock, message)
+                        continue
+                    if is_binary_frame(message):
+                        self.handle_frame(outbox, message)
+                        continue
+                    split_message = bytes(message).split(b"<DELIMITER>")
 
                     if split_message[0] == b"Sair":
+                        self.connection_closed(sock)
                         sock.shutdown(socket.SHUT_RDWR)
                         sock.close()
-                        print("Connection closed")
+                        self.log("Connection closed")
                         break
 
+                    elif split_message[0] == b"STATS":
+                        if outbox is not None:
+                            outbox.put(framed(self.stats_message()), bounded=False)
+                        else:
+                            send_message(sock, self.stats_message())
+
                     elif split_message[0] == b"Chat":
-                        self.chat_clients.append(sock)
+                        outbox = outbox or self.new_outbox(sock)
+                        self.chat_room.join(sock, outbox)
                         client_mode = "Chat"
 
                     elif split_message[0] == b"Arquivo" and len(split_message) >= 2:
                         filename = split_message[1].decode("utf-8")
-                        if not os.path.isfile(f"./server_files/{filename}"):
-                            print(f"ERROR: File {filename} does not exist.")
-                            send_message(
-                                sock,
-                                f"Arquivo<DELIMITER>NON_EXISTENT_FILE".encode("utf-8"),
+                        options = split_message[2:]
+                        if b"MANIFEST" in options:
+                            message = self.manifest_message(filename)
+                            if outbox is not None:
+                                outbox.put(framed(message), bounded=False)
+                            else:
+                                send_message(sock, message)
+                            continue
+                        stream = stream_request(options)
+                        if stream is not None:
+                            outbox = outbox or self.new_outbox(sock)
+                            self.start_stream(
+                                outbox, filename, *stream, range_request(options), compression_request(options)
                             )
+                            continue
+                        transfer = functools.partial(
+                            self.send_file,
+                            sock,
+                            filename,
+                            b"SENDFILE" in options,
+                            b"FRAMES" in options,
+                            range_request(options),
+                            compression_request(options),
+                        )
+                        if outbox is not None:
+                            # A plain transfer writes straight to the socket, after
+                            # everything the writer still has to send
+                            outbox.put_task(transfer)
                         else:
-                            print(f"Reading file {filename} and sending to client...")
-                            with open(f"./server_files/{filename}", "rb") as file:
-                                start_message = f"Arquivo<DELIMITER>SUCCESS<DELIMITER>{filename}<DELIMITER>START".encode(
-                                    "utf-8"
-                                )
-                                send_message(sock, start_message)
-                                while True:
-                                    data = file.read(1024)
-                                    if not data:
-                                        break
-                                    message_header = f"Arquivo<DELIMITER>SUCCESS<DELIMITER>{filename}<DELIMITER>DATA<DELIMITER>".encode(
-                                        "utf-8"
-                                    )
-                                    message_to_send = message_header + data
-                                    send_message(sock, message_to_send)
-                                hash = calculate_sha256(f"./server_files/{filename}")
-                                hash_message = f"Arquivo<DELIMITER>SUCCESS<DELIMITER>{filename}<DELIMITER>HASH<DELIMITER>{hash}".encode(
-                                    "utf-8"
-                                )
-                                send_message(sock, hash_message)
-                                print(f"Successfully sent file {filename} to client.")
+                            transfer()
 
                 elif client_mode == "Chat":
-                    self.server_chat_rcv_handler(sock)
+                    outbox = self.server_chat_rcv_handler(sock, reader, outbox)
                     client_mode = "Command"
+            if outbox is not None:
+                outbox.close()
+            if sock.fileno() != -1:
+                self.connection_closed(sock)
+
+    def log(self, message: str) -> None:
+        if not self.quiet:
+            print(message)
+
+    # With the segments the kernel retransmitted and the RTT it measured
+    def connection_closed(self, sock) -> None:
+        self.stats.add("connections_closed")
+        info = tcp_info(sock)
+        if info is not None:
+            self.stats.add("tcp_retransmits", info[0])
+            self.stats.observe("tcp_rtt_s", info[1])
+
+    # Messages waiting to be written to the chat members, read from the thread answering STATS
+    def chat_queue_depth(self) -> dict:
+        depths = [len(outbox.messages) for _, outbox in self.chat_room.snapshot]
+        return {"clients": len(depths), "max": max(depths, default=0), "total": sum(depths)}
+
+    # STATS: the counters, gauges and histograms of the server as JSON
+    def stats_message(self) -> bytes:
+        self.stats.add("stats_requests")
+        return b"STATS<DELIMITER>" + json.dumps(self.stats.snapshot()).encode("utf-8")
+
+    def new_outbox(self, sock: socket.socket) -> Chat_Outbox:
+        return Chat_Outbox(sock, self.chat_queue_size, self.slow_consumer_policy)
+
+    # Window updates for the streams of the connection
+    def handle_frame(self, outbox, message: memoryview):
+        try:
+            kind, stream_id, _, offset, _ = unpack_frame(message)
+        except ValueError as error:
+            print(f"ERROR: Invalid frame: {error}")
+            return
+        if kind == FRAME_WINDOW and outbox is not None:
+            outbox.update_window(stream_id, offset)
+
+    # Arquivo<DELIMITER>name<DELIMITER>MANIFEST asks for the hashes of the chunks of the
+    # file, the client then asks for the ranges it's missing
+    def manifest_message(self, filename: str) -> bytes:
+        file_path = f"./server_files/{filename}"
+        self.stats.add("manifest_requests")
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            return NON_EXISTENT_FILE_MESSAGE
+        manifest = self.digest_cache.manifest(file_path, os.stat(file_path))
+        return file_message(filename, "MANIFEST", *manifest.fields())
+
+    def start_stream(self, outbox, filename: str, stream_id: int, window: int, byte_range=None, compression=None):
+        self.log(f"Sending file {filename} on stream {stream_id}...")
+        outbox.add_stream(stream_id, self.stream_messages(filename, stream_id, byte_range, compression), window)
+
+    # The messages of a file sent on a stream, each one with the DATA bytes it takes
+    # from the window. They're produced as the writer gets to them, interleaved with
+    # the chat and the other streams of the connection
+    def stream_messages(self, filename: str, stream_id: int, byte_range=None, compression=None):
+        file_path = f"./server_files/{filename}"
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            yield [framed(NON_EXISTENT_FILE_MESSAGE)], 0
+            return
+        if byte_range == INVALID_RANGE:
+            print(f"ERROR: Invalid range of file {filename}.")
+            yield [framed(file_message(filename, "INVALID_RANGE"))], 0
+            return
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            offset, length = file_range(byte_range, stat.st_size)
+            hash = self.digest_cache.get(file_path, stat)
+            corrupted_chunk = self.pick_corrupted_chunk(length)
+            hasher = self.inline_hasher(hash, length, stat.st_size)
+            fields = range_fields(byte_range, offset, stat.st_size)
+            yield [framed(file_message(filename, "START", *fields))], 0
+            chunks = Timed_Iterator(
+                self.chunk_messages(filename, file, offset, length, corrupted_chunk, hasher, True, stream_id, compression)
+            )
+            bytes_sent = 0
+            for buffers in chunks:
+                bytes_sent += len(buffers[-1])
+                yield buffers, len(buffers[-1])
+            self.file_sent(bytes_sent, chunks.seconds)
+            if hasher is not None:
+                hash = hasher.hexdigest()
+                self.digest_cache.put(file_path, stat, hash)
+        if hash is None:
+            hash = self.digest_cache.digest(file_path, stat)
+        yield [framed(file_message(filename, "HASH", hash))], 0
+        self.log(f"Successfully sent file {filename} on stream {stream_id}.")
+
+    def send_file(
+        self, sock: socket.socket, filename: str, use_sendfile=False, use_frames=False, byte_range=None, compression=None
+    ):
+        file_path = f"./server_files/{filename}"
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            send_message(sock, NON_EXISTENT_FILE_MESSAGE)
+            return
+        if byte_range == INVALID_RANGE:
+            print(f"ERROR: Invalid range of file {filename}.")
+            send_message(sock, file_message(filename, "INVALID_RANGE"))
+            return
+        self.log(f"Reading file {filename} and sending to client...")
+        started = time.perf_counter()
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            offset, length = file_range(byte_range, stat.st_size)
+            fields = range_fields(byte_range, offset, stat.st_size)
+            hash = self.digest_cache.get(file_path, stat)
+            corrupted_chunk = self.pick_corrupted_chunk(length)
+            if use_sendfile and compression is None:
+                # SENDFILE mode: a single SIZE message followed by the raw file contents,
+                # copied by the kernel straight from the page cache to the socket
+                send_message(sock, file_message(filename, "SIZE", length, *fields))
+                for segment_offset, count, data in self.body_segments(file, offset, length, corrupted_chunk):
+                    if data is None:
+                        sock.sendfile(file, segment_offset, count)
+                    else:
+                        sock.sendall(data)
+                # Reading and sending are one thing here
+                self.file_sent(length)
+                self.stats.observe("sendfile_s", time.perf_counter() - started)
+            else:
+                hasher = self.inline_hasher(hash, length, stat.st_size)
+                send_message(sock, file_message(filename, "START", *fields))
+                chunks = Timed_Iterator(
+                    self.chunk_messages(
+                        filename, file, offset, length, corrupted_chunk, hasher, use_frames, compression=compression
+                    )
+                )
+                bytes_sent = 0
+                sending = time.perf_counter()
+                for buffers in chunks:
+                    sendmsg_all(sock, buffers)
+                    bytes_sent += len(buffers[-1])
+                self.file_sent(bytes_sent, chunks.seconds, time.perf_counter() - sending - chunks.seconds)
+                if hasher is not None:
+                    hash = hasher.hexdigest()
+                    self.digest_cache.put(file_path, stat, hash)
+        if hash is None:
+            hash = self.digest_cache.digest(file_path, stat)
+        send_message(sock, file_message(filename, "HASH", hash))
+        self.stats.observe("transfer_s", time.perf_counter() - started)
+        self.log(f"Successfully sent file {filename} to client.")
+
+    # file_read_s is the time taken reading (and compressing) the DATA chunks of a
+    # file and send_s the rest of the time sending them, when each one can be told apart
+    def file_sent(self, bytes_sent: int, read_seconds=None, send_seconds=None) -> None:
+        self.stats.add("files_sent")
+        self.stats.add("file_bytes_sent", bytes_sent)
+        if read_seconds is not None:
+            self.stats.observe("file_read_s", read_seconds)
+        if send_seconds is not None:
+            self.stats.observe("send_s", send_seconds)
+
+    # Not cached yet: hashed while it's read to be sent, unless only part of it is sent
+    def inline_hasher(self, hash, length: int, file_size: int):
+        if hash is None and length == file_size:
+            return hashlib.sha256()
+        return None
+
+    # FRAME_SIGNATURE: the client has a copy of the file, maybe an older one. It gets
+    # UNCHANGED when the digests match, otherwise DELTA, the frames that rebuild the file
+    # from its copy and HASH
+    def send_delta(self, sock: socket.socket, frame: memoryview):
+        self.stats.add("delta_requests")
+        try:
+            _, _, name, block_size, payload = unpack_frame(frame)
+            filename = name.decode("utf-8")
+        except ValueError as error:
+            # Without a name the answer can't say which file it was
+            print(f"ERROR: Invalid signature frame: {error}")
+            send_message(sock, file_message("", "INVALID_SIGNATURE"))
+            return
+        file_path = f"./server_files/{filename}"
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            send_message(sock, NON_EXISTENT_FILE_MESSAGE)
+            return
+        if not valid_signature(block_size, payload):
+            print(f"ERROR: Invalid signature of file {filename}.")
+            send_message(sock, file_message(filename, "INVALID_SIGNATURE"))
+            return
+        client_digest, blocks = parse_signature(payload)
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            hash = self.digest_cache.digest(file_path, stat)
+            if hash == client_digest:
+                self.log(f"Client already has file {filename}.")
+                send_message(sock, file_message(filename, "UNCHANGED"))
+                return
+            self.log(f"Sending the changes to file {filename} to client...")
+            send_message(sock, file_message(filename, "DELTA", stat.st_size))
+            with map_file(file, stat.st_size) as data:
+                instructions = list(delta_instructions(data, block_size, blocks))
+                for buffers in self.delta_messages(filename, data, instructions):
+                    sendmsg_all(sock, buffers)
+                    self.stats.add("delta_bytes_sent", len(buffers[-1]))
+        send_message(sock, file_message(filename, "HASH", hash))
+        self.log(f"Successfully sent the changes to file {filename}.")
+
+    # What the client copies from its file goes in COPY frames, the rest in DATA frames,
+    # both with the offset where the bytes go
+    def delta_messages(self, filename: str, data, instructions):
+        name = filename.encode("utf-8")
+        offset = 0
+        for kind, first, second in instructions:
+            if kind == "copy":
+                yield [pack_frame_header(FRAME_COPY, name, offset, COPY_RANGE.size), COPY_RANGE.pack(first, second)]
+                offset += second
+                continue
+            for start in range(first, second, LITERAL_FRAME_SIZE):
+                literal = data[start : min(start + LITERAL_FRAME_SIZE, second)]
+                yield [pack_frame_header(FRAME_DATA, name, offset, len(literal)), literal]
+                offset += len(literal)
+
+    # The DATA chunks as lists of buffers ready to be sent: binary DATA frames
+    # (name and offset in a fixed header) in FRAMES mode, otherwise text DATA messages
+    def chunk_messages(
+        self,
+        filename: str,
+        file,
+        offset: int,
+        length: int,
+        corrupted_chunk,
+        hasher=None,
+        use_frames=False,
+        stream_id=0,
+        compression=None,
+    ):
+        if compression is not None:
+            yield from self.compressed_chunk_messages(
+                filename, file, offset, length, corrupted_chunk, hasher, compression, stream_id
+            )
+            return
+        chunk_no = 0
+        name = filename.encode("utf-8")
+        message_header = file_message(filename, "DATA", "")
+        file.seek(offset)
+        remaining = length
+        while remaining:
+            data = file.read(min(1024, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            if hasher is not None:
+                hasher.update(data)
+            if chunk_no == corrupted_chunk:
+                data = self.modify_bytes(data, self.random.randint(1, 2))
+            if use_frames:
+                yield [pack_frame_header(FRAME_DATA, name, offset + chunk_no * 1024, len(data), stream_id), data]
+            else:
+                yield [LENGTH_PREFIX.pack(len(message_header) + len(data)), message_header, data]
+            chunk_no += 1
+
+    # Chunks of COMPRESSED_CHUNK_SIZE bytes starting at multiples of it (the first and last
+    # ones of a range may be shorter) in COMPRESSED frames, or in DATA frames when they
+    # don't compress. Whole chunks come from the cache unless one is corrupted on purpose
+    def compressed_chunk_messages(
+        self, filename: str, file, offset: int, length: int, corrupted_chunk, hasher, compression, stream_id=0
+    ):
+        name = filename.encode("utf-8")
+        stat = os.fstat(file.fileno())
+        corrupted_offset = None if corrupted_chunk is None else offset + corrupted_chunk * 1024
+        position, end = offset, offset + length
+        while position < end:
+            chunk_end = min(end, (position // COMPRESSED_CHUNK_SIZE + 1) * COMPRESSED_CHUNK_SIZE)
+            data = os.pread(file.fileno(), chunk_end - position, position)
+            if not data:
+                break
+            if hasher is not None:
+                hasher.update(data)
+            whole_chunk = position % COMPRESSED_CHUNK_SIZE == 0 and (
+                len(data) == COMPRESSED_CHUNK_SIZE or position + len(data) == stat.st_size
+            )
+            if corrupted_offset is not None and position <= corrupted_offset < position + len(data):
+                start = corrupted_offset - position
+                corrupted = self.modify_bytes(data[start : start + 1024], self.random.randint(1, 2))
+                data = data[:start] + corrupted + data[start + 1024 :]
+                payload = compress_chunk(data, *compression)
+            elif whole_chunk:
+                payload = self.compression_cache.chunk(file.name, stat, *compression, position, data)
+            else:
+                payload = compress_chunk(data, *compression)
+            if payload is None:
+                yield [pack_frame_header(FRAME_DATA, name, position, len(data), stream_id), data]
+            else:
+                yield [pack_frame_header(FRAME_COMPRESSED, name, position, len(payload), stream_id), payload]
+            position += len(data)
+
+    # (offset, count, data) of the parts of the SENDFILE body: data is None for the
+    # ranges sent straight from the file, only a corrupted chunk goes through user space
+    def body_segments(self, file, offset: int, length: int, corrupted_chunk):
+        if corrupted_chunk is None:
+            if length:
+                yield offset, length, None
+            return
+        corrupted_offset = offset + corrupted_chunk * 1024
+        if corrupted_offset > offset:
+            yield offset, corrupted_offset - offset, None
+        data = os.pread(file.fileno(), min(1024, offset + length - corrupted_offset), corrupted_offset)
+        yield corrupted_offset, len(data), self.modify_bytes(data, self.random.randint(1, 2))
+        end = corrupted_offset + len(data)
+        if offset + length > end:
+            yield end, offset + length - end, None
+
+    def pick_corrupted_chunk(self, length: int):
+        if self.corruption_rate and length and self.random.random() < self.corruption_rate:
+            self.stats.add("transfers_corrupted")
+            return self.random.randrange(-(-length // 1024))
+        return None
+
+    def modify_bytes(self, data: bytes, num_changes: int) -> bytes:
+        modified_data = bytearray(data)
+        indices_to_change = self.random.sample(
+            range(len(modified_data)), min(num_changes, len(modified_data))
+        )
+        for index in indices_to_change:
+            modified_data[index] = self.random.randint(0, 255)
+        return bytes(modified_data)
 
     def server_chat_send_handler(self):
         while True:
             chat_message = input()
             self.send_to_all_clients(chat_message, asServer=True)
 
-    def server_chat_rcv_handler(self, sock: socket.socket):
+    # Returns the writer of the connection if it still has streams to send
+    def server_chat_rcv_handler(self, sock: socket.socket, reader: Frame_Reader, outbox):
         while True:
             try:
-                chat_message_encoded = recv_message(sock)
-                if chat_message_encoded == b"Chat<DELIMITER>Sair":
-                    self.chat_clients.remove(sock)
+                chat_message_encoded = reader.read_frame()
+                if not chat_message_encoded or chat_message_encoded == b"Chat<DELIMITER>Sair":
                     break
-                if not chat_message_encoded:
-                    break
-                chat_message = chat_message_encoded.decode("utf-8")
+                if is_binary_frame(chat_message_encoded):
+                    self.handle_frame(outbox, chat_message_encoded)
+                    continue
+                chat_message = bytes(chat_message_encoded).decode("utf-8")
+                # Files asked for on a stream don't wait for the chat to be left
+                split_message = chat_message.split("<DELIMITER>")
+                options = [option.encode("utf-8") for option in split_message[2:]]
+                if split_message[0] == "Arquivo" and b"MANIFEST" in options:
+                    outbox.put(framed(self.manifest_message(split_message[1])), bounded=False)
+                    continue
+                stream = stream_request(options)
+                if split_message[0] == "Arquivo" and stream is not None:
+                    self.start_stream(
+                        outbox, split_message[1], *stream, range_request(options), compression_request(options)
+                    )
+                    continue
                 peer_name = sock.getpeername()
                 chat_message_to_send = (
                     f"({peer_name[0]}:{peer_name[1]}): {chat_message}"
                 )
                 print(chat_message_to_send)
+                self.stats.add("chat_messages")
                 to_send_message = f"Chat<DELIMITER>{chat_message_to_send}"
                 self.send_to_all_clients(to_send_message, current_socket=sock)
             except Exception as error:
                 print(f"Error in handle_chat: {error}")
                 break
+        self.chat_room.leave(sock)
+        if outbox.streams:
+            return outbox
+        outbox.finish()
+        return None
 
+    # Only queues the message for every other member of the chat, their own writers send it
     def send_to_all_clients(self, message: str, asServer=False, current_socket=None):
         if message == "":
             return
-        for client in self.chat_clients:
-            if client != current_socket:
-                try:
-                    message_to_send = (
-                        f"{'Chat<DELIMITER>SERVER: ' if asServer else ''}{message}"
+        message_to_send = f"{'Chat<DELIMITER>SERVER: ' if asServer else ''}{message}"
+        self.chat_room.broadcast(message_to_send.encode("utf-8"), exclude=current_socket)
+
+
+# Every connection is a coroutine on a single event loop instead of a thread, with the
+# same wire protocol. Each chat member gets a writer task instead of a thread
+class Async_TCP_Server(TCP_Server):
+    # Chunks written before waiting for the transport buffer to drain
+    DRAIN_EVERY = 64
+
+    def _run(self):
+        if self.interactive:
+            server_chat_send_thread = threading.Thread(
+                target=self.server_chat_send_handler, daemon=True
+            )
+            server_chat_send_thread.start()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.server_socket, backlog=self.backlog
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_mode: CLIENT_MODES = "Command"
+        # Writer task of the connection while it's in the chat or has streams
+        outbox = None
+        peer_name = writer.get_extra_info("peername")
+        self.stats.add("connections")
+        self.log(f"Accepted connection from {peer_name}")
+        # asyncio only sets it when the listening socket was created with IPPROTO_TCP
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while self.running:
+                message = await read_frame_async(reader)
+                if message is None:
+                    self.log("Connection closed by peer")
+                    break
+                if is_binary_frame(message) and message[0] == FRAME_SIGNATURE and client_mode == "Command":
+                    if outbox is not None:
+                        outbox.put_task(functools.partial(self.send_delta_async, writer, message))
+                    else:
+                        await self.send_delta_async(writer, message)
+                    continue
+                if is_binary_frame(message):
+                    self.handle_frame(outbox, message)
+                    continue
+                split_message = message.split(b"<DELIMITER>")
+                stream = None
+                if split_message[0] == b"Arquivo" and len(split_message) >= 2:
+                    if b"MANIFEST" in split_message[2:]:
+                        # Built in a thread when it's not cached, it reads the whole file
+                        manifest_message = await self.loop.run_in_executor(
+                            None, self.manifest_message, split_message[1].decode("utf-8")
+                        )
+                        if outbox is not None:
+                            outbox.put(framed(manifest_message), bounded=False)
+                        else:
+                            self.write_message(writer, manifest_message)
+                            await writer.drain()
+                        continue
+                    stream = stream_request(split_message[2:])
+                if stream is not None:
+                    # In command and chat mode alike
+                    outbox = outbox or self.new_outbox(writer)
+                    filename = split_message[1].decode("utf-8")
+                    options = split_message[2:]
+                    self.start_stream(
+                        outbox, filename, *stream, range_request(options), compression_request(options)
                     )
-                    send_message(client, message_to_send.encode("utf-8"))
-                except:
-                    client.close()
-                    self.chat_clients.remove(client)
+                    continue
+                if client_mode == "Command":
+                    if split_message[0] == b"Sair":
+                        self.log("Connection closed")
+                        break
+                    elif split_message[0] == b"STATS":
+                        if outbox is not None:
+                            outbox.put(framed(self.stats_message()), bounded=False)
+                        else:
+                            self.write_message(writer, self.stats_message())
+                            await writer.drain()
+                    elif split_message[0] == b"Chat":
+                        outbox = outbox or self.new_outbox(writer)
+                        self.chat_room.join(writer, outbox)
+                        client_mode = "Chat"
+                    elif split_message[0] == b"Arquivo" and len(split_message) >= 2:
+                        filename = split_message[1].decode("utf-8")
+                        options = split_message[2:]
+                        transfer = functools.partial(
+                            self.send_file_async,
+                            writer,
+                            filename,
+                            b"SENDFILE" in options,
+                            b"FRAMES" in options,
+                            range_request(options),
+                            compression_request(options),
+                        )
+                        if outbox is not None:
+                            outbox.put_task(transfer)
+                        else:
+                            await transfer()
+                elif client_mode == "Chat":
+                    if message == b"Chat<DELIMITER>Sair" or not message:
+                        self.chat_room.leave(writer)
+                        if not outbox.streams:
+                            await outbox.finish()
+                            outbox = None
+                        client_mode = "Command"
+                        continue
+                    chat_message_to_send = (
+                        f"({peer_name[0]}:{peer_name[1]}): {message.decode('utf-8')}"
+                    )
+                    print(chat_message_to_send)
+                    self.stats.add("chat_messages")
+                    self.send_to_all_clients(
+                        f"Chat<DELIMITER>{chat_message_to_send}", current_socket=writer
+                    )
+                    # Frames already buffered by the reader don't yield, the writers
+                    # get their turn before the next message is queued
+                    await asyncio.sleep(0)
+        except (OSError, UnicodeDecodeError) as error:
+            print(f"Error with {peer_name}: {error}")
+        finally:
+            self.chat_room.leave(writer)
+            if outbox is not None:
+                outbox.close()
+            self.connection_closed(writer.get_extra_info("socket"))
+            writer.close()
+
+    def new_outbox(self, writer: asyncio.StreamWriter) -> Async_Chat_Outbox:
+        return Async_Chat_Outbox(writer, self.chat_queue_size, self.slow_consumer_policy)
+
+    def write_message(self, writer: asyncio.StreamWriter, message: bytes):
+        writer.write(LENGTH_PREFIX.pack(len(message)) + message)
+
+    async def send_file_async(
+        self,
+        writer: asyncio.StreamWriter,
+        filename: str,
+        use_sendfile=False,
+        use_frames=False,
+        byte_range=None,
+        compression=None,
+    ):
+        file_path = f"./server_files/{filename}"
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            self.write_message(writer, NON_EXISTENT_FILE_MESSAGE)
+            return
+        if byte_range == INVALID_RANGE:
+            print(f"ERROR: Invalid range of file {filename}.")
+            self.write_message(writer, file_message(filename, "INVALID_RANGE"))
+            return
+        self.log(f"Reading file {filename} and sending to client...")
+        started = time.perf_counter()
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            offset, length = file_range(byte_range, stat.st_size)
+            fields = range_fields(byte_range, offset, stat.st_size)
+            hash = self.digest_cache.get(file_path, stat)
+            corrupted_chunk = self.pick_corrupted_chunk(length)
+            if use_sendfile and compression is None:
+                self.write_message(writer, file_message(filename, "SIZE", length, *fields))
+                # The corrupted chunk, when there is one, is read in a thread
+                segments = await self.loop.run_in_executor(
+                    None, lambda: list(self.body_segments(file, offset, length, corrupted_chunk))
+                )
+                for segment_offset, count, data in segments:
+                    if data is None:
+                        await self.loop.sendfile(writer.transport, file, segment_offset, count)
+                    else:
+                        writer.write(data)
+                self.file_sent(length)
+                self.stats.observe("sendfile_s", time.perf_counter() - started)
+            else:
+                hasher = self.inline_hasher(hash, length, stat.st_size)
+                self.write_message(writer, file_message(filename, "START", *fields))
+                chunks = Timed_Iterator(
+                    self.chunk_messages(
+                        filename, file, offset, length, corrupted_chunk, hasher, use_frames, compression=compression
+                    )
+                )
+                chunk_no = 0
+                bytes_sent = 0
+                send_seconds = 0.0
+                # The chunks are read in a thread while the previous ones are sent
+                async for buffers in self.produce(chunks):
+                    sending = time.perf_counter()
+                    writer.writelines(buffers)
+                    if chunk_no % self.DRAIN_EVERY == 0:
+                        await writer.drain()
+                    send_seconds += time.perf_counter() - sending
+                    bytes_sent += len(buffers[-1])
+                    chunk_no += 1
+                self.file_sent(bytes_sent, chunks.seconds, send_seconds)
+                if hasher is not None:
+                    hash = hasher.hexdigest()
+                    await self.loop.run_in_executor(None, self.digest_cache.put, file_path, stat, hash)
+        if hash is None:
+            hash = await self.loop.run_in_executor(None, self.digest_cache.digest, file_path, stat)
+        self.write_message(writer, file_message(filename, "HASH", hash))
+        await writer.drain()
+        self.stats.observe("transfer_s", time.perf_counter() - started)
+        self.log(f"Successfully sent file {filename} to client.")
+
+    # The messages are read (and compressed) from the file in a thread, a batch ahead
+    async def produce(self, messages):
+        produced = Produced_Ahead(self.loop, messages, self.DRAIN_EVERY)
+        while True:
+            buffers = await produced.take()
+            if buffers is None:
+                return
+            yield buffers
+
+    # The digest and the search for the client's blocks run in a thread
+    async def send_delta_async(self, writer: asyncio.StreamWriter, frame: bytes):
+        self.stats.add("delta_requests")
+        try:
+            _, _, name, block_size, payload = unpack_frame(frame)
+            filename = name.decode("utf-8")
+        except ValueError as error:
+            # Without a name the answer can't say which file it was
+            print(f"ERROR: Invalid signature frame: {error}")
+            self.write_message(writer, file_message("", "INVALID_SIGNATURE"))
+            return
+        file_path = f"./server_files/{filename}"
+        if not os.path.isfile(file_path):
+            print(f"ERROR: File {filename} does not exist.")
+            self.write_message(writer, NON_EXISTENT_FILE_MESSAGE)
+            return
+        if not valid_signature(block_size, payload):
+            print(f"ERROR: Invalid signature of file {filename}.")
+            self.write_message(writer, file_message(filename, "INVALID_SIGNATURE"))
+            return
+        client_digest, blocks = parse_signature(payload)
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            hash = await self.loop.run_in_executor(None, self.digest_cache.digest, file_path, stat)
+            if hash == client_digest:
+                self.log(f"Client already has file {filename}.")
+                self.write_message(writer, file_message(filename, "UNCHANGED"))
+                await writer.drain()
+                return
+            self.log(f"Sending the changes to file {filename} to client...")
+            self.write_message(writer, file_message(filename, "DELTA", stat.st_size))
+            with map_file(file, stat.st_size) as data:
+                instructions = await self.loop.run_in_executor(
+                    None, lambda: list(delta_instructions(data, block_size, blocks))
+                )
+                for count, buffers in enumerate(self.delta_messages(filename, data, instructions)):
+                    writer.writelines(buffers)
+                    self.stats.add("delta_bytes_sent", len(buffers[-1]))
+                    if count % self.DRAIN_EVERY == 0:
+                        await writer.drain()
+        self.write_message(writer, file_message(filename, "HASH", hash))
+        await writer.drain()
+        self.log(f"Successfully sent the changes to file {filename}.")
+
+    def server_chat_send_handler(self):
+        while True:
+            chat_message = input()
+            self.loop.call_soon_threadsafe(self.send_to_all_clients, chat_message, True)
+
+
+# Thousands of connections need as many file descriptors as the hard limit allows
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
 
 if __name__ == "__main__":
-    HOST, PORT = "127.0.0.1", 3300
-    tcp_server = TCP_Server(HOST, PORT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3300)
+    parser.add_argument(
+        "--asyncio", action="store_true", help="serve every client from a single event loop"
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=5, help="pending connections queued by listen"
+    )
+    parser.add_argument(
+        "--chat-queue-size", type=int, default=256, help="chat messages queued for each client"
+    )
+    parser.add_argument(
+        "--slow-consumer",
+        choices=SLOW_CONSUMER_POLICIES,
+        default=DROP_OLDEST,
+        help="what happens to a client whose chat queue is full",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="no messages for every connection and transfer"
+    )
+    parser.add_argument(
+        "--stats-file", default=None, help="appends the stats to this file as JSON lines"
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=10.0, help="seconds between the stats written to --stats-file"
+    )
+    args = parser.parse_args()
+    server_kwargs = {
+        "backlog": args.backlog,
+        "chat_queue_size": args.chat_queue_size,
+        "slow_consumer_policy": args.slow_consumer,
+        "quiet": args.quiet,
+        "stats_file": args.stats_file,
+        "stats_interval": args.stats_interval,
+    }
+    if args.asyncio:
+        raise_file_limit()
+        tcp_server = Async_TCP_Server(args.host, args.port, **server_kwargs)
+    else:
+        tcp_server = TCP_Server(args.host, args.port, **server_kwargs)
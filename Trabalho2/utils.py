@@ -2,6 +2,8 @@ import hashlib
 import socket
 import struct
 
+from framing import sendmsg_all
+
 
 def calculate_sha256(file_path):
     sha256_hash = hashlib.sha256()
@@ -19,10 +21,13 @@ def calculate_sha256_of_file(file):
     return sha256_hash.hexdigest()
 
 
-def send_message(sock: socket.socket, message: bytes):
-    message_len = struct.pack(">I", len(message))
-    message_to_send = message_len + message
-    sock.sendall(message_to_send)
+# The payload buffers are sent after message in the same frame without joining them
+def send_message(sock: socket.socket, message: bytes, *payload):
+    message_len = struct.pack(">I", len(message) + sum(len(buffer) for buffer in payload))
+    if payload:
+        sendmsg_all(sock, [message_len, message, *payload])
+    else:
+        sock.sendall(message_len + message)
 
 
 def recv_message(sock: socket.socket):
@@ -34,10 +39,12 @@ def recv_message(sock: socket.socket):
 
 
 def _recv_num_of_bytes(sock: socket.socket, num: int):
-    data = bytearray()
-    while len(data) < num:
-        packet = sock.recv(num - len(data))
-        if not packet:
+    data = bytearray(num)
+    view = memoryview(data)
+    received = 0
+    while received < num:
+        packet_size = sock.recv_into(view[received:])
+        if not packet_size:
             return None
-        data.extend(packet)
+        received += packet_size
     return data